@@ -16,9 +16,13 @@ import subprocess
 import os, os.path
 import yaml
 import json
+import itertools
+import socket
+import threading
 
 
 local_config_file = '~/.bdkd_datastore.conf'
+local_socket_file = '~/.bdkd_datastore.sock'
 util_name = 'datastore-util'
 
 def configure_datastore(configuration, overwrite=True):
@@ -58,9 +62,98 @@ class DatastoreError(Exception):
     """
     pass
 
+class InProcessBackend:
+    """Calls the datastore operations directly, in this process, using the
+    bdkd.datastore package.  Raises ImportError if it is not installed.
+    """
+
+    def __init__(self):
+        from bdkd.datastore.util import service
+        self._service = service.DatastoreService()
+
+    def call(self, method, **params):
+        """Call a datastore operation
+
+        :param method: name of the operation
+        :param params: the operation's arguments
+        :returns: the result of the operation
+        """
+        try:
+            return self._service.call(method, params)
+        except Exception as e:
+            raise DatastoreError(str(e))
+
+
+class SocketBackend:
+    """Calls the operations of a long-lived datastore service (started with
+    "datastore-util serve") over its Unix socket, keeping the connection open
+    between calls.
+    """
+
+    def __init__(self, socket_path=local_socket_file):
+        self.socket_path = os.path.expanduser(socket_path)
+        self._file = None
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self.socket_path)
+        except socket.error as e:
+            sock.close()
+            raise DatastoreError('Could not connect to datastore service at {0}: {1}'.format(self.socket_path, e))
+        self._file = sock.makefile('rwb')
+        sock.close()
+
+    def close(self):
+        """Close the connection to the service
+        """
+        if self._file:
+            self._file.close()
+            self._file = None
+
+    def call(self, method, **params):
+        """Call an operation of the service
+
+        :param method: name of the operation
+        :param params: the operation's arguments
+        :returns: the result of the operation
+        """
+        request = json.dumps(dict(id=next(self._ids), method=method, params=params)) + '\n'
+        with self._lock:
+            # A connection left over from a service since restarted is
+            # re-established once
+            for attempt in (1, 2):
+                if not self._file:
+                    self._connect()
+                try:
+                    self._file.write(request)
+                    self._file.flush()
+                    line = self._file.readline()
+                except socket.error:
+                    line = None
+                if line:
+                    break
+                self.close()
+        if not line:
+            raise DatastoreError('Connection to datastore service at {0} closed'.format(self.socket_path))
+        response = json.loads(line)
+        if 'error' in response:
+            raise DatastoreError(response['error']['message'])
+        return response['result']
+
+
 class Datastore:
     """Represents Datastore. 
     Attempts to connect to datastore-util on initialisation. Throws DatastoreError if unable to do so.
+
+    How calls are made depends on the backend:
+
+    * 'auto' (the default): in this process if the bdkd.datastore package is
+      installed (see InProcessBackend), otherwise by running datastore-util
+    * 'cli': by running datastore-util for every call
+    * a backend object, such as an InProcessBackend or SocketBackend
     """
 
     def _run_with_args(self, arg_list):
@@ -70,9 +163,29 @@ class Datastore:
 
         return out, err
 
-    def __init__(self):
+    def _call(self, error, method, **params):
+        try:
+            return self._backend.call(method, **params)
+        except DatastoreError as e:
+            raise DatastoreError('{0}: {1}'.format(error, e))
+
+    def __init__(self, backend='auto'):
         """Init Datastore object
+
+        :param backend: 'auto', 'cli' or an object making calls to the datastore
         """
+        if backend == 'auto':
+            try:
+                backend = InProcessBackend()
+            except ImportError:
+                backend = None
+        elif backend == 'cli':
+            backend = None
+        self._backend = backend
+        if backend:
+            if not self._call('Unable to obtain repositories', 'repositories'):
+                raise DatastoreError('No repositories configured')
+            return
 
         # Check if installed and ready
         try:
@@ -89,11 +202,14 @@ class Datastore:
         """Get list of configured Datastore repositories
         :returns: list of strings of datastore repository names
         """
+        if self._backend:
+            return self._call('Unable to obtain repositories', 'repositories')
+
         out, err = self._run_with_args(['repositories'])
         if err:
             raise DatastoreError('Unable to obtain repositories: {0}'.format(err))
 
-        return out.strip().split('\n')
+        return out.splitlines()
 
     def list(self, repository):
         """Lists contents of given Datastore repository
@@ -104,12 +220,16 @@ class Datastore:
         if not repository:
             raise ValueError('Must specify a valid repository')
 
+        if self._backend:
+            return self._call('Unable to list contents of repository "{0}"'.format(repository),
+                              'list', repository=repository)
+
         out, err = self._run_with_args(['list', repository])
 
         if err:
             raise DatastoreError('Unable to list contents of repository "{0}": {1}'.format(repository, err))
 
-        return out.strip().split('\n')
+        return out.splitlines()
 
     def _validate_repository_and_dataset(self, repository, dataset):
         if not repository:
@@ -126,6 +246,10 @@ class Datastore:
         """
         self._validate_repository_and_dataset(repository, dataset)
 
+        if self._backend:
+            return self._call('Unable to get information on dataset "{0}"'.format(dataset),
+                              'get', repository=repository, resource=dataset)
+
         out, err = self._run_with_args(['get', repository, dataset])
 
         if err:
@@ -148,12 +272,16 @@ class Datastore:
         """
         self._validate_repository_and_dataset(repository, dataset)
 
+        if self._backend:
+            return self._call('Unable to get local file list', 'files',
+                              repository=repository, resource=dataset)
+
         out, err = self._run_with_args(['files', repository, dataset])
 
         if err:
             raise DatastoreError('Unable to get local file list: {0}'.format(err))
 
-        return out.strip().split('\n')
+        return out.splitlines()
 
     def create(self, repository, dataset, metadata = {}, metadata_file = '', filenames = [], publish = False, force = False):
         """Creates a dataset on a given repository
@@ -174,6 +302,12 @@ class Datastore:
         if publish and not (metadata or metadata_file):
             raise ValueError('"metadata" or "metadata_file" parameters required when creating a published dataset')
 
+        if self._backend:
+            return self._call('Unable to create dataset "{0}"'.format(dataset), 'create',
+                              repository=repository, resource=dataset, metadata=metadata,
+                              metadata_file=metadata_file or None, filenames=filenames,
+                              publish=publish, force=force)
+
         cmd = ['create']
 
         if metadata:
@@ -216,6 +350,10 @@ class Datastore:
         """
         self._validate_repository_and_dataset(repository, dataset)
 
+        if self._backend:
+            return self._call('Unable to delete', 'delete', repository=repository,
+                              resource=dataset, force=force)
+
         cmd = ['delete']
         if force:
             cmd.append('--force-delete-published')
@@ -240,6 +378,9 @@ class Datastore:
         """
         self._validate_repository_and_dataset(repository, dataset)
 
+        if self._backend:
+            return self._call('Unable to publish', 'publish', repository=repository, resource=dataset)
+
         cmd = ['publish', repository, dataset]
 
         out, err = self._run_with_args(cmd)
@@ -259,6 +400,9 @@ class Datastore:
         """
         self._validate_repository_and_dataset(repository, dataset)
 
+        if self._backend:
+            return self._call('Unable to unpublish', 'unpublish', repository=repository, resource=dataset)
+
         cmd = ['unpublish', repository, dataset]
 
         out, err = self._run_with_args(cmd)
@@ -278,6 +422,11 @@ class Datastore:
         """
         self._validate_repository_and_dataset(repository, dataset)
 
+        if self._backend:
+            self._call('Unable to rebuild file list ', 'rebuild_file_list',
+                       repository=repository, resource=dataset)
+            return True
+
         cmd = ['rebuild-file-list', repository, dataset]
 
         out, err = self._run_with_args(cmd)
@@ -299,6 +448,11 @@ class Datastore:
         """
         self._validate_repository_and_dataset(repository, dataset)
 
+        if self._backend:
+            return self._call('Unable to update metadata ', 'update_metadata',
+                              repository=repository, resource=dataset, metadata=metadata,
+                              metadata_file=metadata_file or None)
+
         cmd = ['update-metadata']
 
         if metadata:
@@ -336,6 +490,12 @@ class Datastore:
         if type(filenames) != list:
             raise ValueError('"filenames" parameter is not a list')
 
+        if self._backend:
+            return self._call('Unable add files', 'add_files', repository=repository,
+                              resource=dataset, filenames=filenames,
+                              add_to_published=add_to_published, overwrite=overwrite,
+                              no_metadata=no_metadata)
+
         cmd = ['add-files']
         
         if add_to_published:
@@ -371,6 +531,10 @@ class Datastore:
         """
         self._validate_repository_and_dataset(repository, dataset)
 
+        if self._backend:
+            return self._call('Unable to get the list of files', 'get_file_list',
+                              repository=repository, resource=dataset, contains=contains)
+
         cmd = ['get-file-list']
 
         if contains:
@@ -384,4 +548,4 @@ class Datastore:
         if err:
             raise DatastoreError('Unable to get the list of files: {0}'.format(err))
 
-        return out.strip().split('\n')
+        return out.splitlines()
@@ -0,0 +1,126 @@
+# Copyright 2015 Nicta
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+import os
+import shutil
+import stat
+import sys
+import tempfile
+import threading
+# Load the datastore's configuration for unit testing
+DATASTORE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+        '..', '..', '..', 'datastore')
+os.environ['BDKD_DATASTORE_CONFIG'] = os.path.join(DATASTORE,
+        'tests', 'unit', 'conf', 'test.conf')
+import bdkd.datastore
+from bdkd.datastore.util import service
+import datastorewrapper
+
+FIXTURE = os.path.join(DATASTORE, 'tests', 'fixtures', 'FeatureCollections',
+        'Coastlines', 'Seton_etal_ESR2012_Coastlines_2012.1.gpmlz')
+METADATA = {'description': 'Coastlines', 'author': 'Fred',
+        'author-email': 'fred@up.com'}
+
+
+def _types(value):
+    # The types making up a result, counting str and unicode as one
+    if isinstance(value, basestring):
+        return basestring
+    if isinstance(value, dict):
+        return dict((key, _types(item)) for key, item in value.items())
+    if isinstance(value, list):
+        return [_types(item) for item in value]
+    return type(value)
+
+
+class BackendsTest(unittest.TestCase):
+    """
+    Every backend returns the same results as running datastore-util.
+    """
+
+    def setUp(self):
+        self.repository = bdkd.datastore.repository('test-repository')
+        if os.path.exists(self.repository.local_cache):
+            shutil.rmtree(self.repository.local_cache)
+        self.tmp = tempfile.mkdtemp()
+        # A datastore-util running this package's bdkd.datastore
+        util_path = os.path.join(self.tmp, datastorewrapper.util_name)
+        with open(util_path, 'w') as util_file:
+            util_file.write('#!/bin/sh\nexec "{0}" -c "from bdkd.datastore.util.'
+                    'ds_util import ds_util; ds_util()" "$@"\n'.format(sys.executable))
+        os.chmod(util_path, stat.S_IRWXU)
+        self.environ = dict(os.environ)
+        os.environ['PATH'] = os.pathsep.join([self.tmp, os.environ['PATH']])
+        os.environ['PYTHONPATH'] = os.pathsep.join(sys.path)
+        self.server = service.ServiceServer(os.path.join(self.tmp, 'service.sock'),
+                service.DatastoreService())
+        self.server_thread = threading.Thread(target=self.server.serve)
+        self.server_thread.start()
+        self.socket_backend = datastorewrapper.SocketBackend(self.server.socket_path)
+
+    def tearDown(self):
+        self.socket_backend.close()
+        self.server.shutdown()
+        self.server_thread.join()
+        os.environ.clear()
+        os.environ.update(self.environ)
+        shutil.rmtree(self.tmp)
+
+    def _results(self, datastore):
+        # The results of a sequence of calls, from an empty repository
+        results = dict(repositories=datastore.get_repositories(),
+                empty=datastore.list('test-repository'),
+                create=datastore.create('test-repository', 'wrapped',
+                    metadata=METADATA, filenames=[FIXTURE]),
+                list=datastore.list('test-repository'),
+                publish=datastore.publish('test-repository', 'wrapped'),
+                republish=datastore.publish('test-repository', 'wrapped'),
+                files=datastore.files('test-repository', 'wrapped'),
+                delete=datastore.delete('test-repository', 'wrapped', force=True),
+                deleted=datastore.list('test-repository'))
+        return results
+
+    def test_same_results(self):
+        backends = dict(cli='cli', in_process=datastorewrapper.InProcessBackend(),
+                socket=self.socket_backend)
+        results = dict((name, self._results(datastorewrapper.Datastore(backend)))
+                for name, backend in backends.items())
+        cli_results = results.pop('cli')
+        self.assertEquals(cli_results['empty'], [])
+        self.assertEquals(cli_results['list'], ['wrapped'])
+        self.assertEquals(cli_results['deleted'], [])
+        for name, backend_results in results.items():
+            self.assertEquals(backend_results, cli_results, name)
+            self.assertEquals(_types(backend_results), _types(cli_results), name)
+
+    def test_same_details(self):
+        datastore = datastorewrapper.Datastore('cli')
+        datastore.create('test-repository', 'wrapped', metadata=METADATA,
+                filenames=[FIXTURE])
+        cli_details = datastore.get('test-repository', 'wrapped')
+        self.assertEquals(cli_details['name'], 'wrapped')
+        for backend in (datastorewrapper.InProcessBackend(), self.socket_backend):
+            details = datastorewrapper.Datastore(backend).get('test-repository',
+                    'wrapped')
+            self.assertEquals(details, cli_details)
+            self.assertEquals(_types(details), _types(cli_details))
+
+    def test_auto(self):
+        self.assertTrue(isinstance(datastorewrapper.Datastore()._backend,
+            datastorewrapper.InProcessBackend))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,286 @@
+#!/usr/bin/env python
+# Copyright 2015 Nicta
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Benchmarks of the datastore core against an in-process stand-in for S3: a
+MemoryHost (or a LocalHost, to include the cost of the local filesystem).
+
+Each shape of synthetic Resource is saved, listed, refreshed (with a cold
+and with a warm cache), rebuilt and its manifest serialised and parsed.  The
+time taken, throughput and requests made are reported, and compared with a
+stored baseline: any increase in the requests made is a regression (and
+fails the run), as is a slowdown beyond a tolerance (which fails the run
+only with --strict, timings being specific to a machine).
+
+Full-size shapes are large (10 files of 10 GB; 100,000 files of 10 KB), so
+by default the sizes of large files and the numbers of many files are scaled
+down: see --size-scale and --count-scale.
+"""
+
+import argparse
+import collections
+import json
+import os
+import posixpath
+import shutil
+import sys
+import tempfile
+import time
+
+import bdkd.datastore
+
+KB = 1024
+MB = 1024 * KB
+GB = 1024 * MB
+
+Shape = collections.namedtuple('Shape', 'resources files size depth')
+
+SHAPES = collections.OrderedDict([
+    ('large-files', Shape(resources=1, files=10, size=10 * GB, depth=0)),
+    ('many-small-files', Shape(resources=1, files=100000, size=10 * KB, depth=0)),
+    ('deep-prefixes', Shape(resources=100, files=10, size=1 * KB, depth=16)),
+    ])
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+        'baseline.json')
+
+
+def scaled(shape, size_scale, count_scale):
+    """
+    A shape with sizes of at least 1 MB scaled by 'size_scale', and counts
+    of at least 1000 scaled by 'count_scale'.
+    """
+    def scale(value, factor, threshold):
+        return max(1, int(value * factor)) if value >= threshold else value
+    return Shape(resources=scale(shape.resources, count_scale, 1000),
+            files=scale(shape.files, count_scale, 1000),
+            size=scale(shape.size, size_scale, MB),
+            depth=shape.depth)
+
+
+def _resource_names(shape_name, shape):
+    prefix = '/'.join('level{0}'.format(level) for level in range(shape.depth))
+    return [posixpath.join(prefix, '{0}-{1}'.format(shape_name, index))
+            for index in range(shape.resources)]
+
+
+def _write_files(path, shape):
+    # Synthetic files of the shape (distinct contents, in blocks of up to 1 MB)
+    os.makedirs(path)
+    paths = []
+    for index in range(shape.files):
+        file_path = os.path.join(path, 'file-{0:06d}.dat'.format(index))
+        block = ('{0:08d}'.format(index) * (MB // 8))[:min(shape.size, MB)]
+        with open(file_path, 'wb') as fh:
+            remaining = shape.size
+            while remaining > 0:
+                fh.write(block[:remaining])
+                remaining -= len(block)
+        paths.append(file_path)
+    return paths
+
+
+class Benchmark(object):
+    """
+    Runs the operations of a shape against a fresh Repository, recording the
+    time taken and requests made by each, and its throughput in items (files,
+    or Resources listed) and bytes per second.
+    """
+    def __init__(self, work_path, backend='memory'):
+        self.work_path = work_path
+        if backend == 'local':
+            self.host = bdkd.datastore.LocalHost(os.path.join(work_path, 'store'))
+        else:
+            self.host = bdkd.datastore.MemoryHost()
+        self.results = collections.OrderedDict()
+
+    def _measure(self, key, func, items=0, nbytes=0):
+        self.host.connection.reset_requests()
+        start = time.time()
+        result = func()
+        seconds = time.time() - start
+        self.results[key] = dict(seconds=seconds,
+                requests=dict(self.host.connection.requests),
+                items_per_second=(items / seconds if items and seconds else None),
+                bytes_per_second=(nbytes / seconds if nbytes and seconds else None))
+        return result
+
+    def _repository(self, shape_name):
+        return bdkd.datastore.Repository(self.host, shape_name,
+                cache_path=os.path.join(self.work_path, 'cache'), stale_time=0)
+
+    def _clear_cache(self, repository):
+        if os.path.exists(repository.local_cache):
+            shutil.rmtree(repository.local_cache)
+
+    def run(self, shape_name, shape):
+        repository = self._repository(shape_name)
+        self._clear_cache(repository)
+        paths = _write_files(os.path.join(self.work_path, 'files', shape_name), shape)
+        names = _resource_names(shape_name, shape)
+        total_files = shape.resources * shape.files
+        total_bytes = total_files * shape.size
+        key = shape_name + '/{0}'
+
+        resources = [bdkd.datastore.Resource.new(name, paths, publish=False)
+                for name in names]
+
+        def save():
+            for resource in resources:
+                repository.save(resource)
+        self._measure(key.format('save'), save, total_files, total_bytes)
+
+        listed = self._measure(key.format('list'), repository.list,
+                shape.resources)
+        assert len(listed) == shape.resources
+
+        manifests = self._measure(key.format('manifest-serialise'),
+                lambda: [resource.to_json() for resource in resources],
+                total_files)
+        manifest_path = os.path.join(self.work_path, 'manifest.json')
+
+        def parse():
+            for manifest in manifests:
+                with open(manifest_path, 'w') as fh:
+                    fh.write(manifest)
+                bdkd.datastore.Resource.load(manifest_path)
+        self._measure(key.format('manifest-parse'), parse, total_files)
+
+        def refresh():
+            for name in names:
+                resource = repository.get(name)
+                repository.refresh_resource(resource, refresh_all=True)
+        self._clear_cache(repository)
+        self._measure(key.format('refresh-cold'), refresh, total_files, total_bytes)
+        self._measure(key.format('refresh-warm'), refresh, total_files, total_bytes)
+
+        # Files found in the object store that are not yet in the manifest
+        rebuilt = bdkd.datastore.Resource.new(shape_name + '-rebuild', publish=False)
+        repository.save(rebuilt)
+        bucket = repository.get_bucket()
+        time.sleep(0.01)
+        for index in range(shape.files):
+            key_name = 'files/{0}/file-{1:06d}.dat'.format(rebuilt.name, index)
+            data = 'x' * min(shape.size, KB)
+            bucket.put_object(key_name, data)
+            bucket.put_object(key_name + bdkd.datastore.BDKD_FILE_SUFFIX,
+                    bucket.get_key(key_name).etag.strip('"'))
+        rebuilt = repository.get(rebuilt.name)
+        assert self._measure(key.format('rebuild-file-list'),
+                lambda: repository.rebuild_file_list(rebuilt), shape.files)
+        assert len(rebuilt.files) == shape.files
+
+
+def _format_rate(value, unit):
+    if value is None:
+        return ''
+    for prefix in ['', 'k', 'M', 'G']:
+        if value < 1000:
+            break
+        value /= 1000.0
+    return '{0:.1f} {1}{2}/s'.format(value, prefix, unit)
+
+
+def report(results, out=sys.stdout):
+    out.write('{0:<40} {1:>10} {2:>14} {3:>14}  {4}\n'.format('benchmark',
+        'seconds', 'items', 'bytes', 'requests'))
+    for key, result in results.items():
+        requests = ' '.join('{0}={1}'.format(operation, count) for operation, count
+                in sorted(result['requests'].items()))
+        out.write('{0:<40} {1:>10.3f} {2:>14} {3:>14}  {4}\n'.format(key,
+            result['seconds'], _format_rate(result['items_per_second'], ''),
+            _format_rate(result['bytes_per_second'], 'B'), requests))
+
+
+def compare(results, baseline, tolerance):
+    """
+    Compare results with a baseline, returning two lists of regressions:
+    more requests of any operation, and more than 'tolerance' (a fraction)
+    slower.
+    """
+    more_requests = []
+    slower = []
+    for key, result in results.items():
+        if key not in baseline:
+            continue
+        expected = baseline[key]
+        for operation, count in sorted(result['requests'].items()):
+            if count > expected['requests'].get(operation, 0):
+                more_requests.append('{0}: {1} {2} requests (baseline {3})'.format(
+                    key, count, operation, expected['requests'].get(operation, 0)))
+        if (expected['seconds'] >= 0.01 and
+                result['seconds'] > expected['seconds'] * (1 + tolerance)):
+            slower.append('{0}: {1:.3f} seconds (baseline {2:.3f})'.format(
+                key, result['seconds'], expected['seconds']))
+    return more_requests, slower
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__,
+            formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--shape', action='append', choices=SHAPES.keys(),
+            help='Shape of Resource to benchmark (default all)')
+    parser.add_argument('--size-scale', type=float, default=0.001,
+            help='Scale of the sizes of large (at least 1 MB) files (default 0.001)')
+    parser.add_argument('--count-scale', type=float, default=0.01,
+            help='Scale of large (at least 1000) numbers of files (default 0.01)')
+    parser.add_argument('--backend', choices=['memory', 'local'], default='memory',
+            help='Store objects in memory or in a local directory (default memory)')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE,
+            help='Baseline results to compare with (default benchmarks/baseline.json)')
+    parser.add_argument('--save-baseline', action='store_true', default=False,
+            help='Store the results as the baseline, rather than comparing them')
+    parser.add_argument('--tolerance', type=float, default=0.5,
+            help='Fraction by which a benchmark may be slower than its baseline '
+            '(default 0.5)')
+    parser.add_argument('--strict', action='store_true', default=False,
+            help='Fail if a benchmark is slower than its baseline')
+    args = parser.parse_args(argv)
+
+    params = dict(size_scale=args.size_scale, count_scale=args.count_scale,
+            backend=args.backend)
+    work_path = tempfile.mkdtemp(prefix='bdkd-benchmarks-')
+    try:
+        benchmark = Benchmark(work_path, args.backend)
+        for shape_name in args.shape or SHAPES.keys():
+            benchmark.run(shape_name, scaled(SHAPES[shape_name],
+                args.size_scale, args.count_scale))
+    finally:
+        shutil.rmtree(work_path)
+    report(benchmark.results)
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as fh:
+            json.dump(dict(params=params, results=benchmark.results), fh,
+                    indent=2, separators=(',', ': '), sort_keys=True)
+            fh.write('\n')
+        return 0
+    if not os.path.exists(args.baseline):
+        return 0
+    with open(args.baseline) as fh:
+        baseline = json.load(fh)
+    if baseline.get('params') != params:
+        print >>sys.stderr, "Not comparing with {0}: run with {1}".format(
+                args.baseline, baseline.get('params'))
+        return 0
+    more_requests, slower = compare(benchmark.results, baseline['results'],
+            args.tolerance)
+    for regression in more_requests + slower:
+        print >>sys.stderr, 'Regression: ' + regression
+    return 1 if more_requests or (args.strict and slower) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,1134 @@
+# Copyright 2015 Nicta
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Object stores other than S3 for a Repository: a local directory tree
+(LocalStore), memory (MemoryStore) and a write-back cache on local disk in
+front of another store (TieredStore).
+
+A Repository talks to its storage in the dialect of boto's S3 buckets and
+keys.  An ObjectStore provides the underlying operations (head, ranged read,
+write, list, delete and copy), and StoreConnection, StoreBucket, StoreKey and
+StoreMultiPartUpload present it to a Repository as boto would present S3.
+BucketStore, conversely, presents a boto bucket as an ObjectStore.
+"""
+
+import base64
+import calendar
+import collections
+import email.utils
+import errno
+import hashlib
+import heapq
+import itertools
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+# Objects are copied in blocks of this size
+COPY_BUFFER_SIZE = 1024 * 1024
+# Keys listed per LIST request, as by S3
+LIST_PAGE_SIZE = 1000
+# Suffix of the temporary files of a LocalStore (which are not objects)
+TMP_SUFFIX = '.bdkd-tmp'
+# Prefix of the top-level directories of a LocalStore that are not objects
+RESERVED_PREFIX = '.bdkd-'
+# Objects of at least this size are written to a bucket as multipart uploads
+MULTIPART_THRESHOLD = 64 * 1024 * 1024
+# Number of per-name locks of a TieredStore
+LOCK_STRIPES = 64
+
+
+def _iso_time(timestamp):
+    # Time format of listed keys
+    return time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(timestamp)) + \
+            '.{0:06d}Z'.format(int(timestamp * 1000000) % 1000000)
+
+
+def _rfc_time(timestamp):
+    # Time format of the Last-Modified header
+    return time.strftime('%a, %d %b %Y %H:%M:%S GMT', time.gmtime(timestamp))
+
+
+def _parse_time(value):
+    # Seconds since the epoch of a time in either of the above formats
+    if not value:
+        return None
+    if value[10:11] == 'T':
+        return calendar.timegm(time.strptime(value[:19], '%Y-%m-%dT%H:%M:%S')) + \
+                float('0' + value[19:].rstrip('Z'))
+    return float(email.utils.mktime_tz(email.utils.parsedate_tz(value)))
+
+
+def _copy_range(src_fh, dest_fh, length=None, md5=None):
+    # Copy up to 'length' bytes (default all) from one file object to
+    # another, optionally updating an md5 hash.  Returns the bytes copied.
+    copied = 0
+    while length is None or copied < length:
+        size = COPY_BUFFER_SIZE
+        if length is not None:
+            size = min(size, length - copied)
+        data = src_fh.read(size)
+        if not data:
+            break
+        if md5:
+            md5.update(data)
+        dest_fh.write(data)
+        copied += len(data)
+    return copied
+
+
+def _not_found(name):
+    return IOError(errno.ENOENT, "No such object", name)
+
+
+class ObjectStore(object):
+    """
+    A flat namespace of objects, each with its contents, size, md5sum
+    ('etag'), time of last modification and meta-data.
+
+    Objects are described by dictionaries with 'size', 'etag',
+    'last_modified' (seconds since the epoch) and 'metadata'.
+    """
+    def head(self, name):
+        """ The description of an object, or None if there is no such object. """
+        raise NotImplementedError()
+
+    def read(self, name, fh, start=0, end=None):
+        """
+        Write the contents of an object (optionally only bytes 'start' to
+        'end' inclusive) to a file object.
+        """
+        raise NotImplementedError()
+
+    def write(self, name, fh, metadata=None, etag=None):
+        """
+        Store the contents of a file object as an object, replacing any of
+        the same name.  The etag is the md5sum of the contents unless given.
+        Returns the description of the object.
+        """
+        raise NotImplementedError()
+
+    def list(self, prefix=''):
+        """ (name, description) of each object with a prefix, in name order. """
+        raise NotImplementedError()
+
+    def delete(self, name):
+        """ Delete an object (if it exists). """
+        raise NotImplementedError()
+
+    def flush(self, timeout=None):
+        """
+        Wait until the writes and deletions made so far are all done, or
+        until 'timeout' seconds pass.  Returns whether they are (always, for
+        a store that makes them as they are requested).
+        """
+        return True
+
+    def copy(self, src_store, src_name, name, metadata=None):
+        """
+        Copy an object of this or another store, with its meta-data or the
+        given 'metadata'.
+        """
+        info = src_store.head(src_name)
+        if not info:
+            raise _not_found(src_name)
+        with tempfile.TemporaryFile() as fh:
+            src_store.read(src_name, fh)
+            fh.seek(0)
+            return self.write(name, fh, info['metadata'] if metadata is None
+                    else metadata, info['etag'])
+
+
+class MemoryStore(ObjectStore):
+    """
+    Objects held in memory, for the lifetime of the process.
+    """
+    def __init__(self):
+        self._objects = {}
+        self._lock = threading.Lock()
+
+    def head(self, name):
+        with self._lock:
+            obj = self._objects.get(name)
+        return obj and dict(obj[1])
+
+    def read(self, name, fh, start=0, end=None):
+        with self._lock:
+            obj = self._objects.get(name)
+        if not obj:
+            raise _not_found(name)
+        fh.write(obj[0][start:(end + 1 if end is not None else None)])
+
+    def write(self, name, fh, metadata=None, etag=None):
+        data = fh.read()
+        info = dict(size=len(data), etag=etag or hashlib.md5(data).hexdigest(),
+                last_modified=time.time(), metadata=dict(metadata or {}))
+        with self._lock:
+            self._objects[name] = (data, info)
+        return dict(info)
+
+    def list(self, prefix=''):
+        with self._lock:
+            return [(name, dict(obj[1])) for name, obj in
+                    sorted((name, obj) for name, obj in self._objects.items()
+                        if name.startswith(prefix))]
+
+    def delete(self, name):
+        with self._lock:
+            self._objects.pop(name, None)
+
+
+class LocalStore(ObjectStore):
+    """
+    Objects stored as files in a directory tree (e.g. on a parallel
+    filesystem), named by their paths relative to the 'root'.
+
+    The md5sum and meta-data of each object are kept in a JSON file under
+    the '.bdkd-meta' directory of the root.  Files placed in the tree by
+    other means are objects too: their md5sum is calculated when first
+    needed (and again whenever the file changes).  Top-level directories
+    whose names start with '.bdkd-' are reserved, and are not objects.
+    """
+    meta_dir = RESERVED_PREFIX + 'meta'
+
+    def __init__(self, root):
+        self.root = os.path.abspath(os.path.expanduser(root))
+
+    def _path(self, name, base=None):
+        parts = name.split('/')
+        if not name or name.startswith('/') or '..' in parts or \
+                (base is None and parts[0].startswith(RESERVED_PREFIX)):
+            raise ValueError("Invalid object name '{0}'".format(name))
+        return os.path.join(base or self.root, *parts)
+
+    def _meta_path(self, name):
+        return self._path(name, os.path.join(self.root, type(self).meta_dir)) + '.json'
+
+    def _describe(self, name, path, stat_result):
+        # The description of the object at a path, from its meta-data file if
+        # that is up to date with the file, otherwise calculating its md5sum
+        meta_path = self._meta_path(name)
+        try:
+            with open(meta_path) as fh:
+                meta = json.load(fh)
+            if meta['size'] == stat_result.st_size and meta['mtime'] == stat_result.st_mtime:
+                return dict(size=meta['size'], etag=meta['etag'],
+                        last_modified=stat_result.st_mtime, metadata=meta['metadata'])
+        except (IOError, ValueError, KeyError):
+            pass
+        md5 = hashlib.md5()
+        with open(path, 'rb') as fh:
+            for chunk in iter(lambda: fh.read(COPY_BUFFER_SIZE), b''):
+                md5.update(chunk)
+        return self._record(name, path, md5.hexdigest(), {})
+
+    def _record(self, name, path, etag, metadata):
+        # Record the md5sum and meta-data of the file at a path
+        stat_result = os.stat(path)
+        meta_path = self._meta_path(name)
+        try:
+            _mkdir_p(os.path.dirname(meta_path))
+            tmp_path = '{0}.{1}{2}'.format(meta_path, _unique(), TMP_SUFFIX)
+            with open(tmp_path, 'w') as fh:
+                json.dump(dict(size=stat_result.st_size, mtime=stat_result.st_mtime,
+                    etag=etag, metadata=metadata), fh)
+            os.rename(tmp_path, meta_path)
+        except (IOError, OSError):
+            # E.g. a read-only tree: the md5sum is calculated again next time
+            pass
+        return dict(size=stat_result.st_size, etag=etag,
+                last_modified=stat_result.st_mtime, metadata=metadata)
+
+    def head(self, name):
+        path = self._path(name)
+        try:
+            stat_result = os.stat(path)
+        except OSError:
+            return None
+        if not os.path.isfile(path):
+            return None
+        return self._describe(name, path, stat_result)
+
+    def read(self, name, fh, start=0, end=None):
+        try:
+            with open(self._path(name), 'rb') as src_fh:
+                src_fh.seek(start)
+                _copy_range(src_fh, fh, None if end is None else end + 1 - start)
+        except IOError, e:
+            if e.errno == errno.ENOENT:
+                raise _not_found(name)
+            raise
+
+    def _write_file(self, name, copy_to):
+        # Write an object's file by way of a temporary file, with the given
+        # function copying the contents to a file object
+        path = self._path(name)
+        _mkdir_p(os.path.dirname(path))
+        tmp_path = '{0}.{1}{2}'.format(path, _unique(), TMP_SUFFIX)
+        try:
+            with open(tmp_path, 'wb') as fh:
+                result = copy_to(fh)
+            os.rename(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        return path, result
+
+    def write(self, name, fh, metadata=None, etag=None):
+        md5 = hashlib.md5()
+        path, _ = self._write_file(name, lambda dest_fh: _copy_range(fh, dest_fh,
+            md5=md5))
+        return self._record(name, path, etag or md5.hexdigest(), dict(metadata or {}))
+
+    def list(self, prefix=''):
+        names = []
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            relative = os.path.relpath(dirpath, self.root)
+            base = '' if relative == '.' else '/'.join(relative.split(os.sep)) + '/'
+            # Only directories that may hold names with the prefix are walked
+            dirnames[:] = [dirname for dirname in dirnames
+                    if not (base == '' and dirname.startswith(RESERVED_PREFIX)) and
+                    ((base + dirname + '/').startswith(prefix) or
+                        prefix.startswith(base + dirname + '/'))]
+            for filename in filenames:
+                name = base + filename
+                if name.startswith(prefix) and not filename.endswith(TMP_SUFFIX):
+                    names.append(name)
+        listing = []
+        for name in sorted(names):
+            info = self.head(name)
+            if info:
+                listing.append((name, info))
+        return listing
+
+    def delete(self, name):
+        for path in [self._path(name), self._meta_path(name)]:
+            try:
+                os.remove(path)
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+            # Remove directories left empty, as S3 has no directories
+            directory = os.path.dirname(path)
+            while directory not in (self.root, os.path.dirname(self.root)):
+                try:
+                    os.rmdir(directory)
+                except OSError:
+                    break
+                directory = os.path.dirname(directory)
+
+    def copy(self, src_store, src_name, name, metadata=None):
+        if not isinstance(src_store, LocalStore):
+            return ObjectStore.copy(self, src_store, src_name, name, metadata)
+        info = src_store.head(src_name)
+        if not info:
+            raise _not_found(src_name)
+        src_path = src_store._path(src_name)
+
+        def copy_to(dest_fh):
+            with open(src_path, 'rb') as src_fh:
+                _copy_range(src_fh, dest_fh)
+        path, _ = self._write_file(name, copy_to)
+        return self._record(name, path, info['etag'],
+                info['metadata'] if metadata is None else dict(metadata))
+
+
+_counter = itertools.count()
+
+
+def _unique():
+    # A suffix for temporary files unique to this process and call
+    return '{0}-{1}'.format(os.getpid(), next(_counter))
+
+
+def _mkdir_p(path):
+    try:
+        os.makedirs(path)
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+def _encode(name):
+    return name.encode('utf-8') if isinstance(name, unicode) else name
+
+
+def _remaining_size(fh):
+    # Bytes remaining to be read from a file object, or None if unknown
+    try:
+        return os.fstat(fh.fileno()).st_size - fh.tell()
+    except (AttributeError, IOError, OSError, ValueError):
+        return None
+
+
+class BucketStore(ObjectStore):
+    """
+    The objects of a bucket in the dialect of boto (a S3 Bucket, or a
+    StoreBucket), e.g. as the remote tier of a TieredStore.  Requests are
+    made by way of 'call' (e.g. a Host's RequestThrottle.call), if given.
+
+    Objects of at least 'multipart_threshold' bytes are written as multipart
+    uploads of 'part_size' parts, with their md5sum as their 'md5sum'
+    meta-data (as a Repository writes them).
+    """
+    def __init__(self, bucket, call=None, multipart_threshold=MULTIPART_THRESHOLD,
+            part_size=MULTIPART_THRESHOLD):
+        self.bucket = bucket
+        self.call = call
+        self.multipart_threshold = multipart_threshold
+        self.part_size = part_size
+
+    def _call(self, func, *args, **kwargs):
+        if self.call:
+            return self.call(func, *args, **kwargs)
+        return func(*args, **kwargs)
+
+    @staticmethod
+    def _describe(key):
+        return dict(size=key.size, etag=(key.etag or '').strip('"'),
+                last_modified=_parse_time(key.last_modified),
+                metadata=dict(key.metadata or {}))
+
+    def head(self, name):
+        key = self._call(self.bucket.get_key, name)
+        return key and self._describe(key)
+
+    def read(self, name, fh, start=0, end=None):
+        headers = {}
+        if start or end is not None:
+            headers['Range'] = 'bytes={0}-{1}'.format(start, '' if end is None else end)
+        try:
+            self._call(self.bucket.new_key(name).get_contents_to_file, fh,
+                    headers=headers)
+        except Exception, e:
+            if getattr(e, 'status', None) == 404:
+                raise _not_found(name)
+            raise
+
+    def write(self, name, fh, metadata=None, etag=None):
+        metadata = dict(metadata or {})
+        offset = fh.tell() if hasattr(fh, 'tell') else 0
+        size = _remaining_size(fh)
+        if size is not None and size >= self.multipart_threshold:
+            if etag and '-' not in etag:
+                metadata.setdefault('md5sum', etag)
+            upload = self._call(self.bucket.initiate_multipart_upload, name,
+                    metadata=metadata)
+
+            def upload_part(part_num):
+                # Each attempt reads the part from its start
+                part_offset = (part_num - 1) * self.part_size
+                fh.seek(offset + part_offset)
+                upload.upload_part_from_file(fh, part_num,
+                        size=min(self.part_size, size - part_offset))
+            try:
+                for part_num in range(1, (size + self.part_size - 1) // self.part_size + 1):
+                    self._call(upload_part, part_num)
+                self._call(upload.complete_upload)
+            except:
+                self._call(upload.cancel_upload)
+                raise
+        else:
+            key = self.bucket.new_key(name)
+            for meta_name, value in metadata.items():
+                key.set_metadata(meta_name, value)
+            md5 = etag and '-' not in etag and key.get_md5_from_hexdigest(etag)
+
+            def set_contents_from_file():
+                if hasattr(fh, 'seek'):
+                    fh.seek(offset)
+                key.set_contents_from_file(fh, md5=md5 or None)
+            self._call(set_contents_from_file)
+        return self.head(name)
+
+    def list(self, prefix=''):
+        def list_keys():
+            return list(self.bucket.list(prefix=prefix))
+        return [(key.name, self._describe(key)) for key in self._call(list_keys)]
+
+    def delete(self, name):
+        self._call(self.bucket.delete_key, name)
+
+    def copy(self, src_store, src_name, name, metadata=None):
+        if not isinstance(src_store, BucketStore):
+            return ObjectStore.copy(self, src_store, src_name, name, metadata)
+        self._call(self.bucket.copy_key, name, src_store.bucket.name, src_name,
+                metadata=metadata)
+        return self.head(name)
+
+
+class TieredStore(ObjectStore):
+    """
+    A write-back cache on fast local storage (e.g. NVMe) in front of a
+    'remote' store (e.g. a BucketStore of S3), optionally with a 'shared'
+    tier between them (e.g. a LocalStore on NFS, shared by a site).
+
+    Objects are written to the 'local' LocalStore, and the write returns
+    at once.  Background workers ('flush_workers' threads) then write each
+    object to the remote store (and to the shared tier), and remove it from
+    the local tier: the local tier is thus a durable queue of writes, and
+    objects found in it when a TieredStore is created (e.g. after a crash)
+    are flushed in turn.  A deletion is queued as a file under the
+    '.bdkd-queue' directory of the local tier, and hides the object at once.
+    A flush that fails is retried after 'retry_delay' seconds.
+
+    Objects for which 'is_barrier' (a function of the name) is true, such
+    as the meta-data of a Resource, are flushed only once every object
+    written before them has been, so that readers of the remote store never
+    find one before the objects it refers to.
+
+    A flush that fails is retried after 'retry_delay' seconds (the workers
+    flushing other objects in the meantime), doubling each time, up to
+    'max_attempts' attempts in all; then it is given up (and recorded in
+    'failed'), leaving the object queued on the local tier for the next
+    TieredStore of it.
+
+    An object is read from the local tier if it is there, otherwise from
+    the shared tier if that holds the same version as the remote store,
+    otherwise from the remote store.
+    """
+    queue_dir = RESERVED_PREFIX + 'queue'
+
+    def __init__(self, local, remote, shared=None, flush_workers=2, retry_delay=5.0,
+            max_attempts=5, is_barrier=None):
+        self.local = local
+        self.remote = remote
+        self.shared = shared
+        self.retry_delay = retry_delay
+        self.max_attempts = max_attempts
+        self.is_barrier = is_barrier
+        self.queue_path = os.path.join(local.root, type(self).queue_dir)
+        self.failed = {}
+        self._locks = [threading.Lock() for _ in range(LOCK_STRIPES)]
+        # The order in which each queued name was first queued, and the
+        # queued names that are not barriers, oldest first (with entries for
+        # names since flushed left to be skipped)
+        self._pending = {}
+        self._order = itertools.count()
+        self._writes = []
+        # Barriers waiting for earlier writes to be flushed, oldest first,
+        # and the order of each write given up
+        self._held = []
+        self._failed_orders = {}
+        self._attempts = collections.Counter()
+        # The names ready to be flushed, each with the time before which it
+        # is not (a flush being retried waits without holding up a worker)
+        self._ready = []
+        self._sequence = itertools.count()
+        self._closed = False
+        self._cond = threading.Condition()
+        # Writes and deletions not flushed by an earlier process (in name
+        # order, so that Resources' files precede their meta-data)
+        for name in sorted(set([name for name, info in local.list()]) |
+                self._deletions()):
+            self._enqueue(name)
+        self._workers = []
+        for _ in range(flush_workers):
+            worker = threading.Thread(target=self._flush_worker)
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+
+    def _lock(self, name):
+        # The lock ordering writes and deletions of a name with its flushing
+        return self._locks[hash(name) % len(self._locks)]
+
+    def _deletion_path(self, name):
+        return os.path.join(self.queue_path, hashlib.sha1(_encode(name)).hexdigest())
+
+    def _is_deleted(self, name):
+        return os.path.exists(self._deletion_path(name))
+
+    def _add_deletion(self, name):
+        _mkdir_p(self.queue_path)
+        path = self._deletion_path(name)
+        tmp_path = '{0}.{1}{2}'.format(path, _unique(), TMP_SUFFIX)
+        with open(tmp_path, 'w') as fh:
+            fh.write(_encode(name))
+        os.rename(tmp_path, path)
+
+    def _remove_deletion(self, name):
+        try:
+            os.remove(self._deletion_path(name))
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+
+    def _deletions(self):
+        # The names of the objects whose deletion is queued
+        names = set()
+        try:
+            filenames = os.listdir(self.queue_path)
+        except OSError:
+            return names
+        for filename in filenames:
+            if not filename.endswith(TMP_SUFFIX):
+                try:
+                    with open(os.path.join(self.queue_path, filename)) as fh:
+                        names.add(fh.read().decode('utf-8'))
+                except IOError:
+                    pass
+        return names
+
+    def _is_queued(self, name):
+        return os.path.exists(self.local._path(name)) or self._is_deleted(name)
+
+    def _enqueue(self, name):
+        with self._cond:
+            if name not in self._pending:
+                order = next(self._order)
+                self._pending[name] = order
+                self._attempts.pop(name, None)
+                self.failed.pop(name, None)
+                self._failed_orders.pop(name, None)
+                if not (self.is_barrier and self.is_barrier(name)):
+                    heapq.heappush(self._writes, (order, name))
+                self._schedule(name)
+
+    def _schedule(self, name, delay=0):
+        # Queue a name to be flushed by a worker, no sooner than 'delay'
+        # seconds from now
+        with self._cond:
+            heapq.heappush(self._ready, (time.time() + delay, next(self._sequence), name))
+            self._cond.notify_all()
+
+    def _next_ready(self):
+        # The next name ready to be flushed (waiting until there is one), or
+        # None once the store is closed
+        with self._cond:
+            while not self._closed:
+                wait = None
+                if self._ready:
+                    wait = self._ready[0][0] - time.time()
+                    if wait <= 0:
+                        return heapq.heappop(self._ready)[2]
+                self._cond.wait(wait)
+            return None
+
+    def _oldest_write(self):
+        # The order of the oldest queued name that is not a barrier, if any
+        while self._writes and self._pending.get(self._writes[0][1]) != self._writes[0][0]:
+            heapq.heappop(self._writes)
+        return self._writes[0][0] if self._writes else None
+
+    def _barrier_state(self, name):
+        # Whether a barrier must wait for earlier writes ('hold'), may be
+        # flushed ('flush'), or is given up as an earlier write was ('fail')
+        order = self._pending[name]
+        oldest = self._oldest_write()
+        if oldest is not None and oldest < order:
+            return 'hold'
+        if self._failed_orders and min(self._failed_orders.values()) < order:
+            return 'fail'
+        return 'flush'
+
+    def _give_up(self, name, reason):
+        self.failed[name] = reason
+        if not (self.is_barrier and self.is_barrier(name)):
+            self._failed_orders[name] = self._pending[name]
+        self._done(name)
+
+    def _done(self, name):
+        # A name is no longer queued: barriers it held back may be flushed
+        del self._pending[name]
+        oldest = self._oldest_write()
+        while self._held and (oldest is None or self._held[0][0] < oldest):
+            order, held = heapq.heappop(self._held)
+            if self._barrier_state(held) == 'fail':
+                self._give_up(held, "Not flushed, as a write before it failed")
+            else:
+                self._schedule(held)
+        self._cond.notify_all()
+
+    def _flush_worker(self):
+        while True:
+            name = self._next_ready()
+            if name is None:
+                return
+            with self._cond:
+                # (Deleting a barrier need not wait: it refers to nothing)
+                if self.is_barrier and self.is_barrier(name) and \
+                        os.path.exists(self.local._path(name)):
+                    state = self._barrier_state(name)
+                    if state == 'hold':
+                        heapq.heappush(self._held, (self._pending[name], name))
+                        continue
+                    elif state == 'fail':
+                        self._give_up(name, "Not flushed, as a write before it failed")
+                        continue
+            try:
+                self._flush(name)
+            except Exception, e:
+                with self._cond:
+                    self._attempts[name] += 1
+                    attempts = self._attempts[name]
+                    if attempts >= self.max_attempts:
+                        logger.error("Failed to flush %s after %d attempts: %s",
+                                name, attempts, e)
+                        self._give_up(name, str(e))
+                        continue
+                delay = self.retry_delay * 2 ** (attempts - 1)
+                logger.warning("Failed to flush %s (retrying in %s seconds): %s",
+                        name, delay, e)
+                self._schedule(name, delay)
+                continue
+            with self._cond:
+                if self._is_queued(name):
+                    # Written or deleted again while being flushed
+                    self._schedule(name)
+                else:
+                    self._attempts.pop(name, None)
+                    self._done(name)
+
+    def _flush(self, name):
+        # Write an object from the local tier to the remote store (and the
+        # shared tier), or delete it from them
+        with self._lock(name):
+            info = self.local.head(name)
+            deleted = not info and self._is_deleted(name)
+        if info:
+            try:
+                fh = open(self.local._path(name), 'rb')
+            except IOError, e:
+                if e.errno == errno.ENOENT:
+                    return  # Deleted since
+                raise
+            with fh:
+                self.remote.write(name, fh, info['metadata'], info['etag'])
+                if self.shared:
+                    try:
+                        fh.seek(0)
+                        self.shared.write(name, fh, info['metadata'], info['etag'])
+                    except (IOError, OSError), e:
+                        logger.warning("Failed to write %s to the shared tier: %s",
+                                name, e)
+            with self._lock(name):
+                current = self.local.head(name)
+                if current and (current['etag'], current['metadata']) == \
+                        (info['etag'], info['metadata']):
+                    self.local.delete(name)
+        elif deleted:
+            self.remote.delete(name)
+            if self.shared:
+                try:
+                    self.shared.delete(name)
+                except (IOError, OSError), e:
+                    logger.warning("Failed to delete %s from the shared tier: %s",
+                            name, e)
+            with self._lock(name):
+                self._remove_deletion(name)
+
+    def pending(self):
+        """ The number of objects whose write or deletion is not yet flushed. """
+        with self._cond:
+            return len(self._pending)
+
+    def flush(self, timeout=None):
+        """
+        Wait until no writes or deletions remain to be flushed (or to be
+        retried), or until 'timeout' seconds pass.  Returns whether all were
+        flushed.  Raises IOError if any were given up (they are in 'failed').
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self._cond:
+            while self._pending:
+                wait = 1.0
+                if deadline is not None:
+                    wait = min(wait, deadline - time.time())
+                    if wait <= 0:
+                        return False
+                self._cond.wait(wait)
+            failed = sorted(self.failed.items())
+        if failed:
+            raise IOError("Failed to flush {0}".format(', '.join(
+                '{0} ({1})'.format(name, error) for name, error in failed)))
+        return True
+
+    def close(self):
+        """
+        Stop the flush workers, once they finish the flushes in progress.
+        Writes and deletions not yet flushed stay queued on the local tier,
+        for the next TieredStore of it.
+        """
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        for worker in self._workers:
+            worker.join()
+        self._workers = []
+
+    def head(self, name):
+        with self._lock(name):
+            if self._is_deleted(name):
+                return None
+            info = self.local.head(name)
+        return info or self.remote.head(name)
+
+    def read(self, name, fh, start=0, end=None):
+        if self._is_deleted(name):
+            raise _not_found(name)
+        try:
+            return self.local.read(name, fh, start, end)
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                raise
+        if self.shared:
+            info = self.remote.head(name)
+            if not info:
+                raise _not_found(name)
+            shared_info = self.shared.head(name)
+            if shared_info and shared_info['size'] == info['size'] and \
+                    shared_info['etag'] in (info['etag'], info['metadata'].get('md5sum')):
+                try:
+                    return self.shared.read(name, fh, start, end)
+                except IOError, e:
+                    if e.errno != errno.ENOENT:
+                        raise
+        return self.remote.read(name, fh, start, end)
+
+    def write(self, name, fh, metadata=None, etag=None):
+        with self._lock(name):
+            info = self.local.write(name, fh, metadata, etag)
+            self._remove_deletion(name)
+        self._enqueue(name)
+        return info
+
+    def list(self, prefix=''):
+        # The local tier is listed first, and the remote store last, so that
+        # an object flushed in the meantime is listed by one or the other
+        listing = dict(self.local.list(prefix))
+        deleted = self._deletions()
+        for name, info in self.remote.list(prefix):
+            if name not in listing and name not in deleted:
+                listing[name] = info
+        return sorted(listing.items())
+
+    def delete(self, name):
+        with self._lock(name):
+            self._add_deletion(name)
+            self.local.delete(name)
+        self._enqueue(name)
+
+
+class StoreConnection(object):
+    """
+    A connection to a collection of ObjectStores, one per bucket (created by
+    'store_factory' from the bucket name when first used), in the dialect of
+    a boto S3Connection.
+
+    The requests made are counted by operation (HEAD, GET, PUT, LIST, COPY,
+    DELETE) in 'requests'.
+    """
+    def __init__(self, store_factory):
+        self.store_factory = store_factory
+        self.buckets = {}
+        self.requests = collections.Counter()
+        self._lock = threading.Lock()
+
+    def request(self, operation, count=1):
+        with self._lock:
+            self.requests[operation] += count
+
+    def reset_requests(self):
+        with self._lock:
+            self.requests.clear()
+
+    def get_bucket(self, name, **kwargs):
+        self.request('HEAD')
+        with self._lock:
+            if name not in self.buckets:
+                self.buckets[name] = StoreBucket(self, name, self.store_factory(name))
+            return self.buckets[name]
+
+
+class StoreBucket(object):
+    """
+    A bucket of an ObjectStore, in the dialect of a boto Bucket.
+    """
+    def __init__(self, connection, name, store):
+        self.connection = connection
+        self.name = name
+        self.store = store
+        self._uploads = {}
+
+    def _key(self, key_name, info, listed=False):
+        key = StoreKey(self, key_name)
+        key.size = info['size']
+        key.etag = '"{0}"'.format(info['etag'])
+        key.metadata = dict(info['metadata'])
+        key.last_modified = (_iso_time if listed else _rfc_time)(info['last_modified'])
+        return key
+
+    def put_object(self, key_name, data, metadata=None):
+        """
+        Store an object from a string, without counting a request (e.g. to
+        set up a benchmark).
+        """
+        return self.store.write(key_name, _BytesReader(data), metadata)
+
+    def new_key(self, key_name):
+        return StoreKey(self, key_name)
+
+    def get_key(self, key_name, headers=None, version_id=None):
+        _unsupported(headers=headers, version_id=version_id)
+        self.connection.request('HEAD')
+        info = self.store.head(key_name)
+        return info and self._key(key_name, info)
+
+    def get_all_keys(self, headers=None, prefix='', **params):
+        _unsupported(headers=headers, **params)
+        self.connection.request('LIST')
+        return [self._key(key_name, info, listed=True) for key_name, info in
+                self.store.list(prefix)[:LIST_PAGE_SIZE]]
+
+    def list(self, prefix='', delimiter='', marker='', headers=None,
+            encoding_type=None):
+        _unsupported(delimiter=delimiter, marker=marker, headers=headers,
+                encoding_type=encoding_type)
+        listing = self.store.list(prefix)
+        self.connection.request('LIST', max(1, (len(listing) + LIST_PAGE_SIZE - 1) //
+            LIST_PAGE_SIZE))
+        return iter([self._key(key_name, info, listed=True)
+            for key_name, info in listing])
+
+    def delete_key(self, key_name, headers=None, version_id=None, mfa_token=None):
+        _unsupported(headers=headers, version_id=version_id, mfa_token=mfa_token)
+        self.connection.request('DELETE')
+        self.store.delete(getattr(key_name, 'name', key_name))
+
+    def delete_keys(self, keys, quiet=False, mfa_token=None, headers=None):
+        _unsupported(mfa_token=mfa_token, headers=headers)
+        self.connection.request('DELETE')
+        for key in keys:
+            self.store.delete(getattr(key, 'name', key))
+
+    def copy_key(self, new_key_name, src_bucket_name, src_key_name, metadata=None,
+            src_version_id=None, headers=None):
+        _unsupported(src_version_id=src_version_id, headers=headers)
+        self.connection.request('COPY')
+        src_bucket = self.connection.get_bucket(src_bucket_name)
+        self.store.copy(src_bucket.store, src_key_name, new_key_name, metadata)
+        return self.new_key(new_key_name)
+
+    def initiate_multipart_upload(self, key_name, headers=None, metadata=None):
+        _unsupported(headers=headers)
+        self.connection.request('PUT')
+        upload = StoreMultiPartUpload(self, key_name, metadata)
+        self._uploads[upload.id] = upload
+        return upload
+
+    def get_multipart_upload(self, key_name, upload_id):
+        """
+        A multipart upload initiated earlier in this process, or None (its
+        parts do not outlive the process: see StoreMultiPartUpload).
+        """
+        upload = self._uploads.get(upload_id)
+        if upload and upload.key_name == key_name:
+            return upload
+        return None
+
+    def flush(self, timeout=None):
+        """
+        Wait until the store has made the writes and deletions requested so
+        far: see ObjectStore.flush().
+        """
+        return self.store.flush(timeout)
+
+
+def _unsupported(**kwargs):
+    # Raise for any boto argument given a value that StoreBucket does not
+    # implement, rather than ignore it
+    given = sorted(name for name, value in kwargs.items() if value)
+    if given:
+        raise NotImplementedError("Not supported by an ObjectStore: {0}".format(
+            ', '.join(given)))
+
+
+class _BytesReader(object):
+    # A minimal file object reading from a string
+    def __init__(self, data):
+        self.data = data
+        self.offset = 0
+
+    def read(self, size=-1):
+        end = len(self.data) if size < 0 else self.offset + size
+        data = self.data[self.offset:end]
+        self.offset += len(data)
+        return data
+
+
+class StoreKey(object):
+    """
+    An object of an ObjectStore, in the dialect of a boto Key.
+    """
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+        self.size = 0
+        self.etag = None
+        self.metadata = {}
+        self.last_modified = None
+        self.version_id = None
+
+    @property
+    def key(self):
+        return self.name
+
+    def get_metadata(self, name):
+        return self.metadata.get(name)
+
+    def set_metadata(self, name, value):
+        self.metadata[name] = value
+
+    def get_md5_from_hexdigest(self, md5_hexdigest):
+        return (md5_hexdigest, base64.b64encode(md5_hexdigest.decode('hex')))
+
+    def get_contents_to_file(self, fp, headers=None, cb=None, num_cb=10, **kwargs):
+        self.bucket.connection.request('GET')
+        start, end = 0, None
+        byte_range = (headers or {}).get('Range')
+        if byte_range:
+            start, _, end = byte_range[len('bytes='):].partition('-')
+            start, end = int(start), (int(end) if end else None)
+        writer = _Writer(fp)
+        self.bucket.store.read(self.name, writer, start, end)
+        if cb:
+            cb(writer.size, writer.size)
+
+    def get_contents_as_string(self, headers=None, cb=None, num_cb=10, **kwargs):
+        writer = _Writer()
+        self.get_contents_to_file(writer, headers=headers, cb=cb, num_cb=num_cb)
+        return writer.getvalue()
+
+    def set_contents_from_file(self, fp, headers=None, md5=None, cb=None,
+            num_cb=10, **kwargs):
+        self.bucket.connection.request('PUT')
+        info = self.bucket.store.write(self.name, fp, self.metadata,
+                md5 and md5[0])
+        if cb:
+            cb(info['size'], info['size'])
+
+    def set_contents_from_string(self, data, headers=None, md5=None, cb=None,
+            num_cb=10, **kwargs):
+        self.set_contents_from_file(_BytesReader(data), md5=md5, cb=cb)
+
+    def set_contents_from_filename(self, filename, headers=None, md5=None, cb=None,
+            num_cb=10, **kwargs):
+        with open(filename, 'rb') as fh:
+            self.set_contents_from_file(fh, md5=md5, cb=cb)
+
+    def delete(self):
+        self.bucket.delete_key(self.name)
+
+
+class _Writer(object):
+    # A minimal file object counting what is written to it, and passing it
+    # on to another file object (or else collecting it)
+    def __init__(self, fp=None):
+        self.fp = fp
+        self.chunks = []
+        self.size = 0
+
+    def write(self, data):
+        if self.fp:
+            self.fp.write(data)
+        else:
+            self.chunks.append(data)
+        self.size += len(data)
+
+    def getvalue(self):
+        return ''.join(self.chunks)
+
+
+class StoreMultiPartUpload(object):
+    """
+    A multipart upload to an ObjectStore, in the dialect of a boto
+    MultiPartUpload.  Parts are held in temporary files until the upload is
+    completed, when the object gets an S3-style multipart ETag.
+
+    The parts do not outlive the process, so an upload interrupted with it
+    is started again from the first part by the next one (unlike one to
+    S3).  Its id is unique, so that it is never mistaken for an upload of
+    another process.
+    """
+    def __init__(self, bucket, key_name, metadata=None):
+        self.bucket = bucket
+        self.key_name = key_name
+        self.metadata = metadata or {}
+        self.id = uuid.uuid4().hex
+        self._parts = {}
+        self._lock = threading.Lock()
+
+    def upload_part_from_file(self, fp, part_num, size=None, cb=None, num_cb=10,
+            **kwargs):
+        self.bucket.connection.request('PUT')
+        part = tempfile.TemporaryFile()
+        md5 = hashlib.md5()
+        copied = _copy_range(fp, part, size, md5)
+        with self._lock:
+            old_part = self._parts.get(part_num)
+            self._parts[part_num] = (part, md5.digest())
+        if old_part:
+            old_part[0].close()
+        if cb:
+            cb(copied, copied)
+
+    def copy_part_from_key(self, src_bucket_name, src_key_name, part_num, start=None,
+            end=None, **kwargs):
+        self.bucket.connection.request('COPY')
+        src_store = self.bucket.connection.get_bucket(src_bucket_name).store
+        part = tempfile.TemporaryFile()
+        src_store.read(src_key_name, part, start or 0, end)
+        part.seek(0)
+        md5 = hashlib.md5()
+        for chunk in iter(lambda: part.read(COPY_BUFFER_SIZE), b''):
+            md5.update(chunk)
+        with self._lock:
+            old_part = self._parts.get(part_num)
+            self._parts[part_num] = (part, md5.digest())
+        if old_part:
+            old_part[0].close()
+
+    def complete_upload(self):
+        self.bucket.connection.request('PUT')
+        with self._lock:
+            parts = [self._parts[part_num] for part_num in sorted(self._parts)]
+        etag = '{0}-{1}'.format(hashlib.md5(''.join(digest for part, digest in parts))
+                .hexdigest(), len(parts))
+        with tempfile.TemporaryFile() as fh:
+            for part, digest in parts:
+                part.seek(0)
+                _copy_range(part, fh)
+            fh.seek(0)
+            self.bucket.store.write(self.key_name, fh, self.metadata, etag)
+        self._close()
+        return self.bucket.new_key(self.key_name)
+
+    def cancel_upload(self):
+        self.bucket.connection.request('DELETE')
+        self._close()
+
+    def _close(self):
+        with self._lock:
+            for part, digest in self._parts.values():
+                part.close()
+            self._parts.clear()
+        self.bucket._uploads.pop(self.id, None)
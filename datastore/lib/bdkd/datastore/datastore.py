@@ -14,22 +14,37 @@
 
 #!/usr/bin/env python
 
-import boto.s3.connection
 import io
 import errno
+import fnmatch
 import hashlib
 import json
 import logging
 import os, stat, sys, time, getpass
-from datetime import datetime
+from datetime import datetime, timedelta
 import shutil
 import urlparse, urllib2
-import yaml
 import re
 import warnings
 import copy
 import tarfile
+import zipfile
+import struct
 import posixpath
+import itertools
+import threading
+import Queue
+import random
+import socket
+import httplib
+import mmap
+import zlib
+import atexit
+import collections
+import contextlib
+from multiprocessing.pool import ThreadPool
+
+import backends
 
 import logging
 logging.getLogger('boto').setLevel(logging.CRITICAL)
@@ -39,12 +54,61 @@ _config_user_file = os.path.expanduser(os.environ.get('BDKD_DATASTORE_CONFIG', '
 _settings = None
 _hosts = None
 _repositories = None
+# Identifies the state of the configuration files when last loaded
+_config_stamp = None
+_config_lock = threading.Lock()
+# The TieredHost of each local path, with the configuration it was made from
+_tiered_hosts = {}
+_bandwidth_limiter = None
 
 TIME_FORMAT = '%a, %d %b %Y %H:%M:%S %Z'
 ISO_8601_UTC_FORMAT = '%Y-%m-%dT%H:%M:%S.%fZ'
 
 BDKD_FILE_SUFFIX = '.bdkd'
 
+# Reads of local files being hashed are done in blocks of this size
+HASH_BUFFER_SIZE = 4 * 1024 * 1024
+DEFAULT_HASH_THREADS = 4
+
+BUNDLE_FORMAT_TAR_GZ = 'tar.gz'
+BUNDLE_FORMAT_ZIP = 'zip'
+BUNDLE_FORMATS = [BUNDLE_FORMAT_TAR_GZ, BUNDLE_FORMAT_ZIP]
+
+# Defaults for streaming bundle uploads (S3 requires parts of at least 5 MiB)
+DEFAULT_PART_SIZE = 8 * 1024 * 1024
+# Files at least this large are uploaded in parts, so that an interrupted
+# upload can be resumed
+DEFAULT_MULTIPART_THRESHOLD = 64 * 1024 * 1024
+# Objects larger than S3's limit for a single copy are copied in parts of
+# this size
+MAX_COPY_SIZE = 5 * 1024 * 1024 * 1024
+COPY_PART_SIZE = 1024 * 1024 * 1024
+# Unreferenced blobs younger than this (in seconds) are never collected, as
+# they may belong to a Resource that is still being saved
+DEFAULT_GC_MIN_AGE = 24 * 60 * 60
+DEFAULT_COMPRESS_BLOCK_SIZE = 1024 * 1024
+
+# Ways of placing a saved local file in the Repository's cache
+CACHE_MODE_COPY = 'copy'
+CACHE_MODE_LINK = 'link'
+CACHE_MODE_REFLINK = 'reflink'
+CACHE_MODE_REFERENCE = 'reference'
+CACHE_MODES = [CACHE_MODE_COPY, CACHE_MODE_LINK, CACHE_MODE_REFLINK,
+        CACHE_MODE_REFERENCE]
+
+# Suffix of the cache entry recording a saved file by reference
+REFERENCE_SUFFIX = '.ref'
+
+# ioctl request to clone a file's extents (Linux btrfs, xfs, ocfs2)
+_FICLONE = 0x40049409
+
+# Priorities of transfers: lower values go first.  Interactive (foreground)
+# transfers never wait for others; bulk transfers wait for interactive ones;
+# prefetches wait for both.
+PRIORITY_FOREGROUND = 0
+PRIORITY_BULK = 5
+PRIORITY_PREFETCH = 10
+
 logger = logging.getLogger(__name__)
 
 def get_uid():
@@ -58,17 +122,174 @@ def get_uid():
     except AttributeError:
         return getpass.getuser()
 
-def checksum(local_path):
+def checksum(local_path, buffer_size=HASH_BUFFER_SIZE):
     """ Calculate the md5sum of the contents of a local file. """
     result = None
     if os.path.exists(local_path):
-        md5 = hashlib.md5()
-        with open(local_path,'rb') as f:
-            for chunk in iter(lambda: f.read(1048576), b''):
-                md5.update(chunk)
-        result = md5.hexdigest()
+        with _metrics.timed('checksum_seconds'):
+            md5 = hashlib.md5()
+            with open(local_path,'rb') as f:
+                for chunk in iter(lambda: f.read(buffer_size), b''):
+                    md5.update(chunk)
+                    _metrics.increment('checksum_bytes_total', len(chunk))
+            result = md5.hexdigest()
     return result
 
+def local_file_meta(path, meta):
+    """
+    Fill in the 'md5sum', 'last-modified' and 'content-length' meta-data of a
+    local file, keeping any values already present.  Returns the meta-data.
+    """
+    info = os.stat(path)
+    if not 'md5sum' in meta:
+        meta['md5sum'] = checksum(path)
+    if not 'last-modified' in meta:
+        meta['last-modified'] = time.strftime(TIME_FORMAT,
+                time.gmtime(info.st_mtime))
+    if not 'content-length' in meta:
+        meta['content-length'] = info.st_size
+    return meta
+
+def _local_file_meta_current(path, meta, mtime):
+    # Whether the size recorded in meta-data (as filled in by
+    # local_file_meta()) and the exact modification time 'mtime' (st_mtime
+    # before it was filled in) still describe a local file, in which case its
+    # recorded md5sum can be trusted without reading the file again.  (The
+    # 'last-modified' meta-data is only to the second.)
+    if not meta or not meta.get('md5sum') or mtime is None:
+        return False
+    try:
+        info = os.stat(path)
+    except OSError:
+        return False
+    return meta.get('content-length') == info.st_size and info.st_mtime == mtime
+
+def _new_version():
+    # A new Resource version id: the (UTC) time it was saved, so that ids sort
+    # in order, plus a random part so that concurrent saves differ
+    return '{0}-{1}'.format(datetime.utcnow().strftime('%Y%m%dT%H%M%S%fZ'),
+            os.urandom(4).encode('hex'))
+
+def _reflink(src_path, dest_path):
+    # Create dest_path as a copy-on-write clone of src_path, raising IOError or
+    # OSError if the filesystem does not support it.
+    import fcntl
+    with open(src_path, 'rb') as src:
+        with open(dest_path, 'wb') as dest:
+            try:
+                fcntl.ioctl(dest.fileno(), _FICLONE, src.fileno())
+            except:
+                dest.close()
+                os.remove(dest_path)
+                raise
+    shutil.copystat(src_path, dest_path)
+
+def parallel_imap(func, items, threads, queue_size=None):
+    """
+    Apply a function to each of a sequence of items on a pool of threads.
+
+    This is a generator yielding the results in the order of the items.  Items
+    are taken from the sequence only as threads become free: at most
+    'queue_size' (default twice the number of threads) are in progress or
+    awaiting collection at any time.  An exception raised by the function is
+    re-raised when its result would have been yielded.
+    """
+    if threads <= 1:
+        for item in items:
+            yield func(item)
+        return
+    tasks = Queue.Queue()
+    results = {}
+    results_cond = threading.Condition()
+
+    def work():
+        while True:
+            task = tasks.get()
+            if task is None:
+                return
+            index, item = task
+            try:
+                result = (True, func(item))
+            except Exception:
+                result = (False, sys.exc_info())
+            with results_cond:
+                results[index] = result
+                results_cond.notify_all()
+
+    workers = []
+    for i in range(threads):
+        worker = threading.Thread(target=work)
+        worker.daemon = True
+        worker.start()
+        workers.append(worker)
+    limit = queue_size or threads * 2
+    items = iter(items)
+    submitted = collected = 0
+    exhausted = False
+    try:
+        while True:
+            while not exhausted and submitted - collected < limit:
+                try:
+                    tasks.put((submitted, next(items)))
+                    submitted += 1
+                except StopIteration:
+                    exhausted = True
+            if collected == submitted:
+                break
+            with results_cond:
+                while not collected in results:
+                    results_cond.wait()
+                succeeded, result = results.pop(collected)
+            collected += 1
+            if not succeeded:
+                raise result[0], result[1], result[2]
+            yield result
+    finally:
+        # Wait for the workers to finish, so that none is left running
+        for i in range(threads):
+            tasks.put(None)
+        for worker in workers:
+            worker.join()
+
+def _local_file_meta_item(item):
+    path, meta = item
+    return path, local_file_meta(path, meta)
+
+def hash_files(items, threads=None):
+    """
+    Fill in the meta-data of local files (see local_file_meta) on a pool of
+    threads, given a sequence of (path, meta-data dictionary) pairs.
+
+    This is a generator: the pairs are yielded in their original order as
+    soon as each is done, so that work on earlier files can proceed while
+    later files are still being read.  The number of threads defaults to the
+    'hash_threads' setting.
+    """
+    if threads is None:
+        threads = settings().get('hash_threads', DEFAULT_HASH_THREADS)
+    for item in parallel_imap(_local_file_meta_item, items, threads):
+        yield item
+
+def _with_local_meta(resource_files, threads=None):
+    # Yield ResourceFiles in order, each once any meta-data still to be read
+    # from its local file is filled in (see ResourceFile.local_meta_pending).
+    # The files are read by hash_files a few ahead of the consumer, so that
+    # reading later files overlaps whatever is done with earlier ones (e.g.
+    # uploading them).
+    resource_files = list(resource_files)
+    pending = [resource_file for resource_file in resource_files
+            if resource_file.local_meta_pending]
+    for resource_file in pending:
+        resource_file.local_mtime = os.stat(resource_file.path).st_mtime
+    pending_ids = set(id(resource_file) for resource_file in pending)
+    filled = hash_files(((resource_file.path, resource_file._metadata)
+        for resource_file in pending), threads)
+    for resource_file in resource_files:
+        if id(resource_file) in pending_ids:
+            next(filled)
+            resource_file.local_meta_pending = False
+        yield resource_file
+
 def mkdir_p(dest_dir):
     """ Make a directory, including all parent directories. """
     try:
@@ -123,20 +344,974 @@ def touch(fname, times=None):
     with file(fname, 'a'):
         os.utime(fname, times)
 
+
+def _gzip_block(data, compresslevel):
+    # Compress a block of data as a complete, self-contained gzip member
+    compressor = zlib.compressobj(compresslevel, zlib.DEFLATED,
+            16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+class _ZipBundleWriter(object):
+    """
+    Writes a zip archive to a seekable file object, member by member,
+    indexing each member as it is written: the offset and length of its
+    compressed data plus what is needed to decompress and verify it, and the
+    md5sum, size and modification time of the file it was written from.
+
+    Unlike zipfile, a member may be copied from another archive as its raw
+    compressed data, given its entry in that archive's index.  Archives
+    (and members) over 4 GiB are written with zip64 extensions.
+    """
+    def __init__(self, fileobj, compresslevel=zlib.Z_DEFAULT_COMPRESSION):
+        self.fileobj = fileobj
+        self.compresslevel = compresslevel
+        self.index = {}
+        self._members = []
+
+    @staticmethod
+    def _dos_date_time(mtime):
+        date_time = time.localtime(mtime)
+        if date_time.tm_year < 1980:
+            date_time = time.localtime(time.mktime((1980, 1, 1, 0, 0, 0, 0, 0, -1)))
+        return (((date_time.tm_year - 1980) << 9) | (date_time.tm_mon << 5) |
+                date_time.tm_mday,
+                (date_time.tm_hour << 11) | (date_time.tm_min << 5) |
+                (date_time.tm_sec // 2))
+
+    def _local_header(self, member):
+        # The local file header of a member (as it stands)
+        extra = b''
+        compress_size, file_size = member['length'], member['size']
+        if member['zip64']:
+            extra = struct.pack('<2H2Q', 1, 16, file_size, compress_size)
+            compress_size = file_size = 0xFFFFFFFF
+        return struct.pack('<4s2B4HL2L2H', b'PK\x03\x04', member['version'], 0,
+                member['flags'], member['compression'], member['dos_time'],
+                member['dos_date'], member['crc'], compress_size, file_size,
+                len(member['encoded_name']), len(extra)) + member['encoded_name'] + extra
+
+    def _begin(self, name, info, size, compression):
+        # Start a member, writing a provisional local header
+        encoded_name, flags = name, 0
+        if isinstance(name, unicode):
+            try:
+                encoded_name = name.encode('ascii')
+            except UnicodeEncodeError:
+                encoded_name, flags = name.encode('utf-8'), 0x800
+        zip64 = size * 1.05 >= 0xFFFFFFFF
+        dos_date, dos_time = self._dos_date_time(info.st_mtime)
+        member = dict(name=name, encoded_name=encoded_name, flags=flags,
+                zip64=zip64, version=45 if zip64 else 20, compression=compression,
+                dos_date=dos_date, dos_time=dos_time, crc=0, length=0, size=size,
+                header_offset=self.fileobj.tell(),
+                external_attr=(info.st_mode & 0xFFFF) << 16)
+        header = self._local_header(member)
+        self.fileobj.write(header)
+        member['offset'] = member['header_offset'] + len(header)
+        return member
+
+    def _end(self, member, md5sum, mtime):
+        # Rewrite the local header of a member with its final sizes and CRC
+        end = self.fileobj.tell()
+        self.fileobj.seek(member['header_offset'])
+        self.fileobj.write(self._local_header(member))
+        self.fileobj.seek(end)
+        self._members.append(member)
+        self.index[member['name']] = dict(offset=member['offset'],
+                length=member['length'], size=member['size'],
+                compression=member['compression'], crc=member['crc'],
+                md5sum=md5sum, mtime=mtime)
+
+    def write(self, path, name):
+        """
+        Compress a local file into the archive as the member 'name'.
+        """
+        with open(path, 'rb') as fh:
+            info = os.fstat(fh.fileno())
+            member = self._begin(name, info, info.st_size, zipfile.ZIP_DEFLATED)
+            compressor = zlib.compressobj(self.compresslevel, zlib.DEFLATED,
+                    -zlib.MAX_WBITS)
+            md5, crc, size = hashlib.md5(), 0, 0
+            for chunk in iter(lambda: fh.read(HASH_BUFFER_SIZE), b''):
+                md5.update(chunk)
+                crc = zlib.crc32(chunk, crc)
+                size += len(chunk)
+                data = compressor.compress(chunk)
+                self.fileobj.write(data)
+                member['length'] += len(data)
+            data = compressor.flush()
+            self.fileobj.write(data)
+            member['length'] += len(data)
+        member['crc'], member['size'] = crc & 0xFFFFFFFF, size
+        if size != info.st_size:
+            raise IOError("File {0} changed while being bundled".format(path))
+        self._end(member, md5.hexdigest(), info.st_mtime)
+
+    def copy(self, path, name, source_fh, entry):
+        """
+        Copy the member 'name' from another archive as it is, given its entry
+        in that archive's index and the local file it describes.
+        """
+        info = os.stat(path)
+        member = self._begin(name, info, entry['size'], entry['compression'])
+        member['crc'], member['length'] = entry['crc'], entry['length']
+        source_fh.seek(entry['offset'])
+        remaining = entry['length']
+        while remaining:
+            chunk = source_fh.read(min(remaining, HASH_BUFFER_SIZE))
+            if not chunk:
+                raise IOError("Bundle member {0} is truncated".format(name))
+            self.fileobj.write(chunk)
+            remaining -= len(chunk)
+        self._end(member, entry['md5sum'], info.st_mtime)
+
+    def close(self):
+        """
+        Write the archive's central directory.
+        """
+        directory_offset = self.fileobj.tell()
+        for member in self._members:
+            extra = []
+            compress_size, file_size = member['length'], member['size']
+            header_offset = member['header_offset']
+            if file_size >= 0xFFFFFFFF:
+                extra.append(file_size)
+                file_size = 0xFFFFFFFF
+            if compress_size >= 0xFFFFFFFF:
+                extra.append(compress_size)
+                compress_size = 0xFFFFFFFF
+            if header_offset >= 0xFFFFFFFF:
+                extra.append(header_offset)
+                header_offset = 0xFFFFFFFF
+            extra = (struct.pack('<2H{0}Q'.format(len(extra)), 1, 8 * len(extra),
+                *extra) if extra else b'')
+            version = 45 if extra or member['zip64'] else 20
+            self.fileobj.write(struct.pack('<4s4B4HL2L5H2L', b'PK\x01\x02',
+                version, 3, version, 0, member['flags'], member['compression'],
+                member['dos_time'], member['dos_date'], member['crc'],
+                compress_size, file_size, len(member['encoded_name']), len(extra),
+                0, 0, 0, member['external_attr'], header_offset))
+            self.fileobj.write(member['encoded_name'] + extra)
+        directory_size = self.fileobj.tell() - directory_offset
+        count = len(self._members)
+        if (count >= 0xFFFF or directory_offset >= 0xFFFFFFFF or
+                directory_size >= 0xFFFFFFFF):
+            zip64_offset = self.fileobj.tell()
+            self.fileobj.write(struct.pack('<4sQ2H2L4Q', b'PK\x06\x06', 44, 45,
+                45, 0, 0, count, count, directory_size, directory_offset))
+            self.fileobj.write(struct.pack('<4sLQL', b'PK\x06\x07', 0,
+                zip64_offset, 1))
+        self.fileobj.write(struct.pack('<4s4H2LH', b'PK\x05\x06', 0, 0,
+            min(count, 0xFFFF), min(count, 0xFFFF),
+            min(directory_size, 0xFFFFFFFF), min(directory_offset, 0xFFFFFFFF), 0))
+
+
+def _bundle_member_contents(data, entry):
+    # Decompress and verify the raw data of one indexed bundle member
+    if entry['compression'] == zipfile.ZIP_DEFLATED:
+        data = zlib.decompress(data, -zlib.MAX_WBITS)
+    elif entry['compression'] != zipfile.ZIP_STORED:
+        raise ValueError("Unsupported bundle compression {0}"
+                .format(entry['compression']))
+    if (zlib.crc32(data) & 0xffffffff) != entry['crc']:
+        raise ValueError("Bundle member failed CRC check")
+    return data
+
+
+def _safe_member_path(unpack_path, name):
+    # Destination of an archive member, or None if the member name would
+    # escape the unpack directory
+    dest_path = os.path.normpath(os.path.join(unpack_path, name))
+    if not dest_path.startswith(os.path.normpath(unpack_path) + os.sep):
+        return None
+    return dest_path
+
+
+def _write_member(dest_path, data):
+    # Written to a temporary file renamed into place, so that a file in the
+    # cache that is a hard link (see CACHE_MODE_LINK) is replaced rather than
+    # overwritten, leaving the original it is linked to alone
+    mkdir_p(os.path.dirname(dest_path))
+    with open(dest_path + '.tmp', 'wb') as fh:
+        fh.write(data)
+    os.rename(dest_path + '.tmp', dest_path)
+
+
+def _extract_zip_members(bundle_path, members, threads):
+    # Extract (name, destination path) members of a zip archive in parallel.
+    # Each thread opens its own handle on the archive; all of them are closed
+    # once the extraction is finished.
+    local = threading.local()
+    zip_files = []
+    lock = threading.Lock()
+
+    def extract(member):
+        zip_file = getattr(local, 'zip_file', None)
+        if not zip_file:
+            zip_file = local.zip_file = zipfile.ZipFile(bundle_path)
+            with lock:
+                zip_files.append(zip_file)
+        # (Replacing the destination, as _write_member() does)
+        mkdir_p(os.path.dirname(member[1]))
+        with open(member[1] + '.tmp', 'wb') as fh:
+            source = zip_file.open(member[0])
+            shutil.copyfileobj(source, fh)
+            source.close()
+        os.rename(member[1] + '.tmp', member[1])
+    try:
+        for result in parallel_imap(extract, members, threads):
+            pass
+    finally:
+        for zip_file in zip_files:
+            zip_file.close()
+
+
+def _extract_bundle(bundle_path, unpack_path, bundle_format, threads=4):
+    """
+    Extract all regular files from a bundle, writing members in parallel.
+
+    Members of a zip bundle are decompressed independently on each thread.
+    A tar.gz bundle can only be decompressed in sequence, so its members are
+    read in order and handed to the threads to be written out.  Returns the
+    names of the extracted members.
+    """
+    names = []
+    if bundle_format == BUNDLE_FORMAT_ZIP:
+        zip_file = zipfile.ZipFile(bundle_path)
+        members = []
+        for info in zip_file.infolist():
+            dest_path = _safe_member_path(unpack_path, info.filename)
+            if dest_path and not info.filename.endswith('/'):
+                names.append(info.filename)
+                members.append((info.filename, dest_path))
+        zip_file.close()
+        _extract_zip_members(bundle_path, members, threads)
+    else:
+        def tar_members(bundle_file):
+            for member in bundle_file:
+                dest_path = _safe_member_path(unpack_path, member.name)
+                if dest_path and member.isfile():
+                    names.append(member.name)
+                    yield dest_path, bundle_file.extractfile(member).read()
+        bundle_file = tarfile.open(bundle_path, mode='r|gz')
+        for result in parallel_imap(lambda member: _write_member(*member),
+                tar_members(bundle_file), threads):
+            pass
+        bundle_file.close()
+    return names
+
+
+class ParallelGzipFile(object):
+    """
+    Write-only file object that gzip-compresses its input on several threads.
+
+    In the manner of pigz, input is cut into fixed-size blocks and each block
+    is compressed as a separate gzip member; the members are written to the
+    underlying file object in order.  A concatenation of gzip members is
+    itself a valid gzip stream, readable by the gzip and tarfile modules.
+    """
+    def __init__(self, fileobj, threads=2, compresslevel=9,
+            block_size=DEFAULT_COMPRESS_BLOCK_SIZE):
+        self.fileobj = fileobj
+        self.threads = threads
+        self.compresslevel = compresslevel
+        self.block_size = block_size
+        self._buffer = []
+        self._buffered = 0
+        self._pending = collections.deque()
+        self._pool = ThreadPool(threads)
+        self.closed = False
+
+    def _submit(self, data):
+        self._pending.append(self._pool.apply_async(_gzip_block,
+            (data, self.compresslevel)))
+        # Bound the number of blocks held in memory
+        while len(self._pending) > self.threads * 2:
+            self.fileobj.write(self._pending.popleft().get())
+
+    def write(self, data):
+        self._buffer.append(data)
+        self._buffered += len(data)
+        if self._buffered >= self.block_size:
+            data = b''.join(self._buffer)
+            while len(data) >= self.block_size:
+                self._submit(data[:self.block_size])
+                data = data[self.block_size:]
+            self._buffer = [data]
+            self._buffered = len(data)
+
+    def close(self):
+        """
+        Compress any buffered input and write out all pending blocks.  The
+        underlying file object is not closed.
+        """
+        if self.closed:
+            return
+        if self._buffered or not self._pending:
+            self._submit(b''.join(self._buffer))
+        self._buffer = []
+        self._buffered = 0
+        try:
+            while self._pending:
+                self.fileobj.write(self._pending.popleft().get())
+        finally:
+            self._pool.close()
+            self._pool.join()
+            self.closed = True
+
+
+# The S3 operation of each boto method used by a Repository, by name
+S3_OPERATIONS = {
+        'get_bucket': 'HEAD',
+        'get_key': 'HEAD',
+        'get_contents_as_string': 'GET',
+        'get_contents_to_file': 'GET',
+        '_Repository__download_key': 'GET',
+        'set_contents_from_file': 'PUT',
+        'set_contents_from_filename': 'PUT',
+        'set_contents_from_string': 'PUT',
+        'initiate_multipart_upload': 'PUT',
+        'upload_part': 'PUT',
+        'upload_part_from_file': 'PUT',
+        'complete_upload': 'PUT',
+        'cancel_upload': 'DELETE',
+        'get_all_keys': 'LIST',
+        'list_keys': 'LIST',
+        'copy_key': 'COPY',
+        'copy_part_from_key': 'COPY',
+        'delete': 'DELETE',
+        'delete_key': 'DELETE',
+        'delete_keys': 'DELETE',
+        }
+
+# Upper bounds (in seconds) of the buckets of latency histograms
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+        30, 60)
+
+
+class Metrics(object):
+    """
+    Counters and latency histograms of the work done by this process: S3
+    requests by operation, bytes transferred, cache lookups and checksums.
+
+    Each measurement is labelled (e.g. with the S3 operation), and is passed
+    on as it is made to each of the 'sinks' (such as a StatsdSink).  The
+    totals are kept in memory: see snapshot() and to_prometheus().
+    """
+    def __init__(self, sinks=None, buckets=LATENCY_BUCKETS):
+        self.sinks = list(sinks or [])
+        self.buckets = tuple(buckets)
+        self._counters = {}
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(name, labels):
+        return (name, tuple(sorted(labels.items())))
+
+    def increment(self, name, value=1, **labels):
+        """ Add to a counter. """
+        key = Metrics._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+        for sink in self.sinks:
+            sink.increment(name, value, labels)
+
+    def observe(self, name, value, **labels):
+        """ Record a value (e.g. a duration in seconds) in a histogram. """
+        key = Metrics._key(name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if not histogram:
+                histogram = self._histograms[key] = dict(
+                        buckets=[0] * len(self.buckets), sum=0.0, count=0)
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    histogram['buckets'][index] += 1
+            histogram['sum'] += value
+            histogram['count'] += 1
+        for sink in self.sinks:
+            sink.observe(name, value, labels)
+
+    @contextlib.contextmanager
+    def timed(self, name, **labels):
+        """ Record the duration of a block of code in a histogram. """
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - start, **labels)
+
+    def snapshot(self):
+        """
+        The totals so far, as a dictionary of 'counters' and 'histograms'
+        (lists of dictionaries, each with a 'name' and 'labels').
+        """
+        with self._lock:
+            counters = [dict(name=name, labels=dict(labels), value=value)
+                    for (name, labels), value in sorted(self._counters.items())]
+            histograms = [dict(name=name, labels=dict(labels),
+                buckets=zip(self.buckets, histogram['buckets']),
+                sum=histogram['sum'], count=histogram['count'])
+                for (name, labels), histogram in sorted(self._histograms.items())]
+        return dict(counters=counters, histograms=histograms)
+
+    def to_prometheus(self, prefix='bdkd_datastore_'):
+        """ The totals so far in the Prometheus text exposition format. """
+        def series(name, labels, extra=None):
+            pairs = sorted(labels.items()) + (extra or [])
+            if not pairs:
+                return prefix + name
+            return '{0}{1}{{{2}}}'.format(prefix, name, ','.join(
+                '{0}="{1}"'.format(key, str(value).replace('\\', '\\\\')
+                    .replace('"', '\\"')) for key, value in pairs))
+        snapshot = self.snapshot()
+        lines = []
+        typed = set()
+        for counter in snapshot['counters']:
+            if counter['name'] not in typed:
+                typed.add(counter['name'])
+                lines.append('# TYPE {0}{1} counter'.format(prefix, counter['name']))
+            lines.append('{0} {1}'.format(
+                series(counter['name'], counter['labels']), counter['value']))
+        for histogram in snapshot['histograms']:
+            name = histogram['name']
+            if name not in typed:
+                typed.add(name)
+                lines.append('# TYPE {0}{1} histogram'.format(prefix, name))
+            for bound, count in histogram['buckets'] + [('+Inf', histogram['count'])]:
+                lines.append('{0} {1}'.format(series(name + '_bucket',
+                    histogram['labels'], [('le', bound)]), count))
+            lines.append('{0} {1}'.format(series(name + '_sum',
+                histogram['labels']), histogram['sum']))
+            lines.append('{0} {1}'.format(series(name + '_count',
+                histogram['labels']), histogram['count']))
+        return ''.join(line + '\n' for line in lines)
+
+    def flush(self):
+        """ Have each of the sinks write out what it has buffered. """
+        for sink in self.sinks:
+            try:
+                sink.flush(self)
+            except Exception:
+                logger.warning("Failed to flush metrics to %s", sink, exc_info=True)
+
+    def reset(self):
+        """ Discard the totals so far. """
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+
+
+class MetricsSink(object):
+    """
+    Receives the measurements of a Metrics object: each counter increment
+    and histogram observation as it is made, and a flush() when the process
+    is done (or when asked).
+    """
+    def increment(self, name, value, labels):
+        pass
+
+    def observe(self, name, value, labels):
+        pass
+
+    def flush(self, metrics):
+        pass
+
+
+class StatsdSink(MetricsSink):
+    """
+    Sends each measurement to a statsd daemon over UDP, as it is made:
+    counters as counts and histogram observations (in seconds) as timings in
+    milliseconds.  Label values are appended to the metric name.
+    """
+    def __init__(self, host='localhost', port=8125, prefix='bdkd_datastore'):
+        self.address = (host, int(port))
+        self.prefix = prefix
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def _name(self, name, labels):
+        return '.'.join([self.prefix, name] + [str(labels[key]).replace('.', '_')
+            for key in sorted(labels)])
+
+    def _send(self, line):
+        try:
+            self._socket.sendto(line, self.address)
+        except socket.error:
+            # Metrics are best effort: never fail the request measured
+            pass
+
+    def increment(self, name, value, labels):
+        self._send('{0}:{1}|c'.format(self._name(name, labels), value))
+
+    def observe(self, name, value, labels):
+        self._send('{0}:{1:.3f}|ms'.format(self._name(name, labels), value * 1000))
+
+
+class PrometheusFileSink(MetricsSink):
+    """
+    Writes the totals to a file in the Prometheus text exposition format when
+    flushed (e.g. for the textfile collector of the node exporter).  The file
+    is replaced atomically.
+    """
+    def __init__(self, path):
+        self.path = os.path.expanduser(path)
+
+    def flush(self, metrics):
+        mkdir_p(os.path.dirname(self.path) or '.')
+        tmp_path = '{0}.{1}.tmp'.format(self.path, os.getpid())
+        with open(tmp_path, 'w') as fh:
+            fh.write(metrics.to_prometheus())
+        os.rename(tmp_path, self.path)
+
+
+_metrics = Metrics()
+atexit.register(_metrics.flush)
+
+
+def _no_such_upload(error):
+    # Whether a request failed because its multipart upload no longer exists
+    # (it was completed, aborted or expired)
+    return (getattr(error, 'error_code', None) == 'NoSuchUpload' or
+            getattr(error, 'status', None) == 404)
+
+
+def _s3_operation(func):
+    # The S3 operation of a function making a request
+    return S3_OPERATIONS.get(getattr(func, '__name__', None), 'OTHER')
+
+
+class RequestThrottle(object):
+    """
+    Retry and rate control for the requests made to a S3 host.
+
+    A request that fails with a transient error (a connection error, a 5xx
+    or throttling response, or a request timeout) is retried up to
+    'max_retries' times, each after a random delay of up to
+    'backoff_base' * 2 ** attempt seconds (but no more than 'backoff_max').
+
+    With a 'request_rate' (requests per second), requests are started no
+    faster than that, in bursts of at most 'burst'.  At most
+    'max_concurrency' requests are in flight at once: this limit is halved
+    when the host signals that it is overloaded (503 SlowDown or 429), and
+    grows back by one for each limit's worth of successful requests.
+
+    Each request's latency (including any retries) is recorded in the
+    metrics, by S3 operation, as are its retries and failures.
+    """
+    throttle_statuses = (429, 503)
+
+    def __init__(self, max_retries=5, backoff_base=0.1, backoff_max=20.0,
+            request_rate=None, burst=None, max_concurrency=64):
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.request_rate = request_rate
+        self.burst = burst or max(1, request_rate or 1)
+        self.max_concurrency = max_concurrency
+        self.concurrency = float(max_concurrency)
+        self._in_flight = 0
+        self._last_decrease = 0
+        self._cond = threading.Condition()
+        self._tokens = float(self.burst)
+        self._token_time = time.time()
+        self._token_lock = threading.Lock()
+
+    def _take_token(self):
+        # Wait for the token bucket to hold a token, and take it
+        while True:
+            with self._token_lock:
+                now = time.time()
+                self._tokens = min(self.burst, self._tokens +
+                        (now - self._token_time) * self.request_rate)
+                self._token_time = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.request_rate
+            time.sleep(wait)
+
+    def _acquire(self):
+        with self._cond:
+            while self._in_flight >= int(self.concurrency):
+                self._cond.wait()
+            self._in_flight += 1
+        if self.request_rate:
+            self._take_token()
+
+    def _release(self, throttled):
+        with self._cond:
+            self._in_flight -= 1
+            now = time.time()
+            if throttled:
+                # Halve the limit at most once a second, so that a burst of
+                # throttled responses to the same load counts once
+                if now - self._last_decrease >= 1:
+                    self.concurrency = max(1.0, self.concurrency / 2)
+                    self._last_decrease = now
+                    logger.debug("Host is throttling: at most %d requests at once",
+                            int(self.concurrency))
+            else:
+                self.concurrency = min(float(self.max_concurrency),
+                        self.concurrency + 1.0 / self.concurrency)
+            self._cond.notify_all()
+
+    def is_transient(self, error):
+        """
+        Whether a request that failed with the given error may succeed if
+        tried again.
+        """
+        status = getattr(error, 'status', None)
+        if isinstance(status, int):
+            return (status >= 500 or status in (408, 429) or
+                    getattr(error, 'error_code', None) == 'RequestTimeout')
+        return isinstance(error, (socket.error, httplib.HTTPException))
+
+    def call(self, func, *args, **kwargs):
+        """
+        Make a request by calling a function with the given arguments,
+        retrying it while it fails with a transient error.  Returns the
+        function's result.
+
+        The function is called again as it is, so must be safe to repeat (a
+        partial transfer must pick up where it stopped, or start again).
+        """
+        operation = _s3_operation(func)
+        with _metrics.timed('s3_request_seconds', operation=operation):
+            attempt = 0
+            while True:
+                self._acquire()
+                throttled = False
+                try:
+                    return func(*args, **kwargs)
+                except Exception, e:
+                    throttled = getattr(e, 'status', None) in type(self).throttle_statuses
+                    if attempt >= self.max_retries or not self.is_transient(e):
+                        _metrics.increment('s3_errors_total', operation=operation)
+                        raise
+                    logger.debug("Request failed (%s), retrying", e)
+                    _metrics.increment('s3_retries_total', operation=operation)
+                finally:
+                    self._release(throttled)
+                time.sleep(random.uniform(0, min(self.backoff_max,
+                    self.backoff_base * 2 ** attempt)))
+                attempt += 1
+
+
+class BandwidthLimiter(object):
+    """
+    Token bucket limiting the rate (in bytes per second) of the transfers
+    that draw on it.
+
+    Interactive (foreground) transfers may run up to one second's worth of
+    bytes ahead of the limit, which bulk transfers then wait to repay: so
+    interactive transfers are served first, and the overall rate still keeps
+    to the limit.
+    """
+    def __init__(self, rate):
+        self.rate = float(rate)
+        self._tokens = self.rate
+        self._time = time.time()
+        self._lock = threading.Lock()
+
+    def consume(self, nbytes, priority=PRIORITY_BULK):
+        """
+        Account for 'nbytes' transferred, waiting as long as required to keep
+        to the limit.
+        """
+        floor = 0
+        if priority <= PRIORITY_FOREGROUND:
+            floor = -self.rate
+        with self._lock:
+            now = time.time()
+            self._tokens = min(self.rate, self._tokens + (now - self._time) * self.rate)
+            self._time = now
+            self._tokens -= nbytes
+            deficit = floor - self._tokens
+        if deficit > 0:
+            time.sleep(deficit / self.rate)
+
+
+class TransferJournal(object):
+    """
+    Persistent record of transfers, kept in a directory of a Repository's
+    local cache, so that an interrupted operation can be resumed where it
+    stopped when it is run again.
+
+    Each transfer has its own small JSON entry (named by a hash of the
+    transfer's name), so that concurrent transfers never contend for one
+    file.  Entries are written atomically.
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def _entry_path(self, name):
+        return os.path.join(self.path,
+                hashlib.sha1(name.encode('utf-8')).hexdigest() + '.json')
+
+    def get(self, name):
+        """
+        Get the entry for a transfer, or None.
+        """
+        try:
+            with open(self._entry_path(name)) as fh:
+                entry = json.load(fh)
+        except (IOError, ValueError):
+            return None
+        if entry.get('name') != name:
+            return None
+        return entry
+
+    def put(self, name, entry):
+        """
+        Record the entry (a dictionary) for a transfer.
+        """
+        entry['name'] = name
+        entry_path = self._entry_path(name)
+        tmp_path = '{0}.{1}.{2}.tmp'.format(entry_path, os.getpid(),
+                threading.current_thread().ident)
+        mkdir_p(self.path)
+        with open(tmp_path, 'w') as fh:
+            json.dump(entry, fh)
+        os.rename(tmp_path, entry_path)
+
+    def remove(self, name):
+        """
+        Remove the entry for a transfer, if there is one.
+        """
+        try:
+            os.remove(self._entry_path(name))
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+
+
+class MultipartUploadFile(object):
+    """
+    Write-only file object that streams its input to a S3 multipart upload.
+
+    Input is cut into parts of 'part_size' bytes which are uploaded by
+    background threads while the caller carries on writing: at most
+    'queue_parts' parts are held in memory awaiting upload.  Closing the file
+    completes the upload; abort() cancels it.  The size and md5sum of all
+    that was written are in 'size' and 'md5sum()'.
+    """
+    def __init__(self, multipart_upload, part_size=DEFAULT_PART_SIZE,
+            upload_threads=2, queue_parts=2, throttle=None):
+        self.multipart_upload = multipart_upload
+        self.throttle = throttle or RequestThrottle(max_retries=0)
+        self.part_size = part_size
+        self._buffer = []
+        self._buffered = 0
+        self._part_num = 0
+        self._md5 = hashlib.md5()
+        self.size = 0
+        self._queue = Queue.Queue(maxsize=queue_parts)
+        self._errors = []
+        self._threads = []
+        for i in range(upload_threads):
+            thread = threading.Thread(target=self._upload_parts)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+        self.closed = False
+
+    def _upload_parts(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            part_num, data = item
+            if self._errors:
+                continue
+            def upload_part():
+                # Each attempt reads the part from its start
+                self.multipart_upload.upload_part_from_file(io.BytesIO(data),
+                        part_num=part_num)
+            try:
+                logger.debug("Uploading part %d (%d bytes) of %s", part_num,
+                        len(data), self.multipart_upload.key_name)
+                self.throttle.call(upload_part)
+                _metrics.increment('transfer_bytes_total', len(data),
+                        direction='upload')
+            except Exception, e:
+                self._errors.append(e)
+
+    def _put_part(self, data):
+        if self._errors:
+            raise self._errors[0]
+        self._part_num += 1
+        self._queue.put((self._part_num, data))
+
+    def md5sum(self):
+        return self._md5.hexdigest()
+
+    def write(self, data):
+        self._md5.update(data)
+        self.size += len(data)
+        self._buffer.append(data)
+        self._buffered += len(data)
+        if self._buffered >= self.part_size:
+            data = b''.join(self._buffer)
+            while len(data) >= self.part_size:
+                self._put_part(data[:self.part_size])
+                data = data[self.part_size:]
+            self._buffer = [data]
+            self._buffered = len(data)
+
+    def _finish_threads(self):
+        for thread in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self.closed = True
+
+    def close(self):
+        """
+        Upload any remaining data and complete the multipart upload.
+        """
+        if self.closed:
+            return
+        if self._buffered or not self._part_num:
+            self._put_part(b''.join(self._buffer))
+        self._buffer = []
+        self._finish_threads()
+        if self._errors:
+            self.throttle.call(self.multipart_upload.cancel_upload)
+            raise self._errors[0]
+        self.throttle.call(self.multipart_upload.complete_upload)
+
+    def abort(self):
+        """
+        Cancel the multipart upload, discarding any parts already uploaded.
+        """
+        if not self.closed:
+            self._finish_threads()
+        self.multipart_upload.cancel_upload()
+
 class Host(object):
     """
     A host that provides a S3-compatible service.
+
+    All requests to the host share one RequestThrottle, configured by
+    'max_retries', 'request_rate' (requests per second, default unlimited)
+    and 'max_concurrent_requests'.
     """
     def __init__(   self, access_key=None, secret_key=None,
                     host='s3.amazonaws.com', port=None,
-                    secure=True):
+                    secure=True, max_retries=5, request_rate=None,
+                    max_concurrent_requests=64):
 
-        self.connection = boto.s3.connection.S3Connection(
+        self.__connection_params = dict(
                 aws_access_key_id=access_key,
                 aws_secret_access_key=secret_key,
                 host=host, port=port,
                 is_secure=secure)
+        self.__connection = None
         self.netloc = '{0}:{1}'.format(host,port)
+        self.throttle = RequestThrottle(max_retries=max_retries,
+                request_rate=request_rate,
+                max_concurrency=max_concurrent_requests)
+
+    @property
+    def connection(self):
+        """
+        The S3 connection to this host, created when first used.
+        """
+        if not self.__connection:
+            import boto.s3.connection
+            import s3
+            self.__connection = boto.s3.connection.S3Connection(
+                    bucket_class=s3.S3Bucket, **self.__connection_params)
+        return self.__connection
+
+
+class LocalHost(Host):
+    """
+    A host storing each bucket (Repository) as a directory tree under a
+    local 'path', such as a parallel filesystem: see backends.LocalStore.
+    """
+    def __init__(self, path, max_retries=0, max_concurrent_requests=64):
+        Host.__init__(self, max_retries=max_retries,
+                max_concurrent_requests=max_concurrent_requests)
+        self.path = os.path.abspath(os.path.expanduser(path))
+        self.netloc = 'file://' + self.path
+        self.__connection = backends.StoreConnection(lambda name:
+                backends.LocalStore(os.path.join(self.path, name)))
+
+    @property
+    def connection(self):
+        return self.__connection
+
+
+class MemoryHost(Host):
+    """
+    A host storing its buckets in memory, for the lifetime of the process
+    (e.g. for tests and benchmarks): see backends.MemoryStore.
+    """
+    def __init__(self, max_retries=0, max_concurrent_requests=64):
+        Host.__init__(self, max_retries=max_retries,
+                max_concurrent_requests=max_concurrent_requests)
+        self.netloc = 'memory'
+        self.__connection = backends.StoreConnection(lambda name:
+                backends.MemoryStore())
+
+    @property
+    def connection(self):
+        return self.__connection
+
+
+class TieredHost(Host):
+    """
+    A host writing to a local 'path' (e.g. NVMe) and returning at once, with
+    the writes flushed in the background (by 'flush_workers' threads per
+    bucket) to the buckets of another 'host' (e.g. S3), and reads served
+    from a site-shared tier under 'shared_path' (e.g. NFS) where it holds
+    the same version: see backends.TieredStore.
+
+    The meta-data of a Resource (and of its versions) is flushed only after
+    the files written before it, as a Repository writes them to S3.
+    """
+    def __init__(self, path, host, shared_path=None, flush_workers=2,
+            max_retries=0, max_concurrent_requests=64):
+        Host.__init__(self, max_retries=max_retries,
+                max_concurrent_requests=max_concurrent_requests)
+        self.path = os.path.abspath(os.path.expanduser(path))
+        self.shared_path = shared_path and os.path.abspath(
+                os.path.expanduser(shared_path))
+        self.backing_host = host
+        self.flush_workers = flush_workers
+        self.netloc = host.netloc
+        self.__connection = backends.StoreConnection(self.__store)
+
+    def __store(self, name):
+        call = self.backing_host.throttle.call
+        bucket = call(self.backing_host.connection.get_bucket, name)
+        shared = None
+        if self.shared_path:
+            shared = backends.LocalStore(os.path.join(self.shared_path, name))
+        return backends.TieredStore(backends.LocalStore(os.path.join(self.path, name)),
+                backends.BucketStore(bucket, call=call), shared=shared,
+                flush_workers=self.flush_workers, is_barrier=_is_resource_key)
+
+    @property
+    def connection(self):
+        return self.__connection
+
+    def close(self):
+        """
+        Stop flushing in the background: writes not yet flushed stay queued
+        under 'path', for the next TieredHost of it.
+        """
+        for bucket in self.__connection.buckets.values():
+            bucket.store.close()
+
+
+def _is_resource_key(key_name):
+    # Whether a key holds the meta-data of a Resource, or of a version of one
+    return key_name.startswith((Repository.resources_prefix + '/',
+        Repository.versions_prefix + '/'))
 
 
 class Repository(object):
@@ -150,13 +1325,42 @@ class Repository(object):
     resources_prefix = 'resources'
     files_prefix = 'files'
     bundle_prefix = 'bundle'
+    versions_prefix = 'versions'
+    blobs_prefix = 'blobs'
+    journal_prefix = 'journal'
 
-    def __init__(self, host, name, cache_path=None, stale_time=60):
+    def __init__(self, host, name, cache_path=None, stale_time=60,
+            prefetch_workers=2, stream_bundles=False, compress_threads=1,
+            part_size=DEFAULT_PART_SIZE, unpack_threads=4,
+            upload_threads=4, cache_mode=CACHE_MODE_COPY, download_threads=4,
+            content_addressed=False,
+            multipart_threshold=DEFAULT_MULTIPART_THRESHOLD, bandwidth_limit=None):
         """
         Create a "connection" to a Repository.
+
+        With 'content_addressed', Files saved from then on are stored once
+        per distinct content, as blobs named by their md5sum (see
+        collect_garbage()).  Files already stored by location are unaffected.
+
+        Transfers are recorded in a TransferJournal in the local cache: files
+        of at least 'multipart_threshold' bytes are uploaded in 'part_size'
+        parts, and downloads are written to a '.part' file, so that either
+        can be resumed after an interruption.
+
+        Transfers are limited to 'bandwidth_limit' bytes per second (if
+        given), and to the process-wide 'bandwidth_limit' setting.
+        Interactive transfers (e.g. ResourceFile.local_path()) take
+        precedence over bulk ones (fetching or saving many Files), which in
+        turn take precedence over prefetches.
         """
+        if cache_mode not in CACHE_MODES:
+            raise ValueError("Unknown cache mode '{0}'".format(cache_mode))
         self.host = host
         self.name = name
+        if isinstance(host, Host):
+            self.throttle = host.throttle
+        else:
+            self.throttle = RequestThrottle()
 
         self.local_cache = posixpath.join(
                 (cache_path or settings()['cache_root']),
@@ -164,6 +1368,31 @@ class Repository(object):
                 name)
         self.bucket = None
         self.stale_time = stale_time
+        self.prefetch_workers = prefetch_workers
+        self.stream_bundles = stream_bundles
+        self.compress_threads = compress_threads
+        self.part_size = part_size
+        self.unpack_threads = unpack_threads
+        self.upload_threads = upload_threads
+        self.download_threads = download_threads
+        self.cache_mode = cache_mode
+        self.content_addressed = content_addressed
+        self.multipart_threshold = multipart_threshold
+        self.bandwidth_limiter = None
+        if bandwidth_limit:
+            self.bandwidth_limiter = BandwidthLimiter(bandwidth_limit)
+        self.journal = TransferJournal(posixpath.join(self.local_cache,
+            type(self).journal_prefix))
+        self._etags = {}
+
+        self._prefetch_queue = None
+        self._prefetch_pending = set()
+        self._prefetch_sequence = itertools.count()
+        self._prefetch_lock = threading.Lock()
+        self._foreground_count = 0
+        self._bulk_count = 0
+        self._foreground_cond = threading.Condition()
+        self._path_locks = {}
 
     def get_bucket(self):
         """
@@ -171,12 +1400,74 @@ class Repository(object):
         """
         if self.host and not self.bucket:
             try:
-                self.bucket = self.host.connection.get_bucket(self.name)
+                self.bucket = self._s3_call(self.host.connection.get_bucket,
+                        self.name)
             except: #I want to narrow this down, but the docs are not clear on what can be raised...
                 print >>sys.stderr, 'Error accessing repository "{0}"'.format(self.name)
                 raise
         return self.bucket
 
+    def _s3_call(self, func, *args, **kwargs):
+        """
+        Make a request to the S3 host by calling a function with the given
+        arguments, with the retries and rate control of the host's
+        RequestThrottle.
+        """
+        return self.throttle.call(func, *args, **kwargs)
+
+    def __wait_turn(self, priority):
+        # Wait (holding the foreground condition) until no transfer of a
+        # higher priority is in progress
+        while ((priority > PRIORITY_FOREGROUND and self._foreground_count) or
+                (priority >= PRIORITY_PREFETCH and self._bulk_count)):
+            self._foreground_cond.wait()
+
+    def _begin_transfer(self, priority):
+        """
+        Wait for the turn of a transfer of the given priority, and count it
+        as in progress until _end_transfer().
+        """
+        with self._foreground_cond:
+            self.__wait_turn(priority)
+            if priority <= PRIORITY_FOREGROUND:
+                self._foreground_count += 1
+            elif priority < PRIORITY_PREFETCH:
+                self._bulk_count += 1
+
+    def _end_transfer(self, priority):
+        with self._foreground_cond:
+            if priority <= PRIORITY_FOREGROUND:
+                self._foreground_count -= 1
+            elif priority < PRIORITY_PREFETCH:
+                self._bulk_count -= 1
+            self._foreground_cond.notify_all()
+
+    def __transfer_callback(self, priority):
+        # Keyword arguments for a boto transfer: a progress callback holding
+        # the transfer to the bandwidth limits, if there are any
+        limiters = [limiter for limiter in (self.bandwidth_limiter, _bandwidth_limiter)
+                if limiter]
+        if not limiters:
+            return {}
+        transferred = [0]
+
+        def callback(so_far, total):
+            if so_far < transferred[0]:
+                # The transfer was retried
+                transferred[0] = 0
+            for limiter in limiters:
+                limiter.consume(so_far - transferred[0], priority)
+            transferred[0] = so_far
+        return dict(cb=callback, num_cb=-1)
+
+    def __list(self, prefix):
+        # List the keys with the given prefix (all pages of the listing)
+        bucket = self.get_bucket()
+
+        def list_keys():
+            return list(bucket.list(prefix))
+        return self._s3_call(list_keys)
+
     def __resource_name_key(self, name):
         # For the given Resource name, return the S3 key string
         return posixpath.join(type(self).resources_prefix, name)
@@ -186,10 +1477,29 @@ class Repository(object):
         # local cache file
         return posixpath.join(self.local_cache, type(self).resources_prefix, name)
 
+    def __version_key(self, name, version):
+        # For the given Resource name and version, return the S3 key string of
+        # that version's meta-data
+        return posixpath.join(type(self).versions_prefix, name, version)
+
+    def __version_cache_path(self, name, version):
+        # For the given Resource name and version, return the local path of
+        # that version's meta-data.  (Versions never change once saved.)
+        return posixpath.join(self.local_cache, type(self).versions_prefix,
+                name, version)
+
     def __file_keyname(self, resource_file):
-        # For the given ResourceFile, return the S3 key string
+        # For the given ResourceFile, return the S3 key string: that of its
+        # blob if it is content-addressed, otherwise its location
+        blob = resource_file.meta('blob')
+        if blob:
+            return self.__blob_keyname(blob)
         return resource_file.location()
 
+    def __blob_keyname(self, md5sum):
+        # For the given md5sum, return the S3 key string of its blob
+        return posixpath.join(type(self).blobs_prefix, md5sum)
+
     def __file_cache_path(self, resource_file):
         # For the given ResourceFile, return the path that would be used for a
         # local cache file
@@ -201,7 +1511,8 @@ class Repository(object):
         # comparing the timestamp most recently modified file to that of metadata
         # file
         resource_keyname = self.__resource_name_key(resource.name)
-        resource_key = self.get_bucket().get_all_keys(prefix=resource_keyname)[0]
+        resource_key = self._s3_call(self.get_bucket().get_all_keys,
+                prefix=resource_keyname)[0]
         resource_timestamp = datetime.strptime(resource_key.last_modified, ISO_8601_UTC_FORMAT)
         rebuild_required = False
         for obj in obj_list:
@@ -221,7 +1532,7 @@ class Repository(object):
         if not bucket:
             return False
         prefix = Repository.files_prefix + '/' + resource.name + '/'
-        obj_list = bucket.get_all_keys(prefix=prefix)
+        obj_list = self.__list(prefix)
         if not self._rebuild_required(resource, obj_list):
             logger.debug("Rebuild not required")
             return False
@@ -235,13 +1546,14 @@ class Repository(object):
                 # If this is a .bdkd file, delete (since S3 always returns
                 # values in alphabetical order, we can assume the main
                 # file is already in the list)
-                obj.delete()
+                self._s3_call(obj.delete)
                 continue
 
-            md5file = bucket.get_all_keys(prefix=obj.key + BDKD_FILE_SUFFIX)
+            md5file = self._s3_call(bucket.get_all_keys,
+                    prefix=obj.key + BDKD_FILE_SUFFIX)
 
             if len(md5file) == 1:       # if md5 file exists, this is a newly found file
-                obj_md5 = md5file[0].get_contents_as_string().strip()
+                obj_md5 = self._s3_call(md5file[0].get_contents_as_string).strip()
                 new_files[obj.key] = obj.size, obj.last_modified, obj_md5
 
         resource.add_files_from_storage_paths(new_files)
@@ -249,23 +1561,31 @@ class Repository(object):
 
 
 
-    def __download(self, key_name, dest_path):
+    def __download(self, key_name, dest_path, check_stale=True, version_id=None,
+            priority=PRIORITY_FOREGROUND):
         # Ensure that a file on the local system is up-to-date with respect to
-        # an object in the S3 repository, downloading it if required.  Returns
-        # True if the remote object was downloaded.
+        # an object in the S3 repository (or a particular version of it),
+        # downloading it if required.  Returns True if the remote object was
+        # downloaded.
         bucket = self.get_bucket()
         if not bucket:
             return False
         local_exists = os.path.exists(dest_path)
-        if local_exists and self.stale_time and (time.time() - os.stat(dest_path)[stat.ST_MTIME]) < self.stale_time:
+        if check_stale and local_exists and self.stale_time and (time.time() - os.stat(dest_path)[stat.ST_MTIME]) < self.stale_time:
             logger.debug("Not refreshing %s: not stale", dest_path)
+            _metrics.increment('cache_lookups_total', result='hit')
             return False
-        key = bucket.get_key(key_name)
+        if version_id:
+            key = self._s3_call(bucket.get_key, key_name, version_id=version_id)
+        else:
+            key = self._s3_call(bucket.get_key, key_name)
         if key:
             logger.debug("Key %s exists", key_name)
+            self._etags[dest_path] = key.etag.strip('"')
             if local_exists:
-                if key.etag.strip('"') == checksum(dest_path):
+                if self.__key_md5sum(key) == checksum(dest_path):
                     logger.debug("Checksum match -- no need to refresh")
+                    _metrics.increment('cache_lookups_total', result='revalidated')
                     try:
                         touch(dest_path)
                     except IOError, e:
@@ -279,50 +1599,184 @@ class Repository(object):
                     return False
                 else:
                     logger.debug("Removing destination file %s before overwriting", dest_path)
+                    _metrics.increment('cache_lookups_total', result='stale')
                     os.remove(dest_path)
             else:
+                _metrics.increment('cache_lookups_total', result='miss')
                 mkdir_p(os.path.dirname(dest_path))
-            with open(dest_path, 'wb') as fh:
-                logger.debug("Retrieving repository data to %s", dest_path)
-                key.get_contents_to_file(fh)
+            logger.debug("Retrieving repository data to %s", dest_path)
+            # A retried download resumes from its partial file
+            self._s3_call(self.__download_key, key, dest_path, priority)
             return True
         else:
             logger.debug("Key %s does not exist in repository, not refreshing", key_name)
             return False
 
-    def __upload(self, key_name, src_path, write_bdkd_file=False, md5sum=None):
+    def __key_md5sum(self, key):
+        # The md5sum of an object: its ETag, unless it was uploaded in parts
+        # (when the md5sum is recorded in its meta-data instead)
+        etag = key.etag.strip('"')
+        if '-' in etag:
+            return key.get_metadata('md5sum') or etag
+        return etag
+
+    def __download_key(self, key, dest_path, priority=PRIORITY_FOREGROUND):
+        # Download an object to a local file by way of a partial file, which
+        # is resumed (with a ranged GET) if an earlier download of the same
+        # object was interrupted
+        part_path = dest_path + '.part'
+        journal_name = 'download:' + dest_path
+        etag = key.etag.strip('"')
+        entry = self.journal.get(journal_name)
+        offset = 0
+        if entry and entry.get('etag') == etag and os.path.exists(part_path):
+            offset = os.path.getsize(part_path)
+        else:
+            self.journal.put(journal_name, dict(etag=etag))
+        with open(part_path, 'ab' if offset else 'wb') as fh:
+            if not offset:
+                key.get_contents_to_file(fh, **self.__transfer_callback(priority))
+            elif offset < key.size:
+                logger.debug("Resuming download of %s at byte %d", key.name, offset)
+                key.get_contents_to_file(fh,
+                        headers={'Range': 'bytes={0}-'.format(offset)},
+                        **self.__transfer_callback(priority))
+        _metrics.increment('transfer_bytes_total',
+                os.path.getsize(part_path) - offset, direction='download')
+        if offset:
+            # The bytes resumed from were written by an earlier download: check
+            # the whole file against the object before using it
+            md5sum = self.__key_md5sum(key)
+            if '-' not in md5sum and checksum(part_path) != md5sum:
+                logger.warning("Resumed download of %s does not match its "
+                        "md5sum: downloading it again", key.name)
+                os.remove(part_path)
+                self.journal.remove(journal_name)
+                return self.__download_key(key, dest_path, priority)
+        os.rename(part_path, dest_path)
+        self.journal.remove(journal_name)
+
+    def __upload_parts(self, bucket, key_name, src_path, local_md5sum):
+        # Upload a local file as a multipart upload, recording each part in
+        # the journal as it completes.  An upload of the same file that was
+        # interrupted is resumed from the first part not recorded.  Returns
+        # the version id of the object (if any).
+        journal_name = 'multipart:' + key_name
+        size = os.path.getsize(src_path)
+        entry = self.journal.get(journal_name)
+        multipart_upload = None
+        resumed = False
+        if (entry and entry.get('path') == src_path and entry.get('size') == size
+                and entry.get('md5sum') == local_md5sum):
+            logger.debug("Resuming upload of %s to %s", src_path, key_name)
+            multipart_upload = bucket.get_multipart_upload(key_name,
+                    entry['upload_id'])
+            resumed = bool(multipart_upload)
+        if not multipart_upload:
+            multipart_upload = self._s3_call(bucket.initiate_multipart_upload,
+                    key_name, metadata={'md5sum': local_md5sum})
+            entry = dict(path=src_path, size=size, md5sum=local_md5sum,
+                    upload_id=multipart_upload.id, part_size=self.part_size,
+                    parts=[])
+            self.journal.put(journal_name, entry)
+        part_size = entry['part_size']
+        try:
+            with open(src_path, 'rb') as fh:
+                for part_num in range(1, max(1, (size + part_size - 1) // part_size) + 1):
+                    if part_num in entry['parts']:
+                        continue
+                    offset = (part_num - 1) * part_size
+
+                    def upload_part():
+                        fh.seek(offset)
+                        multipart_upload.upload_part_from_file(fh, part_num,
+                                size=min(part_size, size - offset),
+                                **self.__transfer_callback(PRIORITY_BULK))
+                    self._s3_call(upload_part)
+                    _metrics.increment('transfer_bytes_total',
+                            min(part_size, size - offset), direction='upload')
+                    entry['parts'].append(part_num)
+                    self.journal.put(journal_name, entry)
+            completed = self._s3_call(multipart_upload.complete_upload)
+        except Exception, e:
+            # The host aborts (or expires) uploads that are not completed: one
+            # that is no longer there is started again from the first part
+            if not (resumed and _no_such_upload(e)):
+                raise
+            logger.warning("Upload %s of %s no longer exists: starting again",
+                    entry['upload_id'], key_name)
+            self.journal.remove(journal_name)
+            return self.__upload_parts(bucket, key_name, src_path, local_md5sum)
+        self.journal.remove(journal_name)
+        return getattr(completed, 'version_id', None)
+
+    def __upload(self, key_name, src_path, write_bdkd_file=False, md5sum=None,
+            local_md5sum=None):
         # Ensure that an object in the S3 repository is up-to-date with respect
         # to a file on the local system, uploading it if required.  Returns
-        # True if the local file was uploaded.
+        # the key of the object (or None without a bucket).  A 'local_md5sum' already known
+        # to describe the file saves reading it again to compare with the
+        # object's ETag and to calculate the Content-MD5 of the upload.
         bucket = self.get_bucket()
         if not bucket:
-            return False
+            return None
         do_upload = True
-        file_key = bucket.get_key(key_name)
+        local_md5sum = local_md5sum or checksum(src_path)
+        # An upload completed earlier in an operation that was interrupted
+        # need not be checked again
+        journal_name = 'upload:' + key_name
+        entry = self.journal.get(journal_name)
+        if entry and entry.get('path') == src_path and entry.get('md5sum') == local_md5sum:
+            logger.debug("Local file %s already uploaded", src_path)
+            file_key = bucket.new_key(key_name)
+            file_key.version_id = entry.get('version_id')
+            return file_key
+        file_key = self._s3_call(bucket.get_key, key_name)
         if file_key:
             logger.debug("Existing key %s", key_name)
-            if file_key.etag.strip('"') == checksum(src_path):
+            if self.__key_md5sum(file_key) == local_md5sum:
                 logger.debug("Local file %s unchanged", src_path)
                 do_upload = False
+                if key_name.startswith(posixpath.join(type(self).blobs_prefix, '')):
+                    # A blob re-used by this save is made young again, so
+                    # that garbage collection leaves it until the save is
+                    # done
+                    self.__copy_onto_itself(bucket, key_name,
+                            dict(file_key.metadata), file_key.size)
         else:
             logger.debug("New key %s", key_name)
-            file_key = boto.s3.key.Key(bucket, key_name)
+            file_key = bucket.new_key(key_name)
         if do_upload:
             logger.debug("Uploading to %s from %s", key_name, src_path)
-            file_key.set_contents_from_filename(src_path)
+            self._begin_transfer(PRIORITY_BULK)
+            try:
+                if os.path.getsize(src_path) >= self.multipart_threshold:
+                    file_key.version_id = self.__upload_parts(bucket, key_name,
+                            src_path, local_md5sum)
+                else:
+                    self._s3_call(file_key.set_contents_from_filename, src_path,
+                            md5=file_key.get_md5_from_hexdigest(local_md5sum),
+                            **self.__transfer_callback(PRIORITY_BULK))
+                    _metrics.increment('transfer_bytes_total',
+                            os.path.getsize(src_path), direction='upload')
+            finally:
+                self._end_transfer(PRIORITY_BULK)
             if write_bdkd_file and md5sum:
-                bdkd_file_key = boto.s3.key.Key(bucket, key_name + BDKD_FILE_SUFFIX)
-                bdkd_file_key.set_contents_from_string(md5sum)
+                bdkd_file_key = bucket.new_key(key_name + BDKD_FILE_SUFFIX)
+                self._s3_call(bdkd_file_key.set_contents_from_string, md5sum)
+        version_id = getattr(file_key, 'version_id', None)
+        self.journal.put(journal_name, dict(path=src_path, md5sum=local_md5sum,
+            version_id=version_id if isinstance(version_id, basestring) else None))
 
-        return do_upload
+        return file_key
 
 
     def __delete(self, key_name):
         # Delete the object identified by the key name from the S3 repository
         bucket = self.get_bucket()
         if bucket:
-            key = boto.s3.key.Key(bucket, key_name)
-            bucket.delete_key(key)
+            key = bucket.new_key(key_name)
+            self._s3_call(bucket.delete_key, key)
 
     def __refresh_remote(self, url, local_path, etag=None, mod=stat.S_IRUSR|stat.S_IRGRP|stat.S_IROTH):
         remote = urllib2.urlopen(urllib2.Request(url))
@@ -347,13 +1801,19 @@ class Repository(object):
         return True
 
     def __delete_resource_file(self, resource_file):
-        key_name = self.__file_keyname(resource_file)
+        # (A blob may be shared with other Resources: it is left for
+        # collect_garbage() to delete once it is no longer referenced.)
+        key_name = resource_file.location()
         bucket = self.get_bucket()
-        if bucket and key_name:
+        if bucket and key_name and not resource_file.meta('blob'):
             self.__delete(key_name)
+        if key_name:
+            # Nor is an upload of the file to be taken as done any longer
+            self.journal.remove('upload:' + self.__file_keyname(resource_file))
         cache_path = self.__file_cache_path(resource_file)
-        if os.path.exists(cache_path):
-            os.remove(cache_path)
+        for path in [cache_path, cache_path + REFERENCE_SUFFIX]:
+            if os.path.exists(path):
+                os.remove(path)
 
     def __delete_resource(self, resource):
         for resource_file in (resource.files + [resource.bundle]):
@@ -366,6 +1826,12 @@ class Repository(object):
         cache_path = self.__resource_name_cache_path(resource.name)
         if os.path.exists(cache_path):
             os.remove(cache_path)
+        for version in self.versions(resource.name):
+            if bucket:
+                self.__delete(self.__version_key(resource.name, version))
+            version_path = self.__version_cache_path(resource.name, version)
+            if os.path.exists(version_path):
+                os.remove(version_path)
 
     def __resource_name_conflict(self, resource_name):
         """
@@ -381,7 +1847,7 @@ class Repository(object):
             # Check for conflict with a longer path name
             key_prefix = self.__resource_name_key(resource_name) + '/'
             resource_names = []
-            for key in bucket.list(key_prefix):
+            for key in self.__list(key_prefix):
                 resource_names.append(key.name[(len(type(self).resources_prefix) + 1):])
             if len(resource_names) > 0:
                 # There are other Resources whose names start with this
@@ -392,7 +1858,7 @@ class Repository(object):
             name_parts = resource_name.split('/')[0:-1]
             while len(name_parts):
                 key_name = self.__resource_name_key('/'.join(name_parts))
-                key = bucket.get_key(key_name)
+                key = self._s3_call(bucket.get_key, key_name)
                 if key:
                     return [ key_name ]
                 name_parts = name_parts[0:-1]
@@ -403,101 +1869,528 @@ class Repository(object):
         logger.debug("Cache path for resource file is %s", dest_path)
         return dest_path
 
-    def _refresh_resource_file(self, resource_file):
+    @contextlib.contextmanager
+    def __path_lock(self, dest_path):
+        # Hold the lock serialising refreshes of a single local cache path, so
+        # that a foreground request and a prefetch never write the same file.
+        # A lock is kept only while it is used (counting its users), so that
+        # a long-lived Repository does not keep one for every path read.
+        with self._prefetch_lock:
+            lock_users = self._path_locks.setdefault(dest_path, [threading.Lock(), 0])
+            lock_users[1] += 1
+        try:
+            with lock_users[0]:
+                yield
+        finally:
+            with self._prefetch_lock:
+                lock_users[1] -= 1
+                if not lock_users[1]:
+                    del self._path_locks[dest_path]
+
+    def _refresh_resource_file(self, resource_file, priority=PRIORITY_FOREGROUND):
         dest_path = self._resource_file_dest_path(resource_file)
+        referenced_path = self.__referenced_path(resource_file, dest_path)
+        if referenced_path:
+            resource_file.path = referenced_path
+            return referenced_path
         bucket = self.get_bucket()
         if bucket and not resource_file.is_bundled():
-            location = resource_file.location()
-            if location:
-                if self.__download(location, dest_path):
-                    logger.debug("Refreshed resource file from %s to %s", location, dest_path)
-                else:
-                    logger.debug("Not refreshing resource file %s to %s", location, dest_path)
-            else:
-                self.__refresh_remote(resource_file.remote(), dest_path, resource_file.meta('ETag'))
+            self._begin_transfer(priority)
+            try:
+                with self.__path_lock(dest_path):
+                    location = resource_file.location() and self.__file_keyname(resource_file)
+                    if location and resource_file.resource and resource_file.resource.pinned:
+                        self.__download_pinned(resource_file, dest_path, priority)
+                    elif location:
+                        if self.__download(location, dest_path, priority=priority):
+                            logger.debug("Refreshed resource file from %s to %s", location, dest_path)
+                        else:
+                            logger.debug("Not refreshing resource file %s to %s", location, dest_path)
+                    else:
+                        self.__refresh_remote(resource_file.remote(), dest_path, resource_file.meta('ETag'))
+            finally:
+                self._end_transfer(priority)
             resource_file.path = dest_path
         return dest_path
 
-    def refresh_resource(self, resource, refresh_all=False):
+    def __download_pinned(self, resource_file, dest_path, priority=PRIORITY_FOREGROUND):
+        # Make the cached copy of a File of a pinned Resource match that
+        # version of the Resource.  A cached copy with the recorded md5sum
+        # needs no request at all; otherwise the object version recorded with
+        # the File is fetched (if the repository keeps object versions), or
+        # the current object provided it is still the same.
+        md5sum = resource_file.meta('md5sum')
+        if (md5sum and os.path.exists(dest_path) and
+                self._cached_etag(dest_path) == md5sum):
+            return False
+        downloaded = self.__download(self.__file_keyname(resource_file), dest_path,
+                check_stale=False, version_id=resource_file.meta('version_id'),
+                priority=priority)
+        if self.__unpinned(resource_file, dest_path):
+            raise ValueError("File '{0}' of Resource '{1}' has changed since "
+                    "the version read".format(resource_file.storage_location(),
+                        resource_file.resource.name))
+        return downloaded
+
+    def __write_reference(self, resource_file, cache_path, md5sum=None):
+        # Record a saved file in the cache by reference to its original path,
+        # rather than copying it.  Returns the md5sum of the file.
+        source_path = os.path.abspath(resource_file.path)
+        mtime = os.stat(source_path).st_mtime
+        reference = local_file_meta(source_path,
+                dict(md5sum=md5sum) if md5sum else {})
+        reference['path'] = source_path
+        reference['mtime'] = mtime
+        if os.path.exists(cache_path):
+            os.remove(cache_path)
+        else:
+            mkdir_p(os.path.dirname(cache_path))
+        with open(cache_path + REFERENCE_SUFFIX + '.tmp', 'w') as fh:
+            json.dump(reference, fh)
+        os.rename(cache_path + REFERENCE_SUFFIX + '.tmp',
+                cache_path + REFERENCE_SUFFIX)
+        return reference['md5sum']
+
+    def __referenced_path(self, resource_file, cache_path):
+        # Get the original path of a file recorded in the cache by reference,
+        # provided that it is still fresh: the original is unchanged since it
+        # was saved, it matches the Resource's meta-data and (once stale) the
+        # object in the repository.  A reference that is no longer fresh is
+        # discarded, so that the file is downloaded instead.
+        reference_path = cache_path + REFERENCE_SUFFIX
+        if not os.path.exists(reference_path):
+            return None
+        try:
+            with open(reference_path) as fh:
+                reference = json.load(fh)
+        except ValueError:
+            reference = {}
+        fresh = (reference.get('path') and
+                _local_file_meta_current(reference['path'], reference,
+                    reference.get('mtime')) and
+                resource_file.meta('md5sum') in (None, reference['md5sum']))
+        bucket = self.get_bucket()
+        if (fresh and bucket and resource_file.location() and
+                (time.time() - os.stat(reference_path)[stat.ST_MTIME]) >= self.stale_time):
+            key = self._s3_call(bucket.get_key, self.__file_keyname(resource_file))
+            if key and key.etag.strip('"') != reference['md5sum']:
+                fresh = False
+            else:
+                touch(reference_path)
+        if not fresh:
+            logger.debug("Discarding out of date cache reference %s", reference_path)
+            os.remove(reference_path)
+            if resource_file.path and resource_file.path == reference.get('path'):
+                resource_file.path = cache_path
+            return None
+        return reference['path']
+
+    def _refresh_bundled_file(self, resource_file):
+        """
+        Fetch a single bundled file out of an indexed (zip) bundle, without
+        downloading or unpacking the rest of the bundle.
+
+        The member is read from the cached bundle if there is one, otherwise
+        with a single ranged GET.  Returns the local path of the file, or None
+        if the bundle has no index (e.g. a legacy tar.gz bundle).
+        """
+        bundle = resource_file.resource and resource_file.resource.bundle
+        entry = bundle and bundle.bundle_entry(resource_file.storage_location())
+        if not entry:
+            return None
+        contents = None
+        start, end = entry['offset'], entry['offset'] + entry['length'] - 1
+        bundle_path = self.__file_cache_path(bundle)
+        if os.path.exists(bundle_path):
+            with open(bundle_path, 'rb') as fh:
+                fh.seek(start)
+                try:
+                    contents = _bundle_member_contents(fh.read(entry['length']),
+                            entry)
+                except (ValueError, zlib.error):
+                    logger.debug("Cached bundle %s is out of date", bundle_path)
+        if contents is None:
+            bucket = self.get_bucket()
+            if not bucket:
+                return None
+            data = b''
+            if entry['length']:
+                logger.debug("Fetching bytes %d-%d of bundle %s", start, end,
+                        bundle.location())
+                data = self._s3_call(
+                        bucket.new_key(bundle.location()).get_contents_as_string,
+                        headers={'Range': 'bytes={0}-{1}'.format(start, end)},
+                        **self.__transfer_callback(PRIORITY_FOREGROUND))
+                _metrics.increment('transfer_bytes_total', len(data),
+                        direction='download')
+            contents = _bundle_member_contents(data, entry)
+        dest_path = self._resource_file_dest_path(resource_file)
+        mkdir_p(os.path.dirname(dest_path))
+        with open(dest_path + '.tmp', 'wb') as fh:
+            fh.write(contents)
+        os.rename(dest_path + '.tmp', dest_path)
+        resource_file.path = dest_path
+        return dest_path
+
+    def _cached_etag(self, local_path):
+        """
+        Get the ETag of the object a cached file was last checked against, or
+        failing that the md5sum of the cached file.
+        """
+        return self._etags.get(local_path) or checksum(local_path)
+
+    def __prefetch_worker(self):
+        # Background thread: refresh queued ResourceFiles, yielding to any
+        # foreground or bulk transfer that is in progress.
+        while True:
+            priority, sequence, resource_file = self._prefetch_queue.get()
+            try:
+                with self._foreground_cond:
+                    self.__wait_turn(PRIORITY_PREFETCH)
+                self._refresh_resource_file(resource_file, PRIORITY_PREFETCH)
+                logger.debug("Prefetched resource file %s",
+                        resource_file.location_or_remote())
+            except Exception, e:
+                logger.warning("Prefetch of %s failed: %s",
+                        resource_file.location_or_remote(), e)
+            finally:
+                with self._prefetch_lock:
+                    self._prefetch_pending.discard(id(resource_file))
+                self._prefetch_queue.task_done()
+
+    def prefetch(self, resource_files, priority=PRIORITY_PREFETCH):
+        """
+        Queue ResourceFiles to be refreshed in the background.
+
+        Queued files are downloaded by a pool of worker threads in order of
+        priority (lower values first), then in the order they were queued.
+        Prefetching always yields to foreground requests such as
+        ResourceFile.local_path().  Bundled files are prefetched by way of
+        their Resource's bundle.
+
+        Returns the number of files queued.
+        """
+        if not self.get_bucket() or not self.prefetch_workers:
+            return 0
+        queued = 0
+        with self._prefetch_lock:
+            if not self._prefetch_queue:
+                self._prefetch_queue = Queue.PriorityQueue()
+                for i in range(self.prefetch_workers):
+                    worker = threading.Thread(target=self.__prefetch_worker,
+                            name='prefetch-{0}-{1}'.format(self.name, i))
+                    worker.daemon = True
+                    worker.start()
+            for resource_file in resource_files:
+                if resource_file.is_bundled() and resource_file.resource:
+                    resource_file = resource_file.resource.bundle
+                if not resource_file or id(resource_file) in self._prefetch_pending:
+                    continue
+                self._prefetch_pending.add(id(resource_file))
+                self._prefetch_queue.put((priority,
+                    next(self._prefetch_sequence), resource_file))
+                queued += 1
+        return queued
+
+    def prefetch_wait(self):
+        """
+        Block until all queued prefetches have completed.
+        """
+        if self._prefetch_queue:
+            self._prefetch_queue.join()
+
+    def fetch(self, resource, resource_files=None, threads=None, progress=None):
+        """
+        Make some of a Resource's Files (default all) available locally,
+        refreshing 'threads' (default 'download_threads') of them at once.
+
+        Only the given Files are refreshed: not the Resource, nor its other
+        Files (except that a tar.gz bundle is unpacked as a whole).  This is a
+        generator yielding (ResourceFile, local path) pairs in the order of
+        the Files.  If given, 'progress' is called with each ResourceFile as
+        soon as it is available (from the thread that refreshed it).
+        """
+        if resource_files is None:
+            resource_files = resource.files
+        resource_files = list(resource_files)
+        # Fetching a single File is interactive; many, bulk
+        priority = PRIORITY_BULK if len(resource_files) > 1 else PRIORITY_FOREGROUND
+        if (resource.bundle and resource_files and
+                resource.bundle.bundle_format() != BUNDLE_FORMAT_ZIP):
+            resource.bundle.unpack_bundle()
+
+        def fetch_file(resource_file):
+            if resource_file.is_bundled():
+                path = resource_file.local_path()
+            else:
+                path = self._refresh_resource_file(resource_file, priority)
+            if progress:
+                progress(resource_file)
+            return (resource_file, path)
+
+        return parallel_imap(fetch_file, resource_files,
+                threads or self.download_threads)
+
+    def refresh_resource(self, resource, refresh_all=False, files=None,
+            match=None, contains=None):
         """
         Synchronise a locally-cached Resource with the Repository's remote host
         (if applicable).
 
-        This method ensures that the local Resource is up-to-date with respect
-        to the S3 object store.  However if there is no Host for this
-        Repository then no action needs to be performed.
+        The Resource's meta-data is reloaded if it has changed.  Its Files are
+        refreshed only as selected: all of them with 'refresh_all', otherwise
+        those given in 'files' (ResourceFiles or paths within the Resource)
+        and/or matching the glob 'match' or the regular expression 'contains'
+        (see Resource.select_files()).  With no selection no Files are
+        refreshed: each is refreshed when it is next read.
+
+        Files of a 'unified' Resource are pinned to the meta-data they are
+        read with: a refreshed File whose object no longer matches its md5sum
+        there has been saved since, so the meta-data is reloaded (once, even if
+        not yet stale) to catch up with it.
+
+        Returns the list of refreshed ResourceFiles.  However if there is no
+        Host for this Repository then no action needs to be performed.
         """
         bucket = self.get_bucket()
         if not bucket:
-            return
+            return []
         cache_path = self.__resource_name_cache_path(resource.name)
         resource_key = self.__resource_name_key(resource.name)
-        if self.__download(resource_key, cache_path) or refresh_all:
-            if os.path.exists(cache_path):
+        if (not resource.pinned and self.__download(resource_key, cache_path)
+                and os.path.exists(cache_path)):
+            resource.reload(cache_path)
+        if refresh_all:
+            resource_files = resource.files
+        elif files is not None or match or contains:
+            resource_files = resource.select_files(files, match, contains)
+        else:
+            return []
+        priority = PRIORITY_BULK if len(resource_files) > 1 else PRIORITY_FOREGROUND
+        for resource_file in resource_files:
+            self._refresh_resource_file(resource_file, priority)
+            logger.debug("Refreshed resource file with path %s", resource_file.path)
+        if (resource.meta('unified') and not resource.pinned and
+                any(self.__unpinned(resource_file) for resource_file in resource_files)):
+            logger.debug("Files of %s are newer than its meta-data", resource.name)
+            if (self.__download(resource_key, cache_path, check_stale=False)
+                    and os.path.exists(cache_path)):
                 resource.reload(cache_path)
-            for resource_file in resource.files:
-                self._refresh_resource_file(resource_file)
-                logger.debug("Refreshed resource file with path %s", resource_file.path)
+                for resource_file in resource_files:
+                    if self.__unpinned(resource_file):
+                        self._refresh_resource_file(resource_file, priority)
+        return resource_files
 
-    def __save_resource_file(self, resource_file, write_bdkd_file=False):
+    def __unpinned(self, resource_file, path=None):
+        # Whether a refreshed File's object differs from the md5sum recorded
+        # for it in the meta-data.  (Multipart uploads have an ETag that is
+        # not an md5sum: these cannot be compared.)
+        md5sum = resource_file.meta('md5sum')
+        path = path or resource_file.path
+        etag = path and self._etags.get(path)
+        return bool(md5sum and etag and '-' not in etag and etag != md5sum)
+
+    def __save_resource_file(self, resource_file, write_bdkd_file=False,
+            is_bundle=False):
         file_cache_path = self.__file_cache_path(resource_file)
         if resource_file.path and os.path.exists(resource_file.path) and resource_file.location():
+            # The md5sum recorded when the file was added is reused if the
+            # file has not changed since, so that it is read only to upload it
+            local_md5sum = None
+            if _local_file_meta_current(resource_file.path, resource_file.metadata,
+                    resource_file.local_mtime):
+                local_md5sum = resource_file.metadata['md5sum']
             if resource_file.path != file_cache_path:
-                resource_file.relocate(file_cache_path)
+                if self.cache_mode == CACHE_MODE_REFERENCE:
+                    local_md5sum = self.__write_reference(resource_file,
+                            file_cache_path, local_md5sum)
+                else:
+                    if os.path.exists(file_cache_path + REFERENCE_SUFFIX):
+                        os.remove(file_cache_path + REFERENCE_SUFFIX)
+                    resource_file.relocate(file_cache_path, cache_mode=self.cache_mode)
+                    if local_md5sum:
+                        # The copy in the cache is described by the same
+                        # meta-data (if not quite the same mtime)
+                        resource_file.local_mtime = os.stat(file_cache_path).st_mtime
             bucket = self.get_bucket()
             if bucket:
+                # Content-addressed Files are uploaded only if no blob of the
+                # same content exists.  (Files written with a .bdkd file are
+                # found by location when rebuilding a file list, so are
+                # stored there.)
+                if self.content_addressed and not write_bdkd_file and not is_bundle:
+                    local_md5sum = local_md5sum or checksum(resource_file.path)
+                    resource_file.metadata['blob'] = local_md5sum
+                else:
+                    resource_file.metadata.pop('blob', None)
                 file_keyname = self.__file_keyname(resource_file)
                 md5sum = None
                 if 'md5sum' in resource_file.metadata:
                     md5sum = resource_file.metadata['md5sum']
-                self.__upload(file_keyname, resource_file.path, write_bdkd_file=write_bdkd_file,
-                              md5sum=md5sum)
+                file_key = self.__upload(file_keyname, resource_file.path,
+                        write_bdkd_file=write_bdkd_file, md5sum=md5sum,
+                        local_md5sum=local_md5sum)
+                # In a bucket that keeps object versions, the version of the
+                # object is recorded so that this version of the Resource
+                # can still be read after the File changes
+                version_id = getattr(file_key, 'version_id', None)
+                if isinstance(version_id, basestring) and version_id != 'null':
+                    resource_file.metadata['version_id'] = version_id
+                else:
+                    resource_file.metadata.pop('version_id', None)
+
+    def __save_resource_files(self, resource_files, write_bdkd_file=False,
+            upload_threads=None):
+        # Cache and upload a number of files at once, 'upload_threads' at a
+        # time.  Files are taken from the (possibly lazy) sequence only as
+        # threads become free, and new local files are read (to fill in
+        # their md5sums) just ahead of being uploaded.
+        for result in parallel_imap(
+                lambda resource_file: self.__save_resource_file(resource_file,
+                    write_bdkd_file=write_bdkd_file),
+                _with_local_meta(resource_files), upload_threads or self.upload_threads):
+            pass
+
+    def __stream_bundle(self, resource):
+        # Write the Resource's bundle directly to the object store as a
+        # multipart upload, compressing and uploading at the same time rather
+        # than staging the whole archive on local disk first.
+        bundle = resource.bundle
+        key_name = self.__file_keyname(bundle)
+        bucket = self.get_bucket()
+        logger.debug("Streaming bundle for %s to %s", resource.name, key_name)
+        stream = MultipartUploadFile(
+                self._s3_call(bucket.initiate_multipart_upload, key_name),
+                part_size=self.part_size, throttle=self.throttle)
+        try:
+            resource.write_bundle(stream, compress_threads=self.compress_threads)
+            stream.close()
+        except:
+            stream.abort()
+            raise
+        # The md5sum is known only now, too late for the upload's meta-data
+        self.__set_md5sum(bucket, key_name, stream.md5sum(), stream.size)
+        # Any cached copy of the bundle is now out of date
+        cache_path = self.__file_cache_path(bundle)
+        if os.path.exists(cache_path):
+            os.remove(cache_path)
+
+    def __set_md5sum(self, bucket, key_name, md5sum, size):
+        # Record the md5sum of an object uploaded in parts in its meta-data
+        self.__copy_onto_itself(bucket, key_name, {'md5sum': md5sum}, size)
+
+    def __copy_onto_itself(self, bucket, key_name, metadata, size):
+        # Copy an object onto itself with the given meta-data, which also
+        # makes it new (in parts, if it is too large to copy at once)
+        if size <= MAX_COPY_SIZE:
+            self._s3_call(bucket.copy_key, key_name, bucket.name, key_name,
+                    metadata=metadata)
+            return
+        multipart_upload = self._s3_call(bucket.initiate_multipart_upload, key_name,
+                metadata=metadata)
+        try:
+            for part_num, start in enumerate(range(0, size, COPY_PART_SIZE), 1):
+                self._s3_call(multipart_upload.copy_part_from_key, bucket.name,
+                        key_name, part_num, start, min(size, start + COPY_PART_SIZE) - 1)
+            self._s3_call(multipart_upload.complete_upload)
+        except:
+            self._s3_call(multipart_upload.cancel_upload)
+            raise
 
-    def save(self, resource, overwrite=False, update_bundle=True, skip_resource_file=False):
+    def save(self, resource, overwrite=False, update_bundle=True, skip_resource_file=False,
+            upload_threads=None):
         """
-        Save a Resource to the Repository.
+        Save a Resource to the Repository, uploading 'upload_threads' files
+        at once (default the Repository's upload_threads).
         """
+        try:
+            self.__save(resource, overwrite, update_bundle, skip_resource_file,
+                    upload_threads)
+        finally:
+            # The uploads of a save are remembered until it returns or
+            # fails: only a save interrupted with its process resumes them
+            for resource_file in (resource.files + [resource.bundle]):
+                if resource_file and resource_file.location():
+                    self.journal.remove('upload:' + self.__file_keyname(resource_file))
+
+    def __save(self, resource, overwrite, update_bundle, skip_resource_file,
+            upload_threads):
         conflicting_names = self.__resource_name_conflict(resource.name)
         if conflicting_names:
             raise ValueError("The Resource name '" + resource.name +
                     "' conflicts with other Resource names including: " +
                     ', '.join(conflicting_names))
 
-        resource_cache_path = self.__resource_name_cache_path(resource.name)
-        if not skip_resource_file:
-            resource.write(resource_cache_path)
-        resource.path = resource_cache_path
-
         if resource.repository != self:
             logger.debug("Setting the repository for the resource")
             resource.repository = self
 
         if resource.bundle:
-            if update_bundle:
-                resource.update_bundle()
-                self.__save_resource_file(resource.bundle)
+            resource.fill_local_meta()
+
+        # The bundle is written before the Resource itself, as writing a
+        # bundle may record an index of its members in the bundle meta-data
+        stream_bundle = (resource.bundle and update_bundle and
+                self.stream_bundles and self.get_bucket() and
+                resource.bundle.bundle_format() == BUNDLE_FORMAT_TAR_GZ)
+        if resource.bundle and update_bundle and not stream_bundle:
+            resource.update_bundle(compress_threads=self.compress_threads)
+
+        if resource.bundle:
+            if stream_bundle:
+                self.__stream_bundle(resource)
+            elif update_bundle:
+                self.__save_resource_file(resource.bundle, is_bundle=True)
         else:
             if resource.files_to_be_deleted:
                 for resource_file in resource.files_to_be_deleted:
                     self.__delete_resource_file(resource_file)
                 resource.files_to_be_deleted = []
-            else:
-                for resource_file in resource.files:
-                    self.__save_resource_file(resource_file, write_bdkd_file=skip_resource_file)
+            self.__save_resource_files(resource.files,
+                    write_bdkd_file=skip_resource_file, upload_threads=upload_threads)
+
+        # The meta-data is written once the Files are saved, as a new version.
+        # Every version is kept (read with get(name, version=...)), and the
+        # Resource's own key is the latest.
+        resource_cache_path = self.__resource_name_cache_path(resource.name)
+        if not skip_resource_file:
+            resource.version = _new_version()
+            resource.write(resource_cache_path)
+            version_cache_path = self.__version_cache_path(resource.name,
+                    resource.version)
+            mkdir_p(os.path.dirname(version_cache_path))
+            shutil.copy2(resource_cache_path, version_cache_path)
+        resource.path = resource_cache_path
+        resource.pinned = False
 
         bucket = self.get_bucket()
 
         if bucket:
             resource_keyname = self.__resource_name_key(resource.name)
-            resource_key = bucket.get_key(resource_keyname)
+            resource_key = self._s3_call(bucket.get_key, resource_keyname)
             if resource_key:
                 if not overwrite:
                     raise ValueError("Resource already exists!")
             else:
-                resource_key = boto.s3.key.Key(bucket, resource_keyname)
+                resource_key = bucket.new_key(resource_keyname)
             if not skip_resource_file:
+                version_keyname = self.__version_key(resource.name, resource.version)
+                logger.debug("Uploading resource version to key %s", version_keyname)
+                self._s3_call(bucket.new_key(version_keyname).set_contents_from_filename,
+                        resource_cache_path)
                 logger.debug("Uploading resource from %s to key %s", resource_cache_path, resource_keyname)
-                resource_key.set_contents_from_filename(resource_cache_path)
+                self._s3_call(resource_key.set_contents_from_filename,
+                        resource_cache_path)
+
+    def flush(self, timeout=None):
+        """
+        Wait until everything saved to a tiered host (see TieredHost) has been
+        written to the host behind it, or until 'timeout' seconds pass.
+        Returns whether it has (always, for other hosts).  Raises IOError if
+        writing any of it was given up.
+        """
+        bucket = self.get_bucket()
+        return not bucket or bucket.flush(timeout)
 
     def move(self, from_resource, to_name):
         try:
@@ -530,7 +2423,7 @@ class Repository(object):
                     ', '.join(conflicting_names))
         # Check that name is not already in use
         to_keyname = self.__resource_name_key(to_name)
-        to_key = to_bucket.get_key(to_keyname)
+        to_key = self._s3_call(to_bucket.get_key, to_keyname)
         if to_key:
             raise ValueError("Cannot rename: name in use")
         # Create unsaved destination resource (also checks name)
@@ -541,14 +2434,24 @@ class Repository(object):
             from_prefix = posixpath.join(Repository.files_prefix, from_resource.name, '')
             for from_file in from_resource.files:
                 to_file = copy.copy(from_file)
-                # Do S3 copy if in S3 (i.e. has 'location')
+                to_file.metadata = dict(from_file.metadata)
+                to_file.resource = to_resource
+                # Do S3 copy if in S3 (i.e. has 'location').  A blob is only
+                # copied if it is not already in the destination bucket.
                 if 'location' in from_file.metadata:
                     to_location = posixpath.join(Repository.files_prefix,
                             to_resource.name,
                             from_file.metadata['location'][len(from_prefix):])
-                    if not from_file.is_bundled():
-                       to_bucket.copy_key(to_location, from_bucket.name,
-                               from_file.metadata['location'])
+                    blob = from_file.meta('blob')
+                    if blob:
+                        blob_keyname = self.__blob_keyname(blob)
+                        if (from_bucket.name != to_bucket.name and
+                                not self._s3_call(to_bucket.get_key, blob_keyname)):
+                            self._s3_call(to_bucket.copy_key, blob_keyname,
+                                    from_bucket.name, blob_keyname)
+                    elif not from_file.is_bundled():
+                       self._s3_call(to_bucket.copy_key, to_location,
+                               from_bucket.name, from_file.metadata['location'])
                     to_file.metadata['location'] = to_location
                 # Add file to to_resource
                 to_resource.files.append(to_file)
@@ -559,8 +2462,8 @@ class Repository(object):
                 to_location = posixpath.join(Repository.files_prefix,
                         to_resource.name,
                         from_location[len(from_prefix):])
-                to_bucket.copy_key(to_location, from_bucket.name,
-                        from_location)
+                self._s3_call(to_bucket.copy_key, to_location,
+                        from_bucket.name, from_location)
                 to_resource.bundle.metadata['location'] = to_location
 
             # Save destination resource
@@ -574,6 +2477,59 @@ class Repository(object):
             to_resource.delete()
             raise
 
+    def collect_garbage(self, min_age=DEFAULT_GC_MIN_AGE, dry_run=False):
+        """
+        Delete the blobs of content-addressed Files that no Resource (nor any
+        saved version of one) refers to any longer.
+
+        Blobs younger than 'min_age' seconds are kept, as they may belong to
+        a Resource that is being saved.  With 'dry_run' nothing is deleted.
+        Returns the names of the keys of the (collectable) blobs.
+        """
+        bucket = self.get_bucket()
+        if not bucket:
+            return []
+        # Blobs are listed before the meta-data is read, so that a blob saved
+        # in the meantime is either referenced or too young to be collected
+        blobs_prefix = posixpath.join(type(self).blobs_prefix, '')
+        cutoff = datetime.utcnow() - timedelta(seconds=min_age)
+        candidates = [key.name for key in self.__list(blobs_prefix)
+                if datetime.strptime(key.last_modified, ISO_8601_UTC_FORMAT) < cutoff]
+        if not candidates:
+            return []
+        metadata_keys = itertools.chain(
+                self.__list(posixpath.join(type(self).resources_prefix, '')),
+                self.__list(posixpath.join(type(self).versions_prefix, '')))
+
+        def referenced_blobs(key):
+            try:
+                data = json.loads(self._s3_call(key.get_contents_as_string))
+            except ValueError:
+                logger.warning("Unreadable resource meta-data %s", key.name)
+                return []
+            return [file_data['blob'] for file_data in data.get('files', [])
+                    if file_data.get('blob')]
+
+        referenced = set()
+        for blobs in parallel_imap(referenced_blobs, metadata_keys,
+                self.download_threads):
+            referenced.update(self.__blob_keyname(blob) for blob in blobs)
+        # A blob re-used by a save since it was listed was made young again
+        # (see __upload), and is kept even if the save's meta-data was not
+        # yet written when it was read
+        garbage = set(key_name for key_name in candidates if key_name not in referenced)
+        if garbage:
+            garbage.intersection_update(key.name for key in self.__list(blobs_prefix)
+                    if datetime.strptime(key.last_modified, ISO_8601_UTC_FORMAT) < cutoff)
+        garbage = [key_name for key_name in candidates if key_name in garbage]
+        if not dry_run:
+            for i in range(0, len(garbage), 1000):
+                logger.debug("Deleting %d unreferenced blobs", len(garbage[i:i + 1000]))
+                self._s3_call(bucket.delete_keys, garbage[i:i + 1000])
+            for key_name in garbage:
+                self.journal.remove('upload:' + key_name)
+        return garbage
+
     def list(self, prefix=''):
         """
         List all Resource names available in the Repository.
@@ -587,7 +2543,7 @@ class Repository(object):
             resources_prefix = posixpath.join(resources_prefix, prefix)
         bucket = self.get_bucket()
         if bucket:
-            for key in bucket.list(resources_prefix):
+            for key in self.__list(resources_prefix):
                 resource_names.append(key.name[(len(type(self).resources_prefix) + 1):])
         else:
             resource_path = posixpath.join(self.local_cache,
@@ -599,23 +2555,51 @@ class Repository(object):
                             dirpath[(len(resource_path) + 1):], filename))
         return resource_names
 
-    def get(self, name):
+    def get(self, name, version=None):
         """
-        Acquire a Resource by name.
+        Acquire a Resource by name: its latest version, or the given
+        'version'.
 
-        Returns the named resource, or None if no such resource exists in the
-        Repository.
+        A Resource acquired by version is pinned to it (see Resource.pin()).
+
+        Returns the named resource, or None if no such resource (or version)
+        exists in the Repository.
         """
-        keyname = self.__resource_name_key(name)
-        cache_path = self.__resource_name_cache_path(name)
-        self.__download(keyname, cache_path)
+        if version:
+            cache_path = self.__version_cache_path(name, version)
+            if not os.path.exists(cache_path):
+                self.__download(self.__version_key(name, version), cache_path)
+        else:
+            cache_path = self.__resource_name_cache_path(name)
+            self.__download(self.__resource_name_key(name), cache_path)
         if os.path.exists(cache_path):
             resource = Resource.load(cache_path)
             resource.repository = self
+            if version:
+                resource.pin()
             return resource
         else:
             return None
 
+    def versions(self, name):
+        """
+        List the ids of the saved versions of a Resource, oldest first.
+
+        (Resources last saved before versions were introduced have none.)
+        """
+        versions_prefix = posixpath.join(type(self).versions_prefix, name, '')
+        bucket = self.get_bucket()
+        if bucket:
+            versions = [key.name[len(versions_prefix):]
+                    for key in self.__list(versions_prefix)]
+        else:
+            versions_path = posixpath.join(self.local_cache, versions_prefix)
+            versions = []
+            if os.path.isdir(versions_path):
+                versions = [filename for filename in os.listdir(versions_path)
+                        if os.path.isfile(os.path.join(versions_path, filename))]
+        return sorted(version for version in versions if version and '/' not in version)
+
     def delete(self, resource_or_name, force_delete_published=False):
         """
         Delete a Resource -- either directly or by name.
@@ -647,7 +2631,7 @@ class Repository(object):
                 key_attr = 'the bucket'
             raise ValueError('Cannot get %s for this repository.' %s (key_attr))
         key_name = self.__resource_name_key(name)
-        key = bucket.get_key(key_name)
+        key = self._s3_call(bucket.get_key, key_name)
         if not key:
             raise ValueError('Key %s does not exist in the repository' % (key_name))
         return key
@@ -660,6 +2644,7 @@ class Repository(object):
         :param name:  name of the resource
         :returns: the last modified date/time in a long string format as per S3
         """
+        import boto.utils
         key = self.get_resource_key(name, key_attr='last modified date')
         return boto.utils.parse_ts(key.last_modified)
 
@@ -679,21 +2664,42 @@ class Asset(object):
         self.files = None
 
     def relocate(self, dest_path, mod=stat.S_IRWXU,
-            move=False):
+            move=False, cache_mode=CACHE_MODE_COPY):
         """
         Relocate an Asset's file to some other path, and set the mode of the
         relocated file.
+
+        Unless moving, the file is copied according to 'cache_mode': a byte
+        copy, a hard link, or a copy-on-write clone (reflink).  Links and
+        clones fall back to a byte copy where the filesystem does not support
+        them.  The mode of a hard-linked file is left alone, as it is shared
+        with the original.
         """
         if self.path:
             if os.path.exists(dest_path):
                 os.remove(dest_path)
             else:
                 mkdir_p(os.path.dirname(dest_path))
+            linked = False
             if move:
                 shutil.move(self.path, dest_path)
+            elif cache_mode == CACHE_MODE_LINK:
+                try:
+                    os.link(self.path, dest_path)
+                    linked = True
+                except OSError, e:
+                    logger.debug("Unable to link %s (%s); copying", self.path, e)
+                    shutil.copy2(self.path, dest_path)
+            elif cache_mode == CACHE_MODE_REFLINK:
+                try:
+                    _reflink(self.path, dest_path)
+                except (IOError, OSError), e:
+                    logger.debug("Unable to clone %s (%s); copying", self.path, e)
+                    shutil.copy2(self.path, dest_path)
             else:
                 shutil.copy2(self.path, dest_path)
-            os.chmod(dest_path, mod)
+            if not linked:
+                os.chmod(dest_path, mod)
             self.path = dest_path
 
     def meta(self, keyname):
@@ -729,6 +2735,10 @@ class Resource(Asset):
         Repository)
     :ivar files:
         A list of the ResourceFile instances associated with this Resource
+    :ivar version:
+        The id of the saved version of the Resource (or None)
+    :ivar pinned:
+        Whether the Resource is read as of its version (see pin())
     """
     class ResourceJSONEncoder(json.JSONEncoder):
         def default(self, o):
@@ -744,6 +2754,8 @@ class Resource(Asset):
                 if o.bundle:
                     resource['bundle'] = o.bundle.metadata
                 resource['published'] = o.published
+                if o.version:
+                    resource['version'] = o.version
                 return resource
             else:
                 return json.JSONEncoder.default(self, o)
@@ -781,6 +2793,8 @@ class Resource(Asset):
         self.files = files
         self.files_to_be_deleted = []
         self.published = publish
+        self.version = None
+        self.pinned = False
 
     @classmethod
     def __normalise_file_data(cls, raw_data):
@@ -822,7 +2836,8 @@ class Resource(Asset):
         return files_data
 
     @classmethod
-    def new(cls, name, files_data=None, metadata=None, do_bundle=False, publish=True):
+    def new(cls, name, files_data=None, metadata=None, do_bundle=False, publish=True,
+            bundle_format=BUNDLE_FORMAT_TAR_GZ):
         """
         A convenience factory method that creates a new, unsaved Resource of
         the given name, using file information and metadata.
@@ -834,20 +2849,27 @@ class Resource(Asset):
 
         The rest of the keyword arguments are used as Resource meta-data.
 
+        If 'do_bundle' is set, local files are stored together in one archive
+        of the given 'bundle_format': either 'tar.gz' or 'zip'.  Files in a
+        zip bundle can be fetched individually.
+
         The Resource and all its ResourceFile objects ready to be saved to a Repository.
         """
         resource_files = []
         bundle = None
         if files_data:
             if do_bundle:
+                # The archive itself is written when the Resource is saved
+                if not bundle_format in BUNDLE_FORMATS:
+                    raise ValueError("Unknown bundle format '{0}'".format(bundle_format))
                 bundle_path = cls.bundle_temp_path(name)
-                bundle = ResourceFile(bundle_path, resource=None, metadata={
+                bundle_meta = {
                     'location': posixpath.join(Repository.files_prefix, name,
-                        '.bundle', 'bundle.tar.gz')})
-                mkdir_p(os.path.dirname(bundle_path))
+                        '.bundle', 'bundle.' + bundle_format)}
+                if bundle_format != BUNDLE_FORMAT_TAR_GZ:
+                    bundle_meta['format'] = bundle_format
+                bundle = ResourceFile(bundle_path, resource=None, metadata=bundle_meta)
                 bundle.files = []
-                bundle_archive = tarfile.open(name=bundle_path, mode='w:gz')
-                # resource_files.append(bundle)
             files_data = cls.__normalise_file_data(files_data)
             for file_data in files_data:
                 path = file_data.pop('path', None)
@@ -865,21 +2887,12 @@ class Resource(Asset):
                     meta['location'] = posixpath.join(Repository.files_prefix, name, location)
                     if path:
                         path = os.path.expanduser(path)
-                        if not 'md5sum' in meta:
-                            meta['md5sum'] = checksum(path)
-                        if not 'last-modified' in meta:
-                            meta['last-modified'] = time.strftime(TIME_FORMAT,
-                                    time.gmtime(os.path.getmtime(path)))
-                        if not 'content-length' in meta:
-                            meta['content-length'] = os.stat(path).st_size
-                        if bundle:
-                            bundle_archive.add(name=path, arcname=location)
                     else:
                         raise ValueError("For Resource files, either a path to a local file or a remote URL is required")
                 resource_file = ResourceFile(path, resource=None, metadata=meta)
+                # Local files are read when saved (or their meta-data needed)
+                resource_file.local_meta_pending = 'remote' not in meta
                 resource_files.append(resource_file)
-            if do_bundle:
-                bundle_archive.close()
         resource = cls(name, files=resource_files, metadata=metadata, publish=publish)
         if publish:
             missing_fields = resource.validate_mandatory_metadata()
@@ -927,18 +2940,12 @@ class Resource(Asset):
                 meta['location'] = posixpath.join(Repository.files_prefix, name, location)
                 if path:
                     path = os.path.expanduser(path)
-                    if not 'md5sum' in meta:
-                        meta['md5sum'] = checksum(path)
-                    if not 'last-modified' in meta:
-                        meta['last-modified'] = time.strftime(TIME_FORMAT,
-                                time.gmtime(os.path.getmtime(path)))
-                    if not 'content-length' in meta:
-                        meta['content-length'] = os.stat(path).st_size
                     if bundle_archive:
                         bundle_archive.add(name=path, arcname=location)
                 else:
                     raise ValueError("For Resource files, either a path to a local file or a remote URL is required")
             resource_file = ResourceFile(path, resource=None, metadata=meta)
+            resource_file.local_meta_pending = 'remote' not in meta
             resource_files.append(resource_file)
 
         return resource_files
@@ -1003,6 +3010,102 @@ class Resource(Asset):
         return True
 
 
+    def sync_directory(self, directory, delete=False, update_published=False,
+            manifest_path=None, hash_threads=None):
+        """
+        Bring the Resource's files up to date with the contents of a local
+        directory, ready to be saved.  Files are located by their path within
+        the directory.
+
+        New files, and files that differ from the Resource's meta-data, are
+        added with their local paths so that only they are uploaded when the
+        Resource is saved.  A file whose size and modification time match the
+        meta-data is taken to be unchanged without being read; otherwise its
+        md5sum is compared.  With 'delete', files that are no longer in the
+        directory are removed from the Resource.
+
+        The md5sums calculated are recorded in a local manifest file (if
+        'manifest_path' is given), so that files which are merely touched are
+        not read again next time.  Returns lists of the storage locations of
+        the files added, changed and deleted.
+        """
+        if self.published and not update_published:
+            raise ValueError("Cannot synchronise a published Resource unless override is specified.")
+        if self.is_bundled():
+            raise ValueError("Cannot synchronise a bundled Resource")
+        directory = os.path.abspath(os.path.expanduser(directory))
+        if not os.path.isdir(directory):
+            raise ValueError("The directory '{0}' does not exist".format(directory))
+
+        manifest = {}
+        if manifest_path and os.path.exists(manifest_path):
+            with open(manifest_path) as fh:
+                try:
+                    data = json.load(fh)
+                except ValueError:
+                    data = {}
+            if data.get('directory') == directory:
+                manifest = data.get('files', {})
+
+        existing = dict((resource_file.storage_location(), resource_file)
+                for resource_file in (self.files or []) if resource_file.location())
+        local_paths = {}
+        for dirpath, dirnames, filenames in os.walk(directory):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                local_paths[os.path.relpath(path, directory).replace(os.sep, '/')] = path
+
+        new_manifest = {}
+        to_check = []
+        for name in sorted(local_paths):
+            path = local_paths[name]
+            file_stat = os.stat(path)
+            meta = {'content-length': file_stat.st_size,
+                    'last-modified': time.strftime(TIME_FORMAT,
+                        time.gmtime(file_stat.st_mtime))}
+            existing_file = existing.get(name)
+            if (existing_file and existing_file.meta('md5sum') and
+                    existing_file.meta('content-length') == meta['content-length'] and
+                    existing_file.meta('last-modified') == meta['last-modified']):
+                new_manifest[name] = [file_stat.st_size, file_stat.st_mtime,
+                        existing_file.meta('md5sum')]
+                continue
+            cached = manifest.get(name)
+            if cached and cached[:2] == [file_stat.st_size, file_stat.st_mtime]:
+                meta['md5sum'] = cached[2]
+            to_check.append((name, path, meta, file_stat.st_mtime))
+
+        added, changed, deleted = [], [], []
+        for (name, path, meta, mtime), item in itertools.izip(to_check,
+                hash_files(((path, meta) for name, path, meta, mtime in to_check),
+                    hash_threads)):
+            new_manifest[name] = [meta['content-length'], mtime, meta['md5sum']]
+            existing_file = existing.get(name)
+            if existing_file and existing_file.meta('md5sum') == meta['md5sum']:
+                continue
+            meta['location'] = posixpath.join(Repository.files_prefix, self.name,
+                    name)
+            resource_file = ResourceFile(path, resource=self, metadata=meta)
+            if existing_file:
+                self.files[self.files.index(existing_file)] = resource_file
+                changed.append(name)
+            else:
+                self.files.append(resource_file)
+                added.append(name)
+
+        if delete:
+            for name in sorted(set(existing) - set(local_paths)):
+                self.files.remove(existing[name])
+                self.files_to_be_deleted.append(existing[name])
+                deleted.append(name)
+
+        if manifest_path:
+            mkdir_p(os.path.dirname(manifest_path))
+            with open(manifest_path + '.tmp', 'w') as fh:
+                json.dump(dict(directory=directory, files=new_manifest), fh)
+            os.rename(manifest_path + '.tmp', manifest_path)
+        return added, changed, deleted
+
     def validate_mandatory_metadata(self):
         """
         Checks if mandatory fields are present, and the values are not None.
@@ -1042,13 +3145,24 @@ class Resource(Asset):
         Reload a Resource from a Resource metadata file (local).
         """
         if local_resource_filename and os.path.exists(local_resource_filename):
+            # ResourceFiles still in the Resource are kept (with their new
+            # meta-data), so that references to them remain valid
+            existing_files = dict((resource_file.location_or_remote(), resource_file)
+                    for resource_file in (self.files or [])
+                    if resource_file.metadata)
             resource_files = []
             with io.open(local_resource_filename, encoding='UTF-8') as fh:
                 data = json.load(fh)
             files_data = data.pop('files', [])
             for file_data in files_data:
-                resource_files.append(ResourceFile(None, resource=self,
-                    metadata=file_data))
+                resource_file = existing_files.pop(
+                        file_data.get('location') or file_data.get('remote'), None)
+                if resource_file:
+                    resource_file.metadata = file_data
+                else:
+                    resource_file = ResourceFile(None, resource=self,
+                            metadata=file_data)
+                resource_files.append(resource_file)
             bundle_data = data.pop('bundle', None)
             if bundle_data:
                 self.bundle = ResourceFile(None, resource=self,
@@ -1058,15 +3172,26 @@ class Resource(Asset):
             self.metadata = data.get('metadata', dict())
             self.files = resource_files
             self.published = data.pop('published', None)
+            self.version = data.pop('version', None)
 
     def to_json(self, **kwargs):
         """
         Create a JSON string representation of the Resource: its files and
         meta-data.
         """
+        self.fill_local_meta()
         return Resource.ResourceJSONEncoder(ensure_ascii=False,
                 encoding='UTF-8', **kwargs).encode(self)
 
+    def fill_local_meta(self, threads=None):
+        """
+        Fill in the meta-data of the local files added to the Resource and not
+        yet read (md5sum, last-modified and content-length), reading them in
+        parallel.  Saving the Resource does this as it uploads them.
+        """
+        for resource_file in _with_local_meta(self.files or [], threads):
+            pass
+
     def write(self, dest_path, mod=stat.S_IRWXU):
         """
         Write the JSON file representation of a Resource to a destination file.
@@ -1087,17 +3212,59 @@ class Resource(Asset):
         this Resource.
 
         (Note that this method will trigger a refresh of the Resource, ensuring that all
-        locally-stored data is relatively up-to-date.)
-        """
-        if self.repository:
-            self.repository.refresh_resource(self, True)
-        paths = []
-        do_refresh = True
-        if self.bundle:
-            self.bundle.unpack_bundle(do_refresh=True)
-        for resource_file in self.files:
-            paths.append(resource_file.local_path())
-        return paths
+        locally-stored data is relatively up-to-date.  Each File is refreshed
+        once.)
+        """
+        if not self.repository:
+            return [resource_file.local_path() for resource_file in self.files]
+        if (self.meta('unified') and not self.is_bundled() and
+                self.repository.get_bucket()):
+            return [resource_file.path for resource_file in
+                    self.repository.refresh_resource(self, refresh_all=True)]
+        self.repository.refresh_resource(self)
+        return [path for resource_file, path in self.repository.fetch(self)]
+
+    def pin(self):
+        """
+        Pin the Resource to the version it was read as: a consistent snapshot,
+        however the Resource is saved afterwards.
+
+        The meta-data of a pinned Resource is not reloaded, and each of its
+        Files is fetched (lazily, as usual) as it was in that version.  If the
+        repository does not keep object versions and a File has changed since,
+        reading it raises a ValueError rather than mixing versions.  Returns
+        the Resource.
+        """
+        self.pinned = True
+        return self
+
+    def select_files(self, files=None, match=None, contains=None):
+        """
+        Return a list of the Resource's ResourceFile objects selected by any
+        of: the given 'files' (ResourceFiles or paths within the Resource), a
+        shell-style pattern 'match' for their path within the Resource (or
+        remote URL), and a regular expression 'contains' (as in
+        files_matching()).  Files must meet all the criteria given.
+        """
+        selected = self.files
+        if files is not None:
+            names = set()
+            for resource_file in files:
+                if isinstance(resource_file, ResourceFile):
+                    names.add(resource_file.location_or_remote())
+                else:
+                    names.add(resource_file)
+            selected = [resource_file for resource_file in selected
+                    if resource_file.location_or_remote() in names or
+                    resource_file.storage_location() in names]
+        if contains:
+            selected = [resource_file for resource_file in selected
+                    if re.search(contains, resource_file.location_or_remote())]
+        if match:
+            selected = [resource_file for resource_file in selected
+                    if fnmatch.fnmatch(resource_file.storage_location() or
+                        resource_file.remote(), match)]
+        return selected
 
     def files_matching(self, pattern):
         """
@@ -1127,19 +3294,85 @@ class Resource(Asset):
                 match = resource_file
         return match
 
-    def update_bundle(self):
-        """
-        Update the bundle with any local file changes.
-        """
-        if not self.bundle:
-            return  # no-op
-        bundle_file = tarfile.open(self.bundle.local_path(), mode='w:gz')
+    def __write_zip_bundle(self, fileobj, previous_bundle=None):
+        # Write a zip bundle and record its index.  Members that are unchanged
+        # since the previous bundle was written are copied from it as they
+        # are, without being compressed again.  A member is unchanged if its
+        # file has the size and modification time recorded in the index (or
+        # failing that, the same size and md5sum).
+        previous_index = self.bundle.meta('index') or {}
+        previous_fh = None
+        if previous_bundle and previous_index:
+            previous_fh = open(previous_bundle, 'rb')
+        bundle_file = _ZipBundleWriter(fileobj)
+        try:
+            for resource_file in self.files:
+                if not (resource_file.path and resource_file.location()):
+                    continue
+                name = resource_file.storage_location()
+                entry = previous_index.get(name)
+                if previous_fh and entry and entry.get('md5sum'):
+                    info = os.stat(resource_file.path)
+                    if (info.st_size == entry['size'] and
+                            (info.st_mtime == entry.get('mtime') or
+                                checksum(resource_file.path) == entry['md5sum'])):
+                        logger.debug("Reusing unchanged bundle member %s", name)
+                        bundle_file.copy(resource_file.path, name, previous_fh,
+                                entry)
+                        continue
+                bundle_file.write(resource_file.path, name)
+            bundle_file.close()
+        finally:
+            if previous_fh:
+                previous_fh.close()
+        self.bundle.metadata['index'] = bundle_file.index
+
+    def write_bundle(self, fileobj, compress_threads=1, previous_bundle=None):
+        """
+        Write an archive of the Resource's local files to a file object, in
+        the format of the Resource's bundle.
+
+        A tar.gz bundle is written as a stream (the file object need not be
+        seekable).  With more than one compression thread it is compressed in
+        independent blocks, in parallel.
+
+        A zip bundle needs a seekable, readable file object: once written, an
+        index of its members is recorded in the bundle's meta-data.  Given the
+        path of the 'previous_bundle' that the current index describes,
+        members that are unchanged are copied from it.
+        """
+        if self.bundle and self.bundle.bundle_format() == BUNDLE_FORMAT_ZIP:
+            self.__write_zip_bundle(fileobj, previous_bundle)
+            return
+        gzip_file = None
+        if compress_threads > 1:
+            gzip_file = ParallelGzipFile(fileobj, threads=compress_threads)
+            bundle_file = tarfile.open(fileobj=gzip_file, mode='w|')
+        else:
+            bundle_file = tarfile.open(fileobj=fileobj, mode='w|gz')
         for resource_file in self.files:
             if resource_file.path and resource_file.location():
-                storage_location = resource_file.storage_location()
                 bundle_file.add(resource_file.path,
                         resource_file.storage_location())
         bundle_file.close()
+        if gzip_file:
+            gzip_file.close()
+
+    def update_bundle(self, compress_threads=1):
+        """
+        Update the bundle with any local file changes.
+        """
+        if not self.bundle:
+            return  # no-op
+        bundle_path = self.bundle.local_path()
+        mkdir_p(os.path.dirname(bundle_path))
+        previous_bundle = None
+        if os.path.exists(bundle_path) and self.bundle.meta('index'):
+            previous_bundle = bundle_path
+        with open(bundle_path + '.tmp', 'w+b') as fh:
+            self.write_bundle(fh, compress_threads=compress_threads,
+                    previous_bundle=previous_bundle)
+        os.rename(bundle_path + '.tmp', bundle_path)
 
     def save(self):
         """
@@ -1162,7 +3395,7 @@ class Resource(Asset):
 
     def publish(self):
         if self.published:
-            print "Nothing to do, resource is already 'Published'"
+            logger.info("Nothing to do, resource %s is already 'Published'", self.name)
             return False
 
         missing_fields = self.validate_mandatory_metadata()
@@ -1177,7 +3410,7 @@ class Resource(Asset):
 
     def unpublish(self):
         if not self.published:
-            print "Nothing to do, resource is already 'Unpublished'"
+            logger.info("Nothing to do, resource %s is already 'Unpublished'", self.name)
             return False
 
         self.published=False
@@ -1201,12 +3434,30 @@ class ResourceFile(Asset):
         Constructor for a Resource file given a local filesystem path, the
         Resource that owns the ResourceFile, and any other meta-data.
         """
+        # Whether the md5sum, last-modified and content-length of a newly
+        # added local file are still to be read from it: they are read when
+        # the meta-data is first used, or as the file is saved
+        self.local_meta_pending = False
+        # The exact modification time of the local file when they were read
+        self.local_mtime = None
         super(ResourceFile, self).__init__()
 
         self.metadata = metadata
         self.resource = resource
         self.path = path
 
+    @property
+    def metadata(self):
+        if self.local_meta_pending:
+            self.local_mtime = os.stat(self.path).st_mtime
+            local_file_meta(self.path, self._metadata)
+            self.local_meta_pending = False
+        return self._metadata
+
+    @metadata.setter
+    def metadata(self, metadata):
+        self._metadata = metadata
+
     def is_bundled(self):
         return (self.metadata and 'bundled' in self.metadata)
 
@@ -1219,6 +3470,22 @@ class ResourceFile(Asset):
         else:
             return None
 
+    def bundle_format(self):
+        """
+        Get the archive format of this bundle: 'tar.gz' (the default) or
+        'zip'.
+        """
+        return self.meta('format') or BUNDLE_FORMAT_TAR_GZ
+
+    def bundle_entry(self, storage_location):
+        """
+        Get the index entry of a member of this (indexed) bundle, or None.
+        """
+        index = self.meta('index')
+        if index and storage_location:
+            return index.get(storage_location)
+        return None
+
     def unpack_bundle(self, do_refresh=True):
         """
         If this ResourceFile is bundled, unpack its contents to the bundle path.
@@ -1232,9 +3499,37 @@ class ResourceFile(Asset):
         resource_filename = self.local_path()
         if not os.path.exists(unpack_path):
             mkdir_p(unpack_path)
-        bundle_file = tarfile.open(resource_filename)
-        bundle_file.extractall(path=unpack_path)
-        bundle_file.close()
+        # Skip unpacking if this very bundle was unpacked before and all its
+        # members are still in place
+        marker_path = resource_filename + '.unpacked'
+        bundle_stat = os.stat(resource_filename)
+        marker = None
+        if os.path.exists(marker_path):
+            with open(marker_path) as fh:
+                try:
+                    marker = json.load(fh)
+                except ValueError:
+                    pass
+        if marker and marker.get('size') == bundle_stat.st_size:
+            unchanged = (marker.get('mtime') == bundle_stat.st_mtime or
+                    marker.get('etag') == self.resource.repository._cached_etag(
+                        resource_filename))
+            if unchanged and all(os.path.exists(os.path.join(unpack_path, name))
+                    for name in marker.get('members', [])):
+                logger.debug("Bundle %s already unpacked", resource_filename)
+                if marker.get('mtime') != bundle_stat.st_mtime:
+                    marker['mtime'] = bundle_stat.st_mtime
+                    with open(marker_path, 'w') as fh:
+                        json.dump(marker, fh)
+                return
+        members = _extract_bundle(resource_filename, unpack_path,
+                self.bundle_format(), self.resource.repository.unpack_threads)
+        with open(marker_path, 'w') as fh:
+            json.dump(dict(
+                etag=self.resource.repository._cached_etag(resource_filename),
+                size=bundle_stat.st_size,
+                mtime=bundle_stat.st_mtime,
+                members=members), fh)
 
     def local_path(self):
         """
@@ -1247,11 +3542,13 @@ class ResourceFile(Asset):
         if (self.resource and self.resource.repository):
             if self.is_bundled():
                 self.path = self.resource.repository._resource_file_dest_path(self)
-                if not os.path.exists(self.path):
+                if (not os.path.exists(self.path) and
+                        not self.resource.repository._refresh_bundled_file(self)):
                     self.resource.local_paths()  # Trigger refresh
             else:
                 if self.resource.meta('unified'):
-                    self.resource.repository.refresh_resource(self.resource, True)
+                    self.resource.repository.refresh_resource(self.resource,
+                            files=[self])
                 else:
                     self.resource.repository._refresh_resource_file(self)
         try:
@@ -1259,6 +3556,32 @@ class ResourceFile(Asset):
         except UnicodeEncodeError:
             return self.path
 
+    def mmap(self):
+        """
+        Get a read-only memory map of this File's locally cached data.
+
+        (Note that this method refreshes this File in the same way as
+        local_path().)  Slicing the map reads directly from the page cache
+        rather than copying the whole file into a Python string.  Empty files
+        cannot be mapped: an empty memoryview is returned for them instead.
+        """
+        with open(self.local_path(), 'rb') as fh:
+            if os.fstat(fh.fileno()).st_size == 0:
+                return memoryview(b'')
+            return mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def memmap(self, dtype='uint8', shape=None, offset=0, order='C'):
+        """
+        Get a read-only numpy.memmap of this File's locally cached data, for
+        raw binary payloads of a known dtype (and optionally shape).
+
+        (Note that this method refreshes this File in the same way as
+        local_path().)  Requires numpy.
+        """
+        import numpy
+        return numpy.memmap(self.local_path(), dtype=dtype, mode='r',
+                offset=offset, shape=shape, order=order)
+
     def location(self):
         """
         Get the meta-data "location" of the ResourceFile (if it is stored in
@@ -1289,23 +3612,88 @@ class ResourceFile(Asset):
         """
         return self.location() or self.remote()
 
+def __config_stamp():
+    # The paths, modification times and sizes of the configuration files
+    stamp = []
+    for file_name in [_config_global_file, _config_user_file]:
+        try:
+            file_stat = os.stat(file_name)
+            stamp.append((file_name, file_stat.st_mtime, file_stat.st_size))
+        except OSError:
+            stamp.append((file_name, None, None))
+    return tuple(stamp)
+
 def __load_config():
-    global _settings, _hosts, _repositories
-    _settings = {}
-    _hosts = {}
-    _repositories = {}
+    # Load the configuration, unless it is unchanged since last loaded.  S3
+    # connections to the configured hosts are only made when first used.
+    #
+    # The configuration is built aside and published in one step, under a
+    # lock, so that other threads never see it half loaded (nor load it
+    # again at the same time).
+    stamp = __config_stamp()
+    if stamp == _config_stamp:
+        return
+    with _config_lock:
+        if stamp != _config_stamp:
+            __build_config(stamp)
+
+def __tiered_host(host_config, backing_config, backing_host):
+    # The TieredHost of a configuration.  The host made by an earlier load of
+    # the same configuration is kept, so that its local directory is flushed
+    # by only one set of threads; one whose configuration changed is closed.
+    path = os.path.abspath(os.path.expanduser(host_config['path']))
+    signature = json.dumps([host_config, backing_config], sort_keys=True)
+    existing = _tiered_hosts.get(path)
+    if existing:
+        if existing[0] == signature:
+            return existing[1]
+        existing[1].close()
+    params = dict((param, host_config[param]) for param in
+            ['shared_path', 'flush_workers', 'max_retries', 'max_concurrent_requests']
+            if param in host_config)
+    host = TieredHost(path, backing_host, **params)
+    _tiered_hosts[path] = (signature, host)
+    return host
+
+def __build_config(stamp):
+    global _settings, _hosts, _repositories, _config_stamp, _bandwidth_limiter
+    import yaml
+    loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+    new_settings = {}
+    new_hosts = {}
+    new_repositories = {}
+    host_configs = {}
     for file_name in [_config_global_file, _config_user_file]:
         if os.path.exists(file_name):
             with open(file_name) as f:
-                config = yaml.load(f)
+                config = yaml.load(f, Loader=loader) or {}
 
             # Update settings
             if 'settings' in config and config['settings']:
-                _settings.update(config['settings'])
+                new_settings.update(config['settings'])
 
             # Update hosts
             if 'hosts' in config and config['hosts']:
+                tiered = []
+                host_configs.update(config['hosts'])
                 for host_name, host_config in config['hosts'].iteritems():
+                    host_type = host_config.get('type', 's3')
+                    if host_type == 'tiered':
+                        # Created once the host it is in front of is known
+                        tiered.append((host_name, host_config))
+                        continue
+                    elif host_type in ('local', 'memory'):
+                        params = dict((param, host_config[param]) for param in
+                                ['max_retries', 'max_concurrent_requests']
+                                if param in host_config)
+                        if host_type == 'local':
+                            new_hosts[host_name] = LocalHost(host_config['path'], **params)
+                        else:
+                            new_hosts[host_name] = MemoryHost(**params)
+                        continue
+                    elif host_type != 's3':
+                        raise ValueError("Unknown type '{0}' of host '{1}'".format(
+                            host_type, host_name))
                     # create host
                     params = {}
                     if 'host' in host_config:
@@ -1318,22 +3706,58 @@ def __load_config():
                         params['access_key'] = host_config['access_key']
                     if 'secret_key' in host_config:
                         params['secret_key'] = host_config['secret_key']
+                    for param in ['max_retries', 'request_rate',
+                            'max_concurrent_requests']:
+                        if param in host_config:
+                            params[param] = host_config[param]
                     host = Host(**params)
-                    _hosts[host_name] = host
+                    new_hosts[host_name] = host
+                for host_name, host_config in tiered:
+                    new_hosts[host_name] = __tiered_host(host_config,
+                            host_configs.get(host_config['host']),
+                            new_hosts[host_config['host']])
 
             # Update repositories
             if 'repositories' in config and config['repositories']:
                 for repo_name, repo_config in config['repositories'].iteritems():
                     if 'host' in repo_config:
-                        host = _hosts[repo_config['host']]
+                        host = new_hosts[repo_config['host']]
                     else:
                         host = None
                     cache_path = os.path.expanduser(
                             repo_config.get('cache_path',
-                                posixpath.join(_settings['cache_root'])))
+                                posixpath.join(new_settings['cache_root'])))
                     stale_time = repo_config.get('stale_time', 60)
-                    repo = Repository(host, repo_name, cache_path, stale_time)
-                    _repositories[repo_name] = repo
+                    repo = Repository(host, repo_name, cache_path, stale_time,
+                            prefetch_workers=repo_config.get('prefetch_workers', 2),
+                            unpack_threads=repo_config.get('unpack_threads', 4),
+                            stream_bundles=repo_config.get('stream_bundles', False),
+                            compress_threads=repo_config.get('compress_threads', 1),
+                            part_size=repo_config.get('part_size', DEFAULT_PART_SIZE),
+                            upload_threads=repo_config.get('upload_threads', 4),
+                            download_threads=repo_config.get('download_threads', 4),
+                            cache_mode=repo_config.get('cache_mode', CACHE_MODE_COPY),
+                            content_addressed=repo_config.get('content_addressed', False),
+                            multipart_threshold=repo_config.get('multipart_threshold',
+                                DEFAULT_MULTIPART_THRESHOLD),
+                            bandwidth_limit=repo_config.get('bandwidth_limit'))
+                    new_repositories[repo_name] = repo
+    # Process-wide bandwidth limit, shared by all Repositories
+    bandwidth_limiter = None
+    if new_settings.get('bandwidth_limit'):
+        bandwidth_limiter = BandwidthLimiter(new_settings['bandwidth_limit'])
+    # Where metrics are sent (besides being kept in memory)
+    sinks = []
+    metrics_config = new_settings.get('metrics') or {}
+    if metrics_config.get('statsd'):
+        statsd_host, _, statsd_port = str(metrics_config['statsd']).partition(':')
+        sinks.append(StatsdSink(statsd_host or 'localhost', statsd_port or 8125))
+    if metrics_config.get('prometheus_file'):
+        sinks.append(PrometheusFileSink(metrics_config['prometheus_file']))
+    _settings, _hosts, _repositories = new_settings, new_hosts, new_repositories
+    _bandwidth_limiter = bandwidth_limiter
+    _metrics.sinks = sinks
+    _config_stamp = stamp
 
 def settings():
     """
@@ -1342,29 +3766,31 @@ def settings():
     These settings may originate from the system-wide configuration (in /etc)
     or user-specific configuration.
     """
-    global _settings
-    if not _settings:
-        __load_config()
+    __load_config()
     return _settings
 
 def hosts():
     """
     Get a dictionary of the configured hosts for BDKD Datastore.
     """
-    global _hosts
-    if not _hosts:
-        __load_config()
+    __load_config()
     return _hosts
 
 def repositories():
     """
     Get a dictionary of all configured Repositories, by name.
     """
-    global _repositories
-    if not _repositories:
-        __load_config()
+    __load_config()
     return _repositories
 
+def metrics():
+    """
+    Get the Metrics of this process, sent to the sinks configured by the
+    'metrics' setting.
+    """
+    __load_config()
+    return _metrics
+
 def repository(name):
     """
     Get a configured Repository by name, or None if no such Repository was
@@ -0,0 +1,45 @@
+# Copyright 2015 Nicta
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Buckets of an S3 host.  This module imports boto (which is slow to import),
+so it is only imported once an S3 host is connected to.
+"""
+
+import boto.s3.bucket
+import boto.s3.multipart
+
+
+class S3Bucket(boto.s3.bucket.Bucket):
+    """
+    A boto Bucket with the operations that a Repository also makes on a
+    backends.StoreBucket, beyond those of boto.
+    """
+    def get_multipart_upload(self, key_name, upload_id):
+        """
+        A multipart upload initiated earlier (perhaps by another process).
+        It is not checked: requests for an upload that S3 no longer has
+        (completed, aborted or expired) fail with NoSuchUpload.
+        """
+        multipart_upload = boto.s3.multipart.MultiPartUpload(self)
+        multipart_upload.key_name = key_name
+        multipart_upload.id = upload_id
+        return multipart_upload
+
+    def flush(self, timeout=None):
+        """
+        Wait until everything written has reached S3.  Writes to S3 are made
+        as they are requested, so nothing is ever left to wait for.
+        """
+        return True
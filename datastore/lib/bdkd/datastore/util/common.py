@@ -21,6 +21,9 @@ import argparse
 import os
 import glob
 import platform
+import sys
+import threading
+import time
 import urlparse
 import bdkd.datastore
 import posixpath
@@ -116,3 +119,85 @@ def _repository_resource_parser():
     parser.add_argument('resource_name',
             help='Name of a Resource')
     return parser
+
+
+def format_size(size):
+    """
+    A number of bytes in human-readable form, e.g. '1.5 MiB'.
+    """
+    for unit in ['B', 'KiB', 'MiB', 'GiB']:
+        if size < 1024:
+            break
+        size /= 1024.0
+    else:
+        unit = 'TiB'
+    if unit == 'B':
+        return '{0} B'.format(int(size))
+    return '{0:.1f} {1}'.format(size, unit)
+
+
+def format_duration(seconds):
+    """
+    A number of seconds as H:MM:SS.
+    """
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return '{0}:{1:02d}:{2:02d}'.format(hours, minutes, seconds)
+
+
+class TransferProgress(object):
+    """
+    Aggregate progress of a number of file transfers: files and bytes done,
+    throughput and estimated time remaining.  Reported on a single,
+    continually rewritten line of a stream (STDERR by default), at most once
+    per 'interval' seconds.  Updates may come from any thread.
+    """
+    def __init__(self, total_files, total_bytes, stream=None, interval=0.5):
+        self.total_files = total_files
+        self.total_bytes = total_bytes
+        self.stream = stream or sys.stderr
+        self.interval = interval
+        self.files = 0
+        self.bytes = 0
+        self.started = time.time()
+        self.__reported = 0
+        self.__lock = threading.Lock()
+
+    def update(self, size):
+        """
+        Record that a file of the given size has been transferred.
+        """
+        with self.__lock:
+            self.files += 1
+            self.bytes += size
+            now = time.time()
+            if now - self.__reported >= self.interval:
+                self.__reported = now
+                self.__report()
+
+    def finish(self):
+        """
+        Report the final totals, ending the progress line.
+        """
+        with self.__lock:
+            self.__report()
+            self.stream.write('\n')
+            self.stream.flush()
+
+    def summary(self):
+        """
+        Progress as a line of text.
+        """
+        elapsed = max(time.time() - self.started, 1e-6)
+        rate = self.bytes / elapsed
+        line = '{0}/{1} files, {2} of {3} ({4}/s)'.format(self.files,
+                self.total_files, format_size(self.bytes),
+                format_size(self.total_bytes), format_size(rate))
+        if self.files < self.total_files and rate > 0:
+            line += ', ETA {0}'.format(format_duration(
+                max(self.total_bytes - self.bytes, 0) / rate))
+        return line
+
+    def __report(self):
+        self.stream.write('\r' + self.summary() + '\033[K')
+        self.stream.flush()
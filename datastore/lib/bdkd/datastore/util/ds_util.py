@@ -20,11 +20,15 @@ in a datastore.
 """
 
 import argparse
+import itertools
+import json
 import os
+import sys
 import posixpath
+import urlparse
 
-import yaml
 import pprint
+import shutil
 import bdkd.datastore
 import bdkd.datastore.util.common as util_common
 
@@ -81,6 +85,52 @@ def _delete_resource_parser():
                         help='Force deleting a published resource')
     return parser
 
+def _sync_parser():
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument('directory',
+                        help='Local directory: files are stored by their path within it')
+    parser.add_argument('--delete', action='store_true', default=False,
+                        help='Delete files from the resource that are no longer in the directory')
+    parser.add_argument('--update-published', action='store_true', default=False,
+                        help='Force synchronising a published resource')
+    parser.add_argument('--dry-run', '-n', action='store_true', default=False,
+                        help='Show what would change, without saving anything')
+    parser.add_argument('--workers', '-w', type=int, default=None,
+                        help='Number of files read and uploaded at once (default: the '
+                        'hash_threads and upload_threads settings)')
+    parser.set_defaults(filenames=[], bundle=False, bundle_format=None)
+    return parser
+
+def _fetch_parser():
+    """
+    Parser for options selecting and fetching a Resource's files.
+    """
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument('--match', '-m',
+                        help='Only files whose path within the Resource matches this '
+                        'shell-style pattern, e.g. "*.nc"')
+    parser.add_argument('--contains', help='Only files whose name includes this regex expression')
+    parser.add_argument('--workers', '-w', type=int, default=None,
+                        help='Number of files downloaded at once (default: the '
+                        'download_threads setting)')
+    progress_group = parser.add_mutually_exclusive_group()
+    progress_group.add_argument('--progress', action='store_true', dest='progress',
+                                help='Show progress on STDERR (default if it is a terminal)')
+    progress_group.add_argument('--no-progress', action='store_false', dest='progress',
+                                help='Do not show progress')
+    parser.set_defaults(progress=None)
+    return parser
+
+def _resource_version_parser():
+    """
+    Parser for selecting a saved version of a Resource.
+    """
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument('--resource-version', dest='resource_version',
+                        help='Read this saved version of the Resource (see the versions '
+                        'command) rather than the latest')
+    return parser
+
 def _get_file_list_parser(enforce=True):
     """
     Parser for get-file-list options.
@@ -89,9 +139,9 @@ def _get_file_list_parser(enforce=True):
     parser.add_argument('--contains', help='Regex expression included in the file name')
     return parser
 
-def _create_options_parser():
+def _publish_parser():
     """
-    Parser for various options related to adding
+    Parser for whether a new resource is published
     """
     parser = argparse.ArgumentParser(add_help=False)
     publish_group = parser.add_mutually_exclusive_group()
@@ -100,10 +150,21 @@ def _create_options_parser():
     publish_group.add_argument('--no-publish', action='store_false', dest='publish',
                         help='Resource not published. Metadata is optional')
     parser.set_defaults(publish=True)
+    return parser
+
+def _create_options_parser():
+    """
+    Parser for various options related to adding
+    """
+    parser = argparse.ArgumentParser(add_help=False, parents=[_publish_parser()])
     parser.add_argument('--force', action='store_true', default=False,
             help="Force overwriting any existing resource")
     parser.add_argument('--bundle', action='store_true', default=False,
             help="Bundle all files together")
+    parser.add_argument('--bundle-format', choices=bdkd.datastore.BUNDLE_FORMATS,
+            default=None,
+            help="Archive format of the bundle (default tar.gz). Files in a "
+            "zip bundle can be fetched individually")
     return parser
 
 def _bdkd_metadata_parser(enforce=True):
@@ -171,6 +232,18 @@ def _create_subparsers(subparser):
                              _files_parser(),
                              _add_files_parser()
                          ])
+    subparser.add_parser('sync', help='Synchronise a Resource with a local directory',
+                         description='Upload new and changed files from a local directory to a '
+                         'Resource (creating it if necessary), optionally deleting files that are '
+                         'no longer in the directory.  Files are compared by size and modification '
+                         'time, then md5sum.  Metadata options are used when creating the Resource',
+                         parents=[
+                             util_common._repository_resource_parser(),
+                             _metadata_parser(),
+                             _bdkd_metadata_parser(),
+                             _publish_parser(),
+                             _sync_parser()
+                         ])
     subparser.add_parser('delete-files', help='Delete file(s) from an existing Resource',
                          description='Delete one or more files from an existing Resource by providing file names',
                          parents=[
@@ -213,14 +286,35 @@ def _create_subparsers(subparser):
     subparser.add_parser('get', help='Get details of a Resource as JSON text',
                          description='Get details of a Resource as JSON text. The meta-data and list '
                          'of Files for a Resource will be printed to STDOUT as JSON text',
+                         parents=[
+                             util_common._repository_resource_parser(),
+                             _resource_version_parser(),
+                         ])
+    subparser.add_parser('versions', help='List the saved versions of a Resource',
+                         description='List the ids of the saved versions of a Resource, oldest '
+                         'first',
                          parents=[
                              util_common._repository_resource_parser(),
                          ])
     subparser.add_parser('files', help='List of locally-cached filenames',
-                         description='List of locally-cached filenames for the given Resource',
+                         description='List of locally-cached filenames for the given Resource, '
+                         'downloading the files as required',
                          parents=[
                              util_common._repository_resource_parser(),
+                             _fetch_parser(),
+                             _resource_version_parser(),
                          ])
+    fetch_parser = subparser.add_parser('fetch', help='Download a Resource\'s files',
+                         description='Download the files of a Resource (or those matching '
+                         '--match / --contains) to the local cache, and optionally to a directory',
+                         parents=[
+                             util_common._repository_resource_parser(),
+                             _fetch_parser(),
+                             _resource_version_parser(),
+                         ])
+    fetch_parser.add_argument('--to', dest='to_directory',
+                              help='Also place the files in this directory, by their paths '
+                              'within the Resource')
     list_parser = subparser.add_parser('list', help='Get a list of all Resources in a Repository',
                          description='Get a list of all Resources in a Repository (or optionally '
                          'those Resources underneath a leading path).',
@@ -230,6 +324,11 @@ def _create_subparsers(subparser):
     list_parser.add_argument('--path', '-p', help='Email address of the maintainer')
     list_parser.add_argument('--verbose', '-v', action='store_true', default=False,
                              help='Verbose mode: all resource details (default names only)')
+    list_parser.add_argument('--format', choices=['text', 'ndjson'], default='text',
+                             help='Output format: text (default), or one JSON object per line')
+    list_parser.add_argument('--workers', '-w', type=int, default=8,
+                             help='Number of resource details fetched at once in verbose mode '
+                             '(default 8)')
 
     repositories_parser = subparser.add_parser('repositories', help='Get a list of all configured Repositories',
                                                description='Get a list of all configured Repositories')
@@ -257,6 +356,58 @@ def _create_subparsers(subparser):
                              util_common._repository_resource_parser(),
                              _get_file_list_parser(),
                          ])
+    gc_parser = subparser.add_parser('gc', help='Delete blobs no longer used by any Resource',
+                         description='Delete the stored contents of files (in a content_addressed '
+                         'repository) that no Resource, nor any saved version of one, refers to. '
+                         'The keys of the blobs are printed to STDOUT',
+                         parents=[
+                             util_common._repository_parser()
+                         ])
+    gc_parser.add_argument('--dry-run', '-n', action='store_true', default=False,
+                           help='Only print the blobs that would be deleted')
+    gc_parser.add_argument('--min-age', type=int, default=bdkd.datastore.DEFAULT_GC_MIN_AGE,
+                           help='Keep blobs younger than this many seconds, which may belong to '
+                           'a Resource being saved (default {0})'.format(
+                               bdkd.datastore.DEFAULT_GC_MIN_AGE))
+    flush_parser = subparser.add_parser('flush', help='Wait for writes to a tiered host to be flushed',
+                         description='Write everything saved to a repository on a tiered host, and '
+                         'not yet written to the host behind it, and wait until it is (e.g. at the '
+                         'end of a job).  Exits with status 1 if the timeout passes first',
+                         parents=[
+                             util_common._repository_parser()
+                         ])
+    flush_parser.add_argument('--timeout', type=float, default=None,
+                              help='Stop waiting after this many seconds')
+    batch_parser = subparser.add_parser('batch', help='Run many commands in one process',
+                         description='Run commands read from a file or STDIN, one JSON object per '
+                         'line: {"id": ..., "method": ..., "params": {...}}.  Methods and params are '
+                         'those of bdkd.datastore.util.service.DatastoreService, e.g. {"method": '
+                         '"delete", "params": {"repository": "my-repo", "resource": "my-resource"}}. '
+                         'A JSON response for each command is written to STDOUT, in the same order')
+    batch_parser.add_argument('--file', '-f', type=argparse.FileType('r'), default=sys.stdin,
+                              help='File of commands (default STDIN)')
+    batch_parser.add_argument('--workers', '-w', type=int, default=4,
+                              help='Number of commands run at once (default 4).  Commands that '
+                              'depend on each other should be run with --workers 1')
+    serve_parser = subparser.add_parser('serve', help='Serve datastore requests on a Unix socket',
+                         description='Run as a long-lived service, answering requests (one JSON '
+                         'object per line) on a Unix socket.  Used by datastorewrapper to avoid '
+                         'starting datastore-util for every call')
+    serve_parser.add_argument('--socket', default='~/.bdkd_datastore.sock',
+                              help='Path of the Unix socket (default ~/.bdkd_datastore.sock)')
+    serve_parser.add_argument('--idle-timeout', type=float, default=None,
+                              help='Stop after this many seconds without connections')
+    stats_parser = subparser.add_parser('stats', help='Print the metrics of a running service',
+                         description='Print the metrics (S3 requests and their latency by operation, '
+                         'bytes transferred, cache hits and misses, checksum time) of the service '
+                         'run by "datastore-util serve".  Metrics may also be sent to statsd or a '
+                         'Prometheus text file: see the "metrics" setting')
+    stats_parser.add_argument('--socket', default='~/.bdkd_datastore.sock',
+                              help='Path of the Unix socket (default ~/.bdkd_datastore.sock)')
+    stats_parser.add_argument('--format', choices=['json', 'prometheus'], default='json',
+                              help='Output format (default json)')
+    stats_parser.add_argument('--reset', action='store_true', default=False,
+                              help='Start the metrics again from zero')
 
     return subparser
 
@@ -266,8 +417,9 @@ def _parse_metadata_file(filename):
     """
     if not filename:
         return None, None
+    import yaml
     meta_file = open(filename, 'r')
-    raw = yaml.load(meta_file)
+    raw = yaml.safe_load(meta_file)
 
     for key in raw:
         if type(raw[key]) == list and key not in ('tags', 'groups'):
@@ -326,12 +478,17 @@ def create_new_resource(resource_args):
         else:
             resource_items.append(item)
 
+    bundle_options = {}
+    if resource_args.bundle and getattr(resource_args, 'bundle_format', None):
+        bundle_options['bundle_format'] = resource_args.bundle_format
+
     try:
         resource = bdkd.datastore.Resource.new(resource_args.resource_name,
                 files_data=resource_items,
                 metadata=metadata,
                 do_bundle=resource_args.bundle,
-                publish=resource_args.publish)
+                publish=resource_args.publish,
+                **bundle_options)
     except bdkd.datastore.MetadataException, e:
         bad_fields_string = ', '.join(e.missing_fields)
         raise ValueError("Must specify the following fields either on command "
@@ -366,6 +523,32 @@ def add_to_resource(repository, resource_name, args):
         raise ValueError("Resource '{0}' does not exist in repository".format(resource_name))
 
 
+def _sync_manifest_path(repository, resource_name):
+    # Local record of the sizes, modification times and md5sums of the files
+    # last synchronised to a resource
+    return os.path.join(repository.local_cache, 'sync', resource_name + '.json')
+
+def sync_resource(repository, resource_name, args):
+    resource = repository.get(resource_name)
+    is_new = not resource
+    if is_new:
+        resource = create_new_resource(args)
+    # A Resource created here may be published already: it has nothing to
+    # protect yet
+    added, changed, deleted = resource.sync_directory(args.directory,
+            delete=args.delete, update_published=(args.update_published or is_new),
+            manifest_path=_sync_manifest_path(repository, resource_name),
+            hash_threads=args.workers)
+    for prefix, names in [('A', added), ('M', changed), ('D', deleted)]:
+        for name in names:
+            print '{0} {1}'.format(prefix, name)
+    if args.dry_run:
+        return
+    if is_new:
+        repository.save(resource, upload_threads=args.workers)
+    elif added or changed or deleted:
+        repository.save(resource, overwrite=True, upload_threads=args.workers)
+
 def delete_from_resource(repository, resource_name, args):
     resource = repository.get(resource_name)
     if resource:
@@ -411,7 +594,8 @@ def _publish(resource_args):
     repository = resource_args.repository
     resource = repository.get(resource_args.resource_name)
     if resource:
-        resource.publish()
+        if not resource.publish():
+            print "Nothing to do, resource is already 'Published'"
     else:
         raise ValueError("Resource '{0}' does not exist!".format(resource_args.resource_name))
 
@@ -419,7 +603,8 @@ def _unpublish(resource_args):
     repository = resource_args.repository
     resource = repository.get(resource_args.resource_name)
     if resource:
-        resource.unpublish()
+        if not resource.unpublish():
+            print "Nothing to do, resource is already 'Unpublished'"
     else:
         raise ValueError("Resource '{0}' does not exist!".format(resource_args.resource_name))
 
@@ -448,29 +633,89 @@ def _delete_resource(repository, resource_name, force_delete_published=False):
     else:
         raise ValueError("Resource '{0}' does not exist!".format(resource_name))
 
-def _get_resource_details(repository, resource_name):
-    resource = repository.get(resource_name)
+def _get_resource_details(repository, resource_name, resource_version=None):
+    resource = repository.get(resource_name, version=resource_version)
     if resource:
         print resource.to_json(indent=4, separators=(',', ': '))
     else:
         raise ValueError("Resource '{0}' does not exist!".format(resource_name))
 
-def _list_resource_files(repository, resource_name):
-    resource = repository.get(resource_name)
-    if resource:
-        paths = resource.local_paths()
-        for path in paths:
-            print path
-    else:
-        raise ValueError("Resource '{0}' does not exist!".format(resource_name))
+def _list_versions(repository, resource_name):
+    for version in repository.versions(resource_name):
+        print version
 
-def _list_resources(repository, path, verbose):
+def _file_size(resource_file, path=None):
+    try:
+        return int(resource_file.meta('content-length'))
+    except (TypeError, ValueError):
+        if path and os.path.exists(path):
+            return os.path.getsize(path)
+        return 0
+
+def _place_file(resource_file, path, to_directory):
+    # Put a fetched file into a directory by its path within the Resource
+    # (or the name of a remote file), as a hard link where possible
+    name = (resource_file.storage_location() or
+            posixpath.basename(urlparse.urlparse(resource_file.remote()).path))
+    dest_path = os.path.join(to_directory, *name.split('/'))
+    bdkd.datastore.mkdir_p(os.path.dirname(dest_path))
+    if os.path.exists(dest_path):
+        os.remove(dest_path)
+    try:
+        os.link(path, dest_path)
+    except OSError:
+        shutil.copy2(path, dest_path)
+    return dest_path
+
+def _fetch_files(repository, resource_name, args, print_paths=True):
+    resource = repository.get(resource_name,
+            version=getattr(args, 'resource_version', None))
+    if not resource:
+        raise ValueError("Resource '{0}' does not exist!".format(resource_name))
+    files = resource.select_files(match=args.match, contains=args.contains)
+    show_progress = args.progress
+    if show_progress is None:
+        show_progress = sys.stderr.isatty()
+    progress = None
+    if show_progress:
+        progress = util_common.TransferProgress(len(files),
+                sum(_file_size(resource_file) for resource_file in files))
+    to_directory = getattr(args, 'to_directory', None)
+    try:
+        for resource_file, path in repository.fetch(resource, files,
+                threads=args.workers,
+                progress=progress and (lambda resource_file:
+                    progress.update(_file_size(resource_file, resource_file.path)))):
+            if to_directory:
+                path = _place_file(resource_file, path, to_directory)
+            if print_paths:
+                print path
+    finally:
+        if progress:
+            progress.finish()
+
+def _list_resource_files(repository, resource_name, args):
+    _fetch_files(repository, resource_name, args)
+
+def _list_resources(repository, path, verbose, output_format='text', workers=8):
     resource_names = repository.list(path or '')
-    for resource_name in resource_names:
-        print resource_name
-        if verbose:
-            resource = repository.get(resource_name)
-            print resource.to_json(indent=4, separators=(',', ': ')) + '\n'
+    if verbose:
+        # Resource details are fetched concurrently, but printed in the order
+        # of the listing
+        resources = bdkd.datastore.parallel_imap(repository.get, resource_names,
+                workers)
+    else:
+        resources = itertools.repeat(None)
+    for resource_name, resource in itertools.izip(resource_names, resources):
+        if output_format == 'ndjson':
+            if resource:
+                print resource.to_json()
+            else:
+                print json.dumps(dict(name=resource_name))
+        else:
+            print resource_name
+            if resource:
+                print resource.to_json(indent=4, separators=(',', ': ')) + '\n'
 
 def _list_repositories(verbose):
     repositories = bdkd.datastore.repositories()
@@ -509,6 +754,8 @@ def ds_util(argv=None):
         _save_resource(args.repository, resource, args.force)
     if args.subcmd == 'add-files':
         add_to_resource(args.repository, args.resource_name, args)
+    if args.subcmd == 'sync':
+        sync_resource(args.repository, args.resource_name, args)
     if args.subcmd == 'delete-files':
         delete_from_resource(args.repository, args.resource_name, args)
     elif args.subcmd == 'copy':
@@ -526,11 +773,17 @@ def ds_util(argv=None):
     elif args.subcmd == 'delete':
         _delete_resource(args.repository, args.resource_name, force_delete_published=args.force_delete_published)
     elif args.subcmd == 'get':
-        _get_resource_details(args.repository, args.resource_name)
+        _get_resource_details(args.repository, args.resource_name,
+                args.resource_version)
+    elif args.subcmd == 'versions':
+        _list_versions(args.repository, args.resource_name)
     elif args.subcmd == 'files':
-        _list_resource_files(args.repository, args.resource_name)
+        _list_resource_files(args.repository, args.resource_name, args)
+    elif args.subcmd == 'fetch':
+        _fetch_files(args.repository, args.resource_name, args, print_paths=False)
     elif args.subcmd == 'list':
-        _list_resources(args.repository, args.path, args.verbose)
+        _list_resources(args.repository, args.path, args.verbose,
+                args.format, args.workers)
     elif args.subcmd == 'repositories':
         _list_repositories(args.verbose)
     elif args.subcmd == 'rebuild-file-list':
@@ -541,3 +794,31 @@ def ds_util(argv=None):
         _unpublish(args)
     elif args.subcmd == 'get-file-list':
         _get_file_list(args)
+    elif args.subcmd == 'gc':
+        for key_name in args.repository.collect_garbage(min_age=args.min_age,
+                dry_run=args.dry_run):
+            print key_name
+    elif args.subcmd == 'flush':
+        try:
+            flushed = args.repository.flush(args.timeout)
+        except IOError, e:
+            print >>sys.stderr, e
+            return 1
+        if not flushed:
+            print >>sys.stderr, "Timed out with writes not yet flushed"
+            return 1
+    elif args.subcmd == 'batch':
+        from bdkd.datastore.util import service
+        if service.run_batch(args.file, sys.stdout, args.workers):
+            return 1
+    elif args.subcmd == 'serve':
+        from bdkd.datastore.util import service
+        service.serve(args.socket, args.idle_timeout)
+    elif args.subcmd == 'stats':
+        from bdkd.datastore.util import service
+        stats = service.request(args.socket, 'stats',
+                dict(format=args.format, reset=args.reset))
+        if args.format == 'prometheus':
+            sys.stdout.write(stats)
+        else:
+            print json.dumps(stats, indent=2)
@@ -0,0 +1,384 @@
+# Copyright 2015 Nicta
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+The operations of datastore-util as a Python API, a long-lived service
+providing them to other processes over a Unix socket, and batches of them run
+in one process.
+
+Requests and responses are JSON objects, one per line:
+
+    {"id": 1, "method": "list", "params": {"repository": "my-repo"}}
+    {"id": 1, "result": ["resource-1", "resource-2"]}
+
+A failed request is answered with an error instead of a result:
+
+    {"id": 1, "error": {"type": "ValueError", "message": "..."}}
+"""
+
+import argparse
+import json
+import logging
+import os
+import socket
+import SocketServer
+import threading
+
+import bdkd.datastore
+from bdkd.datastore.util import ds_util
+
+DEFAULT_SOCKET_PATH = '~/.bdkd_datastore.sock'
+
+logger = logging.getLogger(__name__)
+
+
+class DatastoreService(object):
+    """
+    The datastore-util operations, returning their results rather than
+    printing them.
+    """
+    methods = ['repositories', 'list', 'get', 'versions', 'files', 'create', 'delete',
+            'publish', 'unpublish', 'rebuild_file_list', 'update_metadata',
+            'add_files', 'get_file_list', 'stats']
+
+    def _repository(self, name):
+        repository = bdkd.datastore.repository(name)
+        if not repository:
+            raise ValueError("Repository '{0}' does not exist or is not configured!"
+                    .format(name))
+        return repository
+
+    def _resource(self, repository, resource_name, version=None):
+        resource = self._repository(repository).get(resource_name, version=version)
+        if not resource:
+            raise ValueError("Resource '{0}' does not exist!".format(resource_name))
+        return resource
+
+    def _metadata(self, metadata, metadata_file):
+        # The known meta-data fields, from a metadata file and/or a dictionary
+        # (whose keys may be spelt with dashes, as on the command line)
+        fields = dict((field, None) for field in ds_util.known_metadata_fields)
+        for key, value in (metadata or {}).items():
+            fields[key.replace('-', '_')] = value
+        return argparse.Namespace(metadata_file=metadata_file, **fields)
+
+    def call(self, method, params=None):
+        """
+        Call one of the service's methods by name, with a dictionary of
+        keyword arguments.
+        """
+        if method not in type(self).methods:
+            raise ValueError("Unknown method '{0}'".format(method))
+        return getattr(self, method)(**(params or {}))
+
+    def handle_request(self, line):
+        """
+        Handle a request given as a line of JSON text, returning the response
+        as a line of JSON text.
+        """
+        return json.dumps(self.respond(line)) + '\n'
+
+    def respond(self, line):
+        """
+        Handle a request given as a line of JSON text, returning the response
+        as a dictionary with either a 'result' or an 'error'.
+        """
+        request_id = None
+        try:
+            request = json.loads(line)
+            if not isinstance(request, dict):
+                raise ValueError("A request must be a JSON object")
+            request_id = request.get('id')
+            response = dict(id=request_id,
+                    result=self.call(request.get('method'), request.get('params')))
+        except Exception, e:
+            logger.debug("Request failed", exc_info=True)
+            response = dict(id=request_id,
+                    error=dict(type=type(e).__name__, message=str(e)))
+        return response
+
+    def repositories(self):
+        """
+        Names of all configured Repositories.
+        """
+        return bdkd.datastore.repositories().keys()
+
+    def list(self, repository, path=''):
+        """
+        Names of the Resources in a Repository (optionally underneath a
+        leading path).
+        """
+        return self._repository(repository).list(path or '')
+
+    def get(self, repository, resource, version=None):
+        """
+        The meta-data and list of Files of a Resource (optionally of a saved
+        version of it).
+        """
+        return json.loads(self._resource(repository, resource, version).to_json())
+
+    def versions(self, repository, resource):
+        """
+        Ids of the saved versions of a Resource, oldest first.
+        """
+        return self._repository(repository).versions(resource)
+
+    def files(self, repository, resource, version=None):
+        """
+        Local filenames of a Resource's Files (optionally of a saved version
+        of it), fetching them if required.
+        """
+        existing = self._resource(repository, resource, version)
+        return [path for resource_file, path in
+                existing.repository.fetch(existing)]
+
+    def create(self, repository, resource, metadata=None, metadata_file=None,
+            filenames=None, publish=False, force=False, bundle=False,
+            bundle_format=None):
+        """
+        Create a new Resource.
+        """
+        args = self._metadata(metadata, metadata_file)
+        args.resource_name = resource
+        args.filenames = filenames or []
+        args.publish = publish
+        args.bundle = bundle
+        args.bundle_format = bundle_format
+        new_resource = ds_util.create_new_resource(args)
+        ds_util._save_resource(self._repository(repository), new_resource, force)
+        return True
+
+    def delete(self, repository, resource, force=False):
+        """
+        Delete a Resource.
+        """
+        ds_util._delete_resource(self._repository(repository), resource,
+                force_delete_published=force)
+        return True
+
+    def publish(self, repository, resource):
+        """
+        Publish a Resource.
+        """
+        self._resource(repository, resource).publish()
+        return True
+
+    def unpublish(self, repository, resource):
+        """
+        Unpublish a Resource.
+        """
+        self._resource(repository, resource).unpublish()
+        return True
+
+    def rebuild_file_list(self, repository, resource):
+        """
+        Rebuild the list of Files of a Resource.  Returns whether the list
+        needed rebuilding.
+        """
+        repository = self._repository(repository)
+        existing = self._resource(repository.name, resource)
+        if repository.rebuild_file_list(existing):
+            repository.save(existing, overwrite=True)
+            return True
+        return False
+
+    def update_metadata(self, repository, resource, metadata=None,
+            metadata_file=None):
+        """
+        Update the meta-data of a Resource.
+        """
+        ds_util._update_metadata(self._repository(repository), resource,
+                ds_util._check_bdkd_metadata(self._metadata(metadata, metadata_file)))
+        return True
+
+    def add_files(self, repository, resource, filenames, add_to_published=False,
+            overwrite=False, no_metadata=False):
+        """
+        Add files to an existing Resource.
+        """
+        ds_util.add_to_resource(self._repository(repository), resource,
+                argparse.Namespace(filenames=filenames,
+                    add_to_published=add_to_published, overwrite=overwrite,
+                    no_metadata=no_metadata))
+        return True
+
+    def get_file_list(self, repository, resource, contains=None):
+        """
+        Object store paths ('bucket/key') of a Resource's Files, optionally
+        only those matching a regular expression.
+        """
+        repository = self._repository(repository)
+        existing = self._resource(repository.name, resource)
+        bucket_name = repository.get_bucket().name
+        if contains:
+            files = existing.files_matching(contains)
+        else:
+            files = existing.files
+        return ['{0}/{1}'.format(bucket_name, resource_file.location())
+                for resource_file in files]
+
+    def stats(self, format='json', reset=False):
+        """
+        The metrics of this process (S3 requests, bytes transferred, cache
+        lookups and checksums): a dictionary of counters and histograms, or
+        with format 'prometheus' the Prometheus text format.  With 'reset',
+        the metrics start again from zero.
+        """
+        metrics = bdkd.datastore.metrics()
+        if format == 'prometheus':
+            result = metrics.to_prometheus()
+        elif format == 'json':
+            result = metrics.snapshot()
+        else:
+            raise ValueError("Unknown format '{0}'".format(format))
+        if reset:
+            metrics.reset()
+        return result
+
+
+class _ServiceRequestHandler(SocketServer.StreamRequestHandler):
+    # Answer each line of a connection as a request, until it is closed
+    def handle(self):
+        self.server.connection_opened()
+        try:
+            for line in iter(self.rfile.readline, ''):
+                self.wfile.write(self.server.service.handle_request(line))
+                self.wfile.flush()
+        finally:
+            self.server.connection_closed()
+
+
+class ServiceServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    """
+    Server answering requests for a DatastoreService on a Unix socket, each
+    connection in its own thread.
+
+    The socket is only accessible to the user running the server.  With an
+    'idle_timeout' the server stops once it has had no connections for that
+    many seconds.
+    """
+    daemon_threads = True
+
+    def __init__(self, socket_path, service, idle_timeout=None):
+        self.socket_path = os.path.expanduser(socket_path)
+        self.service = service
+        self.timeout = idle_timeout
+        self.idle = False
+        self.__connections = 0
+        self.__connections_lock = threading.Lock()
+        if os.path.exists(self.socket_path):
+            if _socket_in_use(self.socket_path):
+                raise ValueError("A service is already listening on '{0}'"
+                        .format(self.socket_path))
+            os.remove(self.socket_path)
+        umask = os.umask(0077)
+        try:
+            SocketServer.UnixStreamServer.__init__(self, self.socket_path,
+                    _ServiceRequestHandler)
+        finally:
+            os.umask(umask)
+
+    def connection_opened(self):
+        with self.__connections_lock:
+            self.__connections += 1
+
+    def connection_closed(self):
+        with self.__connections_lock:
+            self.__connections -= 1
+
+    def handle_timeout(self):
+        with self.__connections_lock:
+            self.idle = (self.__connections == 0)
+
+    def serve(self):
+        """
+        Answer requests until interrupted or (with an idle timeout) idle.
+        """
+        try:
+            if self.timeout:
+                while not self.idle:
+                    self.handle_request()
+            else:
+                self.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.server_close()
+            if os.path.exists(self.socket_path):
+                os.remove(self.socket_path)
+
+
+def _socket_in_use(socket_path):
+    # Whether something is accepting connections on a Unix socket
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+        return True
+    except socket.error:
+        return False
+    finally:
+        sock.close()
+
+
+def request(socket_path, method, params=None):
+    """
+    Make a request of the service listening on a Unix socket, returning its
+    result (or raising a ValueError with the error of a failed request).
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        try:
+            sock.connect(os.path.expanduser(socket_path))
+        except socket.error:
+            raise ValueError("No service is listening on '{0}'".format(socket_path))
+        sock_file = sock.makefile('rwb')
+        sock_file.write(json.dumps(dict(id=1, method=method, params=params or {})) + '\n')
+        sock_file.flush()
+        response = json.loads(sock_file.readline())
+        sock_file.close()
+    finally:
+        sock.close()
+    if 'error' in response:
+        raise ValueError("{type}: {message}".format(**response['error']))
+    return response['result']
+
+
+def serve(socket_path=DEFAULT_SOCKET_PATH, idle_timeout=None):
+    """
+    Provide a DatastoreService on a Unix socket until interrupted.
+    """
+    server = ServiceServer(socket_path, DatastoreService(), idle_timeout)
+    logger.info("Serving on %s", server.socket_path)
+    server.serve()
+
+
+def run_batch(input_file, output_file, workers=4):
+    """
+    Run the requests read from a file (one JSON object per line), writing
+    each response to an output file as it completes.
+
+    Up to 'workers' requests run at once, sharing the same configuration and
+    connections; responses are written in the order of the requests.  Returns
+    the number of requests that failed.
+    """
+    datastore_service = DatastoreService()
+    requests = (line for line in iter(input_file.readline, '') if line.strip())
+    failures = 0
+    for response in bdkd.datastore.parallel_imap(datastore_service.respond,
+            requests, workers):
+        if 'error' in response:
+            failures += 1
+        output_file.write(json.dumps(response) + '\n')
+        output_file.flush()
+    return failures
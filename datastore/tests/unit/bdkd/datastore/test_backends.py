@@ -0,0 +1,460 @@
+# -*- coding: utf-8 -*-
+# Copyright 2015 Nicta
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import io
+import os
+import shutil
+import time
+import unittest
+from mock import patch
+# Load a custom configuration for unit testing
+os.environ['BDKD_DATASTORE_CONFIG'] = os.path.join(os.path.dirname(__file__),
+    '..', '..', 'conf', 'test.conf')
+import bdkd.datastore
+from bdkd.datastore import backends
+
+FIXTURES = os.path.join(os.path.dirname(__file__), '..', '..', '..', 'fixtures')
+TEST_PATH='/var/tmp/test'
+
+
+class StoreTests(object):
+    # Tests common to all ObjectStores
+
+    def test_write_head_read(self):
+        info = self.store.write('a/b.txt', io.BytesIO('hello world'), {'x': '1'})
+        self.assertEquals(info['etag'], hashlib.md5('hello world').hexdigest())
+        self.assertEquals(self.store.head('a/b.txt')['size'], 11)
+        self.assertEquals(self.store.head('a/b.txt')['metadata'], {'x': '1'})
+        self.assertEquals(self.store.head('a/c.txt'), None)
+        fh = io.BytesIO()
+        self.store.read('a/b.txt', fh, 6)
+        self.assertEquals(fh.getvalue(), 'world')
+        fh = io.BytesIO()
+        self.store.read('a/b.txt', fh, 0, 4)
+        self.assertEquals(fh.getvalue(), 'hello')
+        self.assertRaises(IOError, self.store.read, 'a/c.txt', io.BytesIO())
+
+    def test_list_delete(self):
+        for name in ['resources/x', 'resources/y/z', 'resourcesx', 'files/x/1']:
+            self.store.write(name, io.BytesIO(name))
+        self.assertEquals([name for name, info in self.store.list('resources/')],
+                ['resources/x', 'resources/y/z'])
+        self.assertEquals([name for name, info in self.store.list('resources')],
+                ['resources/x', 'resources/y/z', 'resourcesx'])
+        self.store.delete('resources/y/z')
+        self.store.delete('does/not/exist')
+        self.assertEquals([name for name, info in self.store.list()],
+                ['files/x/1', 'resources/x', 'resourcesx'])
+
+    def test_copy(self):
+        self.store.write('from', io.BytesIO('data'), {'md5sum': 'abc'})
+        other = backends.MemoryStore()
+        other.copy(self.store, 'from', 'to')
+        self.assertEquals(other.head('to')['metadata'], {'md5sum': 'abc'})
+        self.store.copy(self.store, 'from', 'again', metadata={})
+        fh = io.BytesIO()
+        self.store.read('again', fh)
+        self.assertEquals(fh.getvalue(), 'data')
+        self.assertEquals(self.store.head('again')['metadata'], {})
+
+
+class MemoryStoreTest(StoreTests, unittest.TestCase):
+
+    def setUp(self):
+        self.store = backends.MemoryStore()
+
+
+class LocalStoreTest(StoreTests, unittest.TestCase):
+
+    def setUp(self):
+        self.path = os.path.join(TEST_PATH, 'local-store')
+        if os.path.exists(self.path):
+            shutil.rmtree(self.path)
+        self.store = backends.LocalStore(self.path)
+
+    def test_files_placed_directly(self):
+        os.makedirs(os.path.join(self.path, 'files', 'data'))
+        with open(os.path.join(self.path, 'files', 'data', 'x.csv'), 'w') as fh:
+            fh.write('1,2,3\n')
+        self.assertEquals(self.store.list(), [('files/data/x.csv',
+            self.store.head('files/data/x.csv'))])
+        self.assertEquals(self.store.head('files/data/x.csv')['etag'],
+                hashlib.md5('1,2,3\n').hexdigest())
+
+    def test_delete_removes_empty_directories(self):
+        self.store.write('a/b/c', io.BytesIO('c'))
+        self.store.delete('a/b/c')
+        self.assertEquals(os.listdir(self.path), [])
+
+    def test_invalid_names(self):
+        for name in ['', '/etc/passwd', 'a/../../b', '.bdkd-meta/x']:
+            self.assertRaises(ValueError, self.store.head, name)
+
+
+class StoreRepositoryTests(object):
+    # A Repository backed by an ObjectStore, end to end
+
+    def setUp(self):
+        self.cache_path = os.path.join(TEST_PATH, 'backend-cache')
+        if os.path.exists(self.cache_path):
+            shutil.rmtree(self.cache_path)
+        self.repository = self._repository()
+        self.path = os.path.join(FIXTURES, 'FeatureCollections', 'Coastlines',
+                'Seton_etal_ESR2012_Coastlines_2012.1.gpmlz')
+
+    def _repository(self, name='backend-repository', **kwargs):
+        return bdkd.datastore.Repository(self.host, name, cache_path=self.cache_path,
+                **kwargs)
+
+    def _clear_cache(self, repository):
+        shutil.rmtree(repository.local_cache)
+
+    def test_save_get(self):
+        resource = bdkd.datastore.Resource.new('a/resource', self.path, publish=False)
+        self.repository.save(resource)
+        self.assertEquals(self.repository.list(), ['a/resource'])
+        self._clear_cache(self.repository)
+        fetched = self.repository.get('a/resource')
+        path = fetched.files[0].local_path()
+        with open(path, 'rb') as fh, open(self.path, 'rb') as original:
+            self.assertEquals(fh.read(), original.read())
+        requests = self.host.connection.requests
+        self.assertTrue(requests['PUT'] >= 2 and requests['GET'] >= 2)
+        self.repository.delete('a/resource')
+        self.assertEquals(self.repository.list(), [])
+
+    def test_save_multipart(self):
+        repository = self._repository('multipart-repository',
+                multipart_threshold=1024, part_size=1024)
+        resource = bdkd.datastore.Resource.new('parts', self.path, publish=False)
+        repository.save(resource)
+        key = repository.get_bucket().get_key(resource.files[0].location())
+        self.assertTrue('-' in key.etag)
+        self.assertEquals(key.get_metadata('md5sum'),
+                resource.files[0].meta('md5sum'))
+        self._clear_cache(repository)
+        self.assertEquals(bdkd.datastore.checksum(
+            repository.get('parts').files[0].local_path()),
+            resource.files[0].meta('md5sum'))
+
+    def test_multipart_upload_of_process(self):
+        bucket = self.host.connection.get_bucket('upload-bucket')
+        uploads = [bucket.initiate_multipart_upload('a') for _ in range(2)]
+        self.assertNotEquals(uploads[0].id, uploads[1].id)
+        self.assertTrue(bucket.get_multipart_upload('a', uploads[0].id) is uploads[0])
+        self.assertEquals(bucket.get_multipart_upload('b', uploads[0].id), None)
+        # An upload of another process is not found, and is started again
+        self.assertEquals(bucket.get_multipart_upload('a',
+            '{0}-1'.format(os.getpid() + 1)), None)
+
+    def test_streamed_bundle_md5sum(self):
+        repository = self._repository('stream-repository', stream_bundles=True,
+                part_size=1024, stale_time=0)
+        resource = bdkd.datastore.Resource.new('streamed', self.path, do_bundle=True,
+                publish=False)
+        repository.save(resource)
+        self.assertTrue(repository.flush(5))
+        key = repository.get_bucket().get_key(resource.bundle.location())
+        self._clear_cache(repository)
+        fetched = repository.get('streamed')
+        repository.refresh_resource(fetched, refresh_all=True)
+        self.assertEquals(key.get_metadata('md5sum'),
+                bdkd.datastore.checksum(fetched.bundle.local_path()))
+        # A stale but unchanged bundle is not downloaded again
+        self.host.connection.reset_requests()
+        repository.refresh_resource(fetched, refresh_all=True)
+        self.assertEquals(self.host.connection.requests['GET'], 0)
+
+    def test_streamed_bundle_md5sum_copied_in_parts(self):
+        repository = self._repository('stream-parts-repository', stream_bundles=True,
+                part_size=1024)
+        resource = bdkd.datastore.Resource.new('streamed', self.path, do_bundle=True,
+                publish=False)
+        with patch('bdkd.datastore.datastore.MAX_COPY_SIZE', 1000), \
+                patch('bdkd.datastore.datastore.COPY_PART_SIZE', 1000):
+            repository.save(resource)
+        self.assertTrue(repository.flush(5))
+        key = repository.get_bucket().get_key(resource.bundle.location())
+        self._clear_cache(repository)
+        fetched = repository.get('streamed')
+        repository.refresh_resource(fetched, refresh_all=True)
+        self.assertEquals(key.get_metadata('md5sum'),
+                bdkd.datastore.checksum(fetched.bundle.local_path()))
+        with open(fetched.files[0].local_path(), 'rb') as fh, \
+                open(self.path, 'rb') as original:
+            self.assertEquals(fh.read(), original.read())
+
+    def test_unsupported_arguments(self):
+        bucket = self.repository.get_bucket()
+        self.assertRaises(NotImplementedError, bucket.get_key, 'a',
+                version_id='version')
+        self.assertRaises(NotImplementedError, bucket.list, 'a', delimiter='/')
+        self.assertRaises(NotImplementedError, bucket.get_all_keys, prefix='a',
+                marker='b')
+        self.assertEquals(bucket.get_key('a', version_id=None), None)
+
+    def test_copy(self):
+        resource = bdkd.datastore.Resource.new('original', self.path, publish=False)
+        self.repository.save(resource)
+        other = self._repository('other-repository')
+        other.copy(resource, 'copied')
+        self._clear_cache(other)
+        self.assertEquals(bdkd.datastore.checksum(
+            other.get('copied').files[0].local_path()),
+            resource.files[0].meta('md5sum'))
+
+
+class MemoryHostTest(StoreRepositoryTests, unittest.TestCase):
+
+    def setUp(self):
+        self.host = bdkd.datastore.MemoryHost()
+        StoreRepositoryTests.setUp(self)
+
+    def test_configured_host(self):
+        self.assertTrue(isinstance(bdkd.datastore.hosts()['test-memory-host'],
+            bdkd.datastore.MemoryHost))
+
+
+class S3HostTest(unittest.TestCase):
+
+    def test_bucket(self):
+        host = bdkd.datastore.Host(access_key='access', secret_key='secret')
+        bucket = host.connection.get_bucket('s3-bucket', validate=False)
+        multipart_upload = bucket.get_multipart_upload('files/a', 'upload-id')
+        self.assertEquals((multipart_upload.bucket, multipart_upload.key_name,
+            multipart_upload.id), (bucket, 'files/a', 'upload-id'))
+        self.assertTrue(bucket.flush())
+
+
+class LocalHostTest(StoreRepositoryTests, unittest.TestCase):
+
+    def setUp(self):
+        self.store_path = os.path.join(TEST_PATH, 'local-host')
+        if os.path.exists(self.store_path):
+            shutil.rmtree(self.store_path)
+        self.host = bdkd.datastore.LocalHost(self.store_path)
+        StoreRepositoryTests.setUp(self)
+
+    def test_objects_are_files(self):
+        resource = bdkd.datastore.Resource.new('on-disk', self.path, publish=False)
+        self.repository.save(resource)
+        self.assertTrue(os.path.isfile(os.path.join(self.store_path,
+            'backend-repository', 'files', 'on-disk',
+            os.path.basename(self.path))))
+
+
+class _FailingStore(backends.MemoryStore):
+    # Fails the first 'failures' writes
+    def __init__(self, failures):
+        backends.MemoryStore.__init__(self)
+        self.failures = failures
+
+    def write(self, name, fh, metadata=None, etag=None):
+        if self.failures:
+            self.failures -= 1
+            raise IOError("Unavailable")
+        return backends.MemoryStore.write(self, name, fh, metadata, etag)
+
+
+class _OrderedStore(backends.MemoryStore):
+    # Records the order of writes, files being slower to write than others
+    def __init__(self):
+        backends.MemoryStore.__init__(self)
+        self.written = []
+
+    def write(self, name, fh, metadata=None, etag=None):
+        if name.startswith('files/'):
+            time.sleep(0.05)
+        self.written.append(name)
+        return backends.MemoryStore.write(self, name, fh, metadata, etag)
+
+
+class TieredStoreTest(StoreTests, unittest.TestCase):
+
+    def setUp(self):
+        self.path = os.path.join(TEST_PATH, 'tiered-store')
+        if os.path.exists(self.path):
+            shutil.rmtree(self.path)
+        self.remote = backends.MemoryStore()
+        self.shared = backends.LocalStore(os.path.join(self.path, 'shared'))
+        self.store = self._store()
+
+    def _store(self, **kwargs):
+        kwargs.setdefault('remote', self.remote)
+        kwargs.setdefault('retry_delay', 0)
+        return backends.TieredStore(backends.LocalStore(os.path.join(self.path, 'local')),
+                shared=self.shared, **kwargs)
+
+    def tearDown(self):
+        self.assertTrue(self.store.flush(5))
+
+    def test_write_back(self):
+        self.store = self._store(flush_workers=0)
+        self.store.write('a', io.BytesIO('a'), {'x': '1'})
+        self.assertEquals(self.remote.head('a'), None)
+        self.assertEquals(self.store.head('a')['metadata'], {'x': '1'})
+        self.assertEquals([name for name, info in self.store.list()], ['a'])
+        self.assertEquals(self.store.pending(), 1)
+        self.assertFalse(self.store.flush(0.1))
+        # Writes left by an earlier store are flushed
+        self.store = self._store()
+        self.assertTrue(self.store.flush(5))
+        self.assertEquals(self.remote.head('a')['metadata'], {'x': '1'})
+        self.assertEquals(self.shared.head('a')['etag'], self.remote.head('a')['etag'])
+        self.assertEquals(self.store.local.list(), [])
+        self.assertEquals(self.store.head('a')['metadata'], {'x': '1'})
+
+    def test_deletion_queued(self):
+        self.remote.write('a', io.BytesIO('a'))
+        self.store = self._store(flush_workers=0)
+        self.store.delete('a')
+        self.assertEquals(self.store.head('a'), None)
+        self.assertEquals(self.store.list(), [])
+        self.assertRaises(IOError, self.store.read, 'a', io.BytesIO())
+        self.assertNotEquals(self.remote.head('a'), None)
+        self.store = self._store()
+        self.assertTrue(self.store.flush(5))
+        self.assertEquals(self.remote.head('a'), None)
+        self.assertEquals(os.listdir(self.store.queue_path), [])
+
+    def test_read_from_shared(self):
+        info = self.remote.write('a', io.BytesIO('remote'))
+        # The shared tier is read only if it holds the remote version
+        self.shared.write('a', io.BytesIO('shared'), etag=info['etag'])
+        fh = io.BytesIO()
+        self.store.read('a', fh)
+        self.assertEquals(fh.getvalue(), 'shared')
+        self.shared.write('a', io.BytesIO('stale!'))
+        fh = io.BytesIO()
+        self.store.read('a', fh)
+        self.assertEquals(fh.getvalue(), 'remote')
+
+    def test_flush_retried(self):
+        self.store = self._store(remote=_FailingStore(2))
+        self.store.write('a', io.BytesIO('a'))
+        self.assertTrue(self.store.flush(5))
+        self.assertNotEquals(self.store.remote.head('a'), None)
+
+    def test_retry_does_not_hold_up_worker(self):
+        self.store = self._store(remote=_FailingStore(1), flush_workers=1,
+                retry_delay=1)
+        self.store.write('a', io.BytesIO('a'))
+        self.store.write('b', io.BytesIO('b'))
+        # The only worker flushes 'b' while 'a' waits to be retried
+        deadline = time.time() + 0.5
+        while not self.store.remote.head('b') and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertNotEquals(self.store.remote.head('b'), None)
+        self.assertEquals(self.store.remote.head('a'), None)
+        self.assertTrue(self.store.flush(5))
+        self.assertNotEquals(self.store.remote.head('a'), None)
+
+    def test_barrier_flushed_after_earlier_writes(self):
+        self.store = self._store(remote=_OrderedStore(), flush_workers=4,
+                is_barrier=lambda name: name.startswith('resources/'))
+        for name in ['files/r/1', 'files/r/2', 'resources/r', 'files/s/1']:
+            self.store.write(name, io.BytesIO(name))
+        self.assertTrue(self.store.flush(5))
+        written = self.store.remote.written
+        self.assertEquals(sorted(written), ['files/r/1', 'files/r/2', 'files/s/1',
+            'resources/r'])
+        self.assertTrue(written.index('resources/r') > written.index('files/r/1'))
+        self.assertTrue(written.index('resources/r') > written.index('files/r/2'))
+
+    def test_flush_given_up(self):
+        self.store = self._store(remote=_FailingStore(100), max_attempts=2,
+                is_barrier=lambda name: name.startswith('resources/'))
+        self.store.write('files/a', io.BytesIO('a'))
+        self.store.write('resources/a', io.BytesIO('{}'))
+        self.assertRaises(IOError, self.store.flush, 5)
+        self.assertEquals(sorted(self.store.failed), ['files/a', 'resources/a'])
+        self.assertEquals(self.store.remote.failures, 98)
+        # Still queued, for the next store of the local tier
+        self.store.close()
+        self.store = self._store()
+        self.assertTrue(self.store.flush(5))
+        self.assertEquals([name for name, info in self.remote.list()],
+                ['files/a', 'resources/a'])
+
+    def test_close(self):
+        self.store = self._store(remote=_FailingStore(100), retry_delay=0.01)
+        self.store.write('a', io.BytesIO('a'))
+        self.store.close()
+        self.assertEquals(self.store.remote.head('a'), None)
+        self.store = self._store()
+
+    def test_bucket_store(self):
+        # A tier in front of a bucket, written as a multipart upload
+        host = bdkd.datastore.MemoryHost()
+        bucket = host.connection.get_bucket('bucket')
+        self.store = self._store(remote=backends.BucketStore(bucket,
+            multipart_threshold=4, part_size=4))
+        self.store.write('a', io.BytesIO('0123456789'), {'x': '1'})
+        self.assertTrue(self.store.flush(5))
+        key = bucket.get_key('a')
+        self.assertTrue(key.etag.endswith('-3"'))
+        self.assertEquals(key.get_metadata('md5sum'), hashlib.md5('0123456789').hexdigest())
+        self.assertEquals(key.get_metadata('x'), '1')
+        fh = io.BytesIO()
+        self.store.remote.read('a', fh, 2, 5)
+        self.assertEquals(fh.getvalue(), '2345')
+        self.assertEquals([name for name, info in self.store.remote.list()], ['a'])
+
+
+class TieredHostTest(StoreRepositoryTests, unittest.TestCase):
+
+    def setUp(self):
+        self.store_path = os.path.join(TEST_PATH, 'tiered-host')
+        if os.path.exists(self.store_path):
+            shutil.rmtree(self.store_path)
+        self.backing_host = bdkd.datastore.MemoryHost()
+        self.host = bdkd.datastore.TieredHost(self.store_path, self.backing_host)
+        StoreRepositoryTests.setUp(self)
+
+    def test_save_multipart(self):
+        # Once flushed, small objects are written to the backing host whole,
+        # keeping their md5sum
+        repository = self._repository('multipart-repository',
+                multipart_threshold=1024, part_size=1024)
+        resource = bdkd.datastore.Resource.new('parts', self.path, publish=False)
+        repository.save(resource)
+        self.assertTrue(repository.flush(5))
+        key = repository.get_bucket().get_key(resource.files[0].location())
+        self.assertEquals(key.get_metadata('md5sum'),
+                resource.files[0].meta('md5sum'))
+        self._clear_cache(repository)
+        self.assertEquals(bdkd.datastore.checksum(
+            repository.get('parts').files[0].local_path()),
+            resource.files[0].meta('md5sum'))
+
+    def test_flushed_to_backing_host(self):
+        resource = bdkd.datastore.Resource.new('flushed', self.path, publish=False)
+        self.repository.save(resource)
+        self.assertTrue(self.repository.flush(5))
+        backing = bdkd.datastore.Repository(self.backing_host, 'backend-repository',
+                cache_path=os.path.join(TEST_PATH, 'backing-cache'))
+        self.assertEquals(backing.list(), ['flushed'])
+        self.assertEquals(bdkd.datastore.checksum(
+            backing.get('flushed').files[0].local_path()),
+            resource.files[0].meta('md5sum'))
+
+    def test_configured_host(self):
+        host = bdkd.datastore.hosts()['test-tiered-host']
+        self.assertTrue(isinstance(host, bdkd.datastore.TieredHost))
+        self.assertTrue(host.backing_host is bdkd.datastore.hosts()['test-memory-host'])
+        # The same host (and its flush threads) is kept when reloaded
+        bdkd.datastore.datastore._config_stamp = None
+        self.assertTrue(bdkd.datastore.hosts()['test-tiered-host'] is host)
@@ -14,9 +14,19 @@
 # limitations under the License.
 
 import codecs
+import gzip
+import hashlib
+import io
+import tarfile
 import unittest
-from mock import MagicMock
-import os, shutil, re
+import zipfile
+from mock import ANY, MagicMock, patch
+import json
+import os, shutil, re, time
+import posixpath
+import socket
+import struct
+import threading
 import glob
 
 # Load a custom configuration for unit testing
@@ -29,6 +39,14 @@ FIXTURES = os.path.join(os.path.dirname(__file__),
 TEST_PATH='/var/tmp/test'
 
 
+def _has_numpy():
+    try:
+        import numpy
+    except ImportError:
+        return False
+    return True
+
+
 class UtilitiesTest(unittest.TestCase):
 
     def test_common_directory_single(self):
@@ -47,6 +65,41 @@ class UtilitiesTest(unittest.TestCase):
         self.assertEquals(bdkd.datastore.common_directory(['', '']),
                 '')
 
+    def test_parallel_imap_order(self):
+        def slow_square(x):
+            time.sleep(0.001 * (10 - x))
+            return x * x
+        self.assertEquals(list(bdkd.datastore.parallel_imap(slow_square,
+            range(10), 4)), [x * x for x in range(10)])
+
+    def test_parallel_imap_error(self):
+        def fail_on_three(x):
+            if x == 3:
+                raise ValueError(x)
+            return x
+        results = bdkd.datastore.parallel_imap(fail_on_three, range(10), 3)
+        self.assertEquals([next(results) for i in range(3)], [0, 1, 2])
+        self.assertRaises(ValueError, next, results)
+
+    def test_hash_files(self):
+        paths = glob.glob(os.path.join(FIXTURES, 'FeatureCollections',
+            'Coastlines', 'Shapefile', '*.*'))
+        items = [(path, {}) for path in paths]
+        results = list(bdkd.datastore.hash_files(items, threads=3))
+        self.assertEquals([path for path, meta in results], paths)
+        for path, meta in results:
+            self.assertEquals(meta, bdkd.datastore.local_file_meta(path, {}))
+            self.assertEquals(meta['md5sum'], bdkd.datastore.checksum(path))
+
+    def test_transfer_journal(self):
+        journal = bdkd.datastore.TransferJournal(os.path.join(TEST_PATH, 'journal-test'))
+        self.assertEquals(journal.get('upload:a'), None)
+        journal.put('upload:a', dict(parts=[1, 2]))
+        self.assertEquals(journal.get('upload:a')['parts'], [1, 2])
+        journal.remove('upload:a')
+        journal.remove('upload:a')
+        self.assertEquals(journal.get('upload:a'), None)
+
 
 class ConfigurationTest(unittest.TestCase):
     def test_config_settings(self):
@@ -67,6 +120,154 @@ class ConfigurationTest(unittest.TestCase):
         self.assertTrue(bdkd.datastore.repository('test-repository'))
         self.assertFalse(bdkd.datastore.repository('does-not-exist'))
 
+    def test_config_cached(self):
+        # The configuration is only loaded again if its files change
+        self.assertTrue(bdkd.datastore.repository('test-repository') is
+                bdkd.datastore.repository('test-repository'))
+
+    def test_config_loaded_once_by_threads(self):
+        # Threads needing the configuration at once see it whole, loaded once
+        bdkd.datastore.datastore._config_stamp = None
+        found = []
+        start = threading.Event()
+
+        def lookup():
+            start.wait()
+            found.append(bdkd.datastore.repository('test-repository'))
+        threads = [threading.Thread(target=lookup) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        start.set()
+        for thread in threads:
+            thread.join()
+        self.assertEquals(len(found), 8)
+        self.assertTrue(found[0] is not None)
+        self.assertTrue(all(repository is found[0] for repository in found))
+
+
+class RequestThrottleTest(unittest.TestCase):
+
+    class ResponseError(Exception):
+        def __init__(self, status):
+            super(RequestThrottleTest.ResponseError, self).__init__(status)
+            self.status = status
+
+    @classmethod
+    def _failing(cls, errors, result='done'):
+        # A function raising each of the given errors in turn, then returning
+        calls = []
+
+        def func():
+            calls.append(None)
+            if len(calls) <= len(errors):
+                raise errors[len(calls) - 1]
+            return result
+        return func, calls
+
+    def test_retry_transient(self):
+        throttle = bdkd.datastore.RequestThrottle(backoff_base=0, max_concurrency=8)
+        func, calls = RequestThrottleTest._failing([
+            RequestThrottleTest.ResponseError(503), socket.error('reset')])
+        self.assertEquals(throttle.call(func), 'done')
+        self.assertEquals(len(calls), 3)
+        # The host signalled that it was overloaded
+        self.assertTrue(throttle.concurrency < 8)
+
+    def test_no_retry(self):
+        throttle = bdkd.datastore.RequestThrottle(backoff_base=0, max_retries=1)
+        func, calls = RequestThrottleTest._failing([
+            RequestThrottleTest.ResponseError(404)])
+        self.assertRaises(RequestThrottleTest.ResponseError, throttle.call, func)
+        self.assertEquals(len(calls), 1)
+        func, calls = RequestThrottleTest._failing([
+            RequestThrottleTest.ResponseError(500)] * 2)
+        self.assertRaises(RequestThrottleTest.ResponseError, throttle.call, func)
+        self.assertEquals(len(calls), 2)
+
+    def test_request_rate(self):
+        throttle = bdkd.datastore.RequestThrottle(request_rate=50, burst=1)
+        start = time.time()
+        for i in range(5):
+            throttle.call(lambda: None)
+        self.assertTrue(time.time() - start >= 0.07)
+
+
+class MetricsTest(unittest.TestCase):
+
+    def test_counters_and_histograms(self):
+        metrics = bdkd.datastore.Metrics(buckets=(0.1, 1))
+        metrics.increment('cache_lookups_total', result='hit')
+        metrics.increment('cache_lookups_total', 2, result='hit')
+        metrics.observe('s3_request_seconds', 0.5, operation='GET')
+        metrics.observe('s3_request_seconds', 2, operation='GET')
+        snapshot = metrics.snapshot()
+        self.assertEquals(snapshot['counters'], [dict(name='cache_lookups_total',
+            labels=dict(result='hit'), value=3)])
+        histogram = snapshot['histograms'][0]
+        self.assertEquals(histogram['buckets'], [(0.1, 0), (1, 1)])
+        self.assertEquals((histogram['sum'], histogram['count']), (2.5, 2))
+        text = metrics.to_prometheus()
+        self.assertTrue('bdkd_datastore_cache_lookups_total{result="hit"} 3\n' in text)
+        self.assertTrue('bdkd_datastore_s3_request_seconds_bucket{operation="GET",le="+Inf"} 2\n'
+                in text)
+        metrics.reset()
+        self.assertEquals(metrics.snapshot(), dict(counters=[], histograms=[]))
+
+    def test_request_metrics(self):
+        metrics = bdkd.datastore.Metrics()
+        throttle = bdkd.datastore.RequestThrottle(backoff_base=0)
+        func, calls = RequestThrottleTest._failing([socket.error('reset')])
+        func.__name__ = 'get_key'
+        with patch('bdkd.datastore.datastore._metrics', metrics):
+            throttle.call(func)
+        snapshot = metrics.snapshot()
+        self.assertEquals(snapshot['counters'], [dict(name='s3_retries_total',
+            labels=dict(operation='HEAD'), value=1)])
+        self.assertEquals(snapshot['histograms'][0]['labels'], dict(operation='HEAD'))
+
+    def test_statsd_sink(self):
+        server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        server.bind(('127.0.0.1', 0))
+        server.settimeout(5)
+        sink = bdkd.datastore.StatsdSink('127.0.0.1', server.getsockname()[1])
+        metrics = bdkd.datastore.Metrics(sinks=[sink])
+        metrics.increment('transfer_bytes_total', 100, direction='download')
+        metrics.observe('checksum_seconds', 0.25)
+        self.assertEquals(server.recv(1024),
+                'bdkd_datastore.transfer_bytes_total.download:100|c')
+        self.assertEquals(server.recv(1024), 'bdkd_datastore.checksum_seconds:250.000|ms')
+        server.close()
+
+    def test_prometheus_file_sink(self):
+        path = os.path.join(TEST_PATH, 'metrics', 'bdkd_datastore.prom')
+        metrics = bdkd.datastore.Metrics(sinks=[bdkd.datastore.PrometheusFileSink(path)])
+        metrics.increment('s3_errors_total', operation='PUT')
+        metrics.flush()
+        with open(path) as fh:
+            self.assertEquals(fh.read(), metrics.to_prometheus())
+
+
+class BandwidthLimiterTest(unittest.TestCase):
+
+    def test_bulk_limited(self):
+        limiter = bdkd.datastore.BandwidthLimiter(1000)
+        start = time.time()
+        for i in range(3):
+            limiter.consume(100, bdkd.datastore.PRIORITY_BULK)
+        self.assertTrue(time.time() - start < 0.05)
+        limiter.consume(900, bdkd.datastore.PRIORITY_BULK)
+        self.assertTrue(time.time() - start >= 0.15)
+
+    def test_foreground_ahead_of_bulk(self):
+        limiter = bdkd.datastore.BandwidthLimiter(1000)
+        start = time.time()
+        # Interactive transfers may run a second ahead of the limit...
+        limiter.consume(1800, bdkd.datastore.PRIORITY_FOREGROUND)
+        self.assertTrue(time.time() - start < 0.05)
+        # ...which bulk transfers repay
+        limiter.consume(100, bdkd.datastore.PRIORITY_BULK)
+        self.assertTrue(time.time() - start >= 0.85)
+
 
 class HostTest(unittest.TestCase):
 
@@ -80,6 +281,11 @@ class HostTest(unittest.TestCase):
         self.assertTrue(host.connection)
         self.assertTrue(host.netloc)
 
+    def test_host_connection_lazy(self):
+        host = bdkd.datastore.Host('access-key', 'secret-key', host='hostname')
+        self.assertEquals(host._Host__connection, None)
+        self.assertTrue(host.connection is host.connection)
+
 
 class RepositoryTest(unittest.TestCase):
 
@@ -148,6 +354,333 @@ class RepositoryTest(unittest.TestCase):
         self.repository.refresh_resource(self.resource)
         self.assertTrue(self.resource)
 
+    @classmethod
+    def _remote_resource(cls, repository, name, md5sums, metadata=None):
+        # A Resource as loaded from a repository, with Files of the given
+        # names and md5sums
+        resource = bdkd.datastore.Resource(name, [], metadata=metadata or {})
+        resource.repository = repository
+        for file_name, md5sum in sorted(md5sums.items()):
+            resource.files.append(bdkd.datastore.ResourceFile(None,
+                resource=resource, metadata={'md5sum': md5sum,
+                    'location': posixpath.join('files', name, file_name)}))
+        return resource
+
+    def test_refresh_resource_selected_files(self):
+        repository = bdkd.datastore.Repository(MagicMock(), 'refresh-test')
+        repository.get_bucket().get_key.return_value = None
+        resource = RepositoryTest._remote_resource(repository, 'selected',
+                {'a.txt': '1', 'b.txt': '2', 'c.csv': '3'})
+        refreshed = []
+        repository._refresh_resource_file = (lambda resource_file,
+                priority=None: refreshed.append(resource_file.storage_location()))
+        self.assertEquals(repository.refresh_resource(resource), [])
+        repository.refresh_resource(resource, files=['b.txt'])
+        self.assertEquals(refreshed, ['b.txt'])
+        del refreshed[:]
+        repository.refresh_resource(resource, files=[resource.files[0]],
+                match='*.txt')
+        self.assertEquals(refreshed, ['a.txt'])
+        del refreshed[:]
+        repository.refresh_resource(resource, match='*.txt')
+        self.assertEquals(refreshed, ['a.txt', 'b.txt'])
+        del refreshed[:]
+        repository.refresh_resource(resource, refresh_all=True)
+        self.assertEquals(len(refreshed), 3)
+
+    def test_refresh_unified_resource_pinned(self):
+        repository = bdkd.datastore.Repository(MagicMock(), 'unified-test')
+        RepositoryTest._clear_local(repository)
+        resource = RepositoryTest._remote_resource(repository, 'unified',
+                {'a.txt': 'old', 'b.txt': 'old'}, metadata={'unified': True})
+        # The object of a.txt has been saved since the meta-data was read
+        etags = {'a.txt': 'new', 'b.txt': 'old'}
+        current = RepositoryTest._remote_resource(None, 'unified',
+                etags, metadata={'unified': True})
+        manifest_key = MagicMock()
+        manifest_key.etag = '"manifest"'
+        manifests = [resource.to_json(), current.to_json()]
+        manifest_key.get_contents_to_file.side_effect = (lambda fh:
+                fh.write(manifests.pop(0)))
+        repository.get_bucket().get_key.side_effect = (lambda key_name:
+                manifest_key if key_name == 'resources/unified' else None)
+        refreshed = []
+
+        def refresh_resource_file(resource_file, priority=None):
+            refreshed.append(resource_file.storage_location())
+            resource_file.path = os.path.join(TEST_PATH, resource_file.location())
+            repository._etags[resource_file.path] = etags[
+                    resource_file.storage_location()]
+        repository._refresh_resource_file = refresh_resource_file
+        resource_file = resource.files[0]
+        repository.refresh_resource(resource, files=[resource_file])
+        # Only the file read is refreshed, and the meta-data catches up with it
+        self.assertEquals(refreshed, ['a.txt'])
+        self.assertEquals(manifest_key.get_contents_to_file.call_count, 2)
+        self.assertTrue(resource_file is resource.files[0])
+        self.assertEquals(resource_file.meta('md5sum'), 'new')
+        RepositoryTest._clear_local(repository)
+
+    def test_resource_versions(self):
+        self.repository.save(self.resource)
+        first_version = self.resource.version
+        self.resource.metadata['description'] = 'Changed'
+        self.repository.save(self.resource, overwrite=True)
+        versions = self.repository.versions(self.resource_name)
+        self.assertEquals(versions, [first_version, self.resource.version])
+        self.assertEquals(self.repository.get(self.resource_name).version,
+                self.resource.version)
+        snapshot = self.repository.get(self.resource_name, version=first_version)
+        self.assertTrue(snapshot.pinned)
+        self.assertFalse('description' in snapshot.metadata)
+        self.assertEquals(self.repository.get(self.resource_name,
+            version='does-not-exist'), None)
+        self.repository.delete(self.resource)
+        self.assertEquals(self.repository.versions(self.resource_name), [])
+
+    def test_pinned_resource_files(self):
+        repository = bdkd.datastore.Repository(MagicMock(), 'pinned-test')
+        RepositoryTest._clear_local(repository)
+        resource = RepositoryTest._remote_resource(repository, 'pinned',
+                {'a.txt': 'a-md5', 'b.txt': 'b-md5'}).pin()
+        resource.files[0].metadata['version_id'] = 'a-version'
+        keys = {}
+
+        def get_key(key_name, version_id=None):
+            keys[key_name] = version_id
+            # The recorded object version is unchanged; the current one is not
+            key = MagicMock(etag='"a-md5"' if version_id else '"changed"')
+            key.get_contents_to_file.side_effect = lambda fh: fh.write('data')
+            return key
+        repository.get_bucket().get_key.side_effect = get_key
+        # Only the Files are read: the meta-data is not reloaded
+        self.assertEquals(repository.refresh_resource(resource,
+            files=['a.txt']), resource.files[:1])
+        self.assertEquals(keys, {'files/pinned/a.txt': 'a-version'})
+        # Without an object version, a File that has changed cannot be read
+        self.assertRaises(ValueError, resource.files[1].local_path)
+        RepositoryTest._clear_local(repository)
+
+    def test_save_content_addressed(self):
+        repository = bdkd.datastore.Repository(MagicMock(), 'blob-test',
+                content_addressed=True)
+        RepositoryTest._clear_local(repository)
+        bucket = repository.get_bucket()
+        bucket.list.return_value = []
+        md5sum = self.resource.files[0].metadata['md5sum']
+        # The blob is already stored (e.g. by another Resource)
+        blob_key = MagicMock(etag='"{0}"'.format(md5sum), metadata={}, size=10)
+        bucket.get_key.side_effect = (lambda key_name:
+                blob_key if key_name == 'blobs/' + md5sum else None)
+        repository.save(self.resource)
+        self.assertEquals(self.resource.files[0].meta('blob'), md5sum)
+        self.assertFalse(blob_key.set_contents_from_filename.called)
+        # It is only made young again, by copying it onto itself
+        bucket.copy_key.assert_called_once_with('blobs/' + md5sum, bucket.name,
+                'blobs/' + md5sum, metadata={})
+        bucket.copy_key.reset_mock()
+        # Copying and deleting touch only the meta-data (and the blob's age)
+        repository.copy(self.resource, 'copied')
+        self.assertEquals(set(call[0][0] for call in bucket.copy_key.call_args_list),
+                set(['blobs/' + md5sum]))
+        repository.delete(self.resource)
+        self.assertFalse('blobs/' + md5sum in [call[0][0]
+            for call in bucket.new_key.call_args_list])
+        RepositoryTest._clear_local(repository)
+
+    def test_collect_garbage(self):
+        repository = bdkd.datastore.Repository(MagicMock(), 'gc-test')
+        old, young = '2015-01-01T00:00:00.000Z', time.strftime(
+                '%Y-%m-%dT%H:%M:%S.000Z', time.gmtime())
+        manifest = MagicMock()
+        manifest.name = 'resources/kept'
+        manifest.get_contents_as_string.return_value = json.dumps(dict(
+            name='kept', files=[dict(location='files/kept/a', blob='used')]))
+        listing = {
+                'blobs/': [MagicMock(last_modified=old), MagicMock(last_modified=old),
+                    MagicMock(last_modified=young)],
+                'resources/': [manifest],
+                'versions/': []}
+        for key, name in zip(listing['blobs/'], ['used', 'unused', 'new']):
+            key.name = 'blobs/' + name
+        bucket = repository.get_bucket()
+        bucket.list.side_effect = lambda prefix: listing[prefix]
+        self.assertEquals(repository.collect_garbage(dry_run=True), ['blobs/unused'])
+        self.assertFalse(bucket.delete_keys.called)
+        self.assertEquals(repository.collect_garbage(), ['blobs/unused'])
+        bucket.delete_keys.assert_called_once_with(['blobs/unused'])
+
+    def test_collect_garbage_during_save(self):
+        repository = bdkd.datastore.Repository(bdkd.datastore.MemoryHost(),
+                'gc-race-test', content_addressed=True)
+        RepositoryTest._clear_local(repository)
+        repository.save(self.resource)
+        blob = 'blobs/' + self.resource.files[0].meta('blob')
+        repository.delete(self.resource)
+        time.sleep(0.01)
+        # A save re-using the unreferenced blob runs after it is listed, and
+        # writes its meta-data after the collector has read the meta-data
+        reused = ResourceTest.fixture()
+        parallel_imap = bdkd.datastore.parallel_imap
+
+        def racing_parallel_imap(func, items, threads, queue_size=None):
+            results = list(parallel_imap(func, items, threads, queue_size))
+            with patch('bdkd.datastore.datastore.parallel_imap', parallel_imap):
+                repository.save(reused)
+            return results
+        with patch('bdkd.datastore.datastore.parallel_imap', racing_parallel_imap):
+            self.assertEquals(repository.collect_garbage(min_age=0), [])
+        self.assertTrue(repository.get_bucket().get_key(blob))
+        repository.delete(reused)
+        time.sleep(0.01)
+        self.assertEquals(repository.collect_garbage(min_age=0), [blob])
+        RepositoryTest._clear_local(repository)
+
+    def test_download_resumed(self):
+        repository = bdkd.datastore.Repository(MagicMock(), 'resume-test')
+        RepositoryTest._clear_local(repository)
+        resource = RepositoryTest._remote_resource(repository, 'resumed',
+                {'a.txt': 'a-md5'})
+        dest_path = repository._resource_file_dest_path(resource.files[0])
+        bdkd.datastore.mkdir_p(os.path.dirname(dest_path))
+        with open(dest_path + '.part', 'w') as fh:
+            fh.write('abc')
+        md5sum = hashlib.md5('abcdef').hexdigest()
+        repository.journal.put('download:' + dest_path, dict(etag=md5sum))
+        key = MagicMock(etag='"{0}"'.format(md5sum), size=6)
+        key.get_contents_to_file.side_effect = (lambda fh, headers=None:
+                fh.write('def'))
+        repository.get_bucket().get_key.return_value = key
+        self.assertEquals(resource.files[0].local_path(), dest_path)
+        key.get_contents_to_file.assert_called_once_with(ANY,
+                headers={'Range': 'bytes=3-'})
+        with open(dest_path) as fh:
+            self.assertEquals(fh.read(), 'abcdef')
+        self.assertFalse(os.path.exists(dest_path + '.part'))
+        self.assertEquals(repository.journal.get('download:' + dest_path), None)
+        RepositoryTest._clear_local(repository)
+
+    def test_download_resumed_checked(self):
+        repository = bdkd.datastore.Repository(MagicMock(), 'resume-test')
+        RepositoryTest._clear_local(repository)
+        resource = RepositoryTest._remote_resource(repository, 'resumed',
+                {'a.txt': 'a-md5'})
+        dest_path = repository._resource_file_dest_path(resource.files[0])
+        bdkd.datastore.mkdir_p(os.path.dirname(dest_path))
+        md5sum = hashlib.md5('abcdef').hexdigest()
+        # The partial file was damaged since it was written
+        with open(dest_path + '.part', 'w') as fh:
+            fh.write('xyz')
+        repository.journal.put('download:' + dest_path, dict(etag=md5sum))
+        key = MagicMock(etag='"{0}"'.format(md5sum), size=6)
+        key.get_contents_to_file.side_effect = (lambda fh, headers=None:
+                fh.write('abcdef'[int(headers['Range'][6:-1]):] if headers
+                    else 'abcdef'))
+        repository.get_bucket().get_key.return_value = key
+        with open(resource.files[0].local_path()) as fh:
+            self.assertEquals(fh.read(), 'abcdef')
+        self.assertEquals(key.get_contents_to_file.call_count, 2)
+        self.assertEquals(repository.journal.get('download:' + dest_path), None)
+        RepositoryTest._clear_local(repository)
+
+    def test_download_retried(self):
+        repository = bdkd.datastore.Repository(MagicMock(), 'retry-test')
+        repository.throttle = bdkd.datastore.RequestThrottle(backoff_base=0)
+        RepositoryTest._clear_local(repository)
+        resource = RepositoryTest._remote_resource(repository, 'retried',
+                {'a.txt': 'a-md5'})
+        key = MagicMock(etag='"{0}"'.format(hashlib.md5('abcdef').hexdigest()),
+                size=6)
+        ranges = []
+
+        def get_contents_to_file(fh, headers=None):
+            # The connection is reset after part of the object is received
+            ranges.append(headers)
+            if not headers:
+                fh.write('abc')
+                raise socket.error('reset')
+            fh.write('def')
+        key.get_contents_to_file.side_effect = get_contents_to_file
+        repository.get_bucket().get_key.return_value = key
+        with open(resource.files[0].local_path()) as fh:
+            self.assertEquals(fh.read(), 'abcdef')
+        self.assertEquals(ranges, [None, {'Range': 'bytes=3-'}])
+        RepositoryTest._clear_local(repository)
+
+    def test_upload_resumed(self):
+        repository = bdkd.datastore.Repository(MagicMock(), 'multipart-test',
+                part_size=4, multipart_threshold=8)
+        RepositoryTest._clear_local(repository)
+        src_path = os.path.join(TEST_PATH, 'multipart-test-source')
+        with open(src_path, 'w') as fh:
+            fh.write('0123456789')
+        md5sum = bdkd.datastore.checksum(src_path)
+        # The first part was uploaded before the upload was interrupted
+        repository.journal.put('multipart:files/r/a', dict(path=src_path,
+            size=10, md5sum=md5sum, upload_id='upload-id', part_size=4, parts=[1]))
+        bucket = repository.get_bucket()
+        bucket.get_key.return_value = None
+        repository._Repository__upload('files/r/a', src_path)
+        bucket.get_multipart_upload.assert_called_once_with('files/r/a', 'upload-id')
+        multipart_upload = bucket.get_multipart_upload.return_value
+        self.assertEquals([(call[0][1], call[1]['size']) for call in
+            multipart_upload.upload_part_from_file.call_args_list], [(2, 4), (3, 2)])
+        self.assertTrue(multipart_upload.complete_upload.called)
+        self.assertFalse(bucket.initiate_multipart_upload.called)
+        self.assertEquals(repository.journal.get('multipart:files/r/a'), None)
+        # Once uploaded, the file is not checked again until the save completes
+        bucket.get_key.reset_mock()
+        repository._Repository__upload('files/r/a', src_path)
+        self.assertFalse(bucket.get_key.called)
+        os.remove(src_path)
+        RepositoryTest._clear_local(repository)
+
+    def test_upload_restarted(self):
+        repository = bdkd.datastore.Repository(MagicMock(), 'multipart-test',
+                part_size=4, multipart_threshold=8)
+        RepositoryTest._clear_local(repository)
+        src_path = os.path.join(TEST_PATH, 'multipart-test-source')
+        with open(src_path, 'w') as fh:
+            fh.write('0123456789')
+        md5sum = bdkd.datastore.checksum(src_path)
+        # The upload was aborted by the host since it was interrupted
+        repository.journal.put('multipart:files/r/a', dict(path=src_path,
+            size=10, md5sum=md5sum, upload_id='expired-id', part_size=4, parts=[1]))
+        bucket = repository.get_bucket()
+        bucket.get_key.return_value = None
+        new_upload = bucket.initiate_multipart_upload.return_value
+        new_upload.id = 'new-id'
+        error = Exception('NoSuchUpload')
+        error.status, error.error_code = 404, 'NoSuchUpload'
+        bucket.get_multipart_upload.return_value.upload_part_from_file.side_effect = error
+        repository._Repository__upload('files/r/a', src_path)
+        self.assertEquals([call[0][1] for call in
+            new_upload.upload_part_from_file.call_args_list], [1, 2, 3])
+        self.assertTrue(new_upload.complete_upload.called)
+        self.assertEquals(repository.journal.get('multipart:files/r/a'), None)
+        os.remove(src_path)
+        RepositoryTest._clear_local(repository)
+
+    def test_failed_save_forgets_uploads(self):
+        repository = bdkd.datastore.Repository(bdkd.datastore.MemoryHost(),
+                'forget-test')
+        RepositoryTest._clear_local(repository)
+        repository.save(self.resource)
+        key_name = self.resource.files[0].location()
+        # The Files are uploaded before the save fails
+        self.assertRaises(ValueError, repository.save, self.resource)
+        self.assertEquals(repository.journal.get('upload:' + key_name), None)
+        RepositoryTest._clear_local(repository)
+
+    def test_delete_forgets_upload(self):
+        self.repository.save(self.resource)
+        # As left by a later save of the Resource that was interrupted
+        key_name = self.resource.files[0].location()
+        self.repository.journal.put('upload:' + key_name, dict(
+            path=self.resource.files[0].path, md5sum='md5'))
+        self.repository.delete(self.resource)
+        self.assertEquals(self.repository.journal.get('upload:' + key_name), None)
+
     def test_delete_resource(self):
         self.assertEquals(self.repository.get(self.resource_name), None)
         self.repository.save(self.resource)
@@ -163,6 +696,212 @@ class RepositoryTest(unittest.TestCase):
         self.repository.delete(self.resource, True)
         self.assertFalse(self.resource.repository)
 
+    def test_save_reads_new_files_while_uploading(self):
+        host = bdkd.datastore.MemoryHost()
+        repository = bdkd.datastore.Repository(host, 'pipeline-test',
+                cache_path=os.path.join(TEST_PATH, 'pipeline-cache'))
+        RepositoryTest._clear_local(repository)
+        files_path = os.path.join(TEST_PATH, 'pipeline-files')
+        if os.path.exists(files_path):
+            shutil.rmtree(files_path)
+        os.makedirs(files_path)
+        paths = []
+        for index in range(30):
+            paths.append(os.path.join(files_path, '{0:02d}'.format(index)))
+            with open(paths[-1], 'w') as fh:
+                fh.write(str(index))
+        resource = bdkd.datastore.Resource.new('pipelined', paths, publish=False)
+        self.assertTrue(all(resource_file.local_meta_pending
+            for resource_file in resource.files))
+        # Each file is read with the uploads made so far
+        uploads_when_read = []
+        local_file_meta = bdkd.datastore.local_file_meta
+
+        def recording_local_file_meta(path, meta):
+            uploads_when_read.append(host.connection.requests['PUT'])
+            return local_file_meta(path, meta)
+        with patch('bdkd.datastore.datastore.local_file_meta',
+                recording_local_file_meta):
+            repository.save(resource, upload_threads=1)
+        self.assertEquals(len(uploads_when_read), 30)
+        self.assertEquals(uploads_when_read[0], 0)
+        self.assertTrue(uploads_when_read[-1] > 0)
+        for path, resource_file in zip(paths, resource.files):
+            self.assertFalse(resource_file.local_meta_pending)
+            self.assertEquals(resource_file.meta('md5sum'),
+                    bdkd.datastore.checksum(path))
+        shutil.rmtree(files_path)
+
+    def test_new_file_meta_read_when_used(self):
+        resource = bdkd.datastore.Resource.new('lazy', self.resource.files[0].path,
+                publish=False)
+        resource_file = resource.files[0]
+        self.assertTrue(resource_file.local_meta_pending)
+        self.assertEquals(resource_file.metadata['md5sum'],
+                bdkd.datastore.checksum(resource_file.path))
+        self.assertFalse(resource_file.local_meta_pending)
+
+    def test_save_reuses_md5sum(self):
+        repository = bdkd.datastore.Repository(MagicMock(), 'upload-test')
+        RepositoryTest._clear_local(repository)
+        bucket = repository.get_bucket()
+        bucket.list.return_value = []
+        file_key = MagicMock(etag='"stale"')
+        bucket.get_key.side_effect = (lambda key_name:
+                file_key if key_name.startswith('files/') else None)
+        md5sum = self.resource.files[0].metadata['md5sum']
+        with patch('bdkd.datastore.datastore.checksum') as checksum:
+            repository.save(self.resource)
+            self.assertFalse(checksum.called)
+        file_key.get_md5_from_hexdigest.assert_any_call(md5sum)
+        file_key.set_contents_from_filename.assert_any_call(
+                self.resource.files[0].path,
+                md5=file_key.get_md5_from_hexdigest.return_value)
+        RepositoryTest._clear_local(repository)
+
+    def test_save_cache_mode_link(self):
+        repository = bdkd.datastore.Repository(None, 'link-test',
+                cache_mode='link')
+        RepositoryTest._clear_local(repository)
+        src_path = os.path.join(TEST_PATH, 'link-test-source')
+        with open(src_path, 'w') as fh:
+            fh.write('linked')
+        resource = bdkd.datastore.Resource.new('linked', src_path,
+                publish=False)
+        repository.save(resource)
+        self.assertNotEquals(resource.files[0].path, src_path)
+        self.assertEquals(os.stat(resource.files[0].path).st_ino,
+                os.stat(src_path).st_ino)
+        os.remove(src_path)
+        RepositoryTest._clear_local(repository)
+
+    def test_cache_mode_link_not_written_through(self):
+        src_path = os.path.join(TEST_PATH, 'link-test-source')
+        linked_path = os.path.join(TEST_PATH, 'link-test-cache', 'linked')
+        with open(src_path, 'w') as fh:
+            fh.write('original')
+        if os.path.exists(linked_path):
+            os.remove(linked_path)
+        bdkd.datastore.mkdir_p(os.path.dirname(linked_path))
+        os.link(src_path, linked_path)
+        # E.g. a bundle unpacked into the cache
+        bdkd.datastore.datastore._write_member(linked_path, 'unpacked')
+        with open(src_path) as fh:
+            self.assertEquals(fh.read(), 'original')
+        with open(linked_path) as fh:
+            self.assertEquals(fh.read(), 'unpacked')
+        os.remove(src_path)
+        shutil.rmtree(os.path.dirname(linked_path))
+
+    def test_local_file_meta_current(self):
+        path = os.path.join(TEST_PATH, 'meta-current-test')
+        with open(path, 'w') as fh:
+            fh.write('before')
+        mtime = int(time.time()) + 0.25
+        os.utime(path, (mtime, mtime))
+        meta = bdkd.datastore.local_file_meta(path, {})
+        current = bdkd.datastore.datastore._local_file_meta_current
+        self.assertTrue(current(path, meta, os.stat(path).st_mtime))
+        self.assertFalse(current(path, meta, None))
+        # Rewritten within the same second, with the same size
+        with open(path, 'w') as fh:
+            fh.write('after!')
+        os.utime(path, (mtime + 0.5, mtime + 0.5))
+        self.assertEquals(bdkd.datastore.local_file_meta(path, {})['last-modified'],
+                meta['last-modified'])
+        self.assertFalse(current(path, meta, mtime))
+        os.remove(path)
+
+    def test_save_cache_mode_reference(self):
+        repository = bdkd.datastore.Repository(None, 'reference-test',
+                cache_mode='reference')
+        RepositoryTest._clear_local(repository)
+        src_path = os.path.join(TEST_PATH, 'reference-test-source')
+        with open(src_path, 'w') as fh:
+            fh.write('referenced')
+        repository.save(bdkd.datastore.Resource.new('referenced', src_path,
+            publish=False))
+        resource_file = repository.get('referenced').files[0]
+        cache_path = repository._resource_file_dest_path(resource_file)
+        self.assertFalse(os.path.exists(cache_path))
+        self.assertEquals(resource_file.local_path(), src_path)
+        # Once the original changes, the reference is no longer fresh
+        with open(src_path, 'w') as fh:
+            fh.write('changed since saved')
+        self.assertNotEquals(resource_file.local_path(), src_path)
+        self.assertFalse(os.path.exists(cache_path + '.ref'))
+        os.remove(src_path)
+        RepositoryTest._clear_local(repository)
+
+    def test_unknown_cache_mode(self):
+        self.assertRaises(ValueError, bdkd.datastore.Repository, None,
+                'bad-mode', cache_mode='symlink')
+
+    def test_path_locks_released(self):
+        repository = bdkd.datastore.Repository(bdkd.datastore.MemoryHost(),
+                'path-lock-test')
+        RepositoryTest._clear_local(repository)
+        repository.save(self.resource)
+        RepositoryTest._clear_local(repository)
+        resource = repository.get(self.resource.name)
+        threads = [threading.Thread(target=resource.files[0].local_path)
+                for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertTrue(os.path.exists(resource.files[0].path))
+        self.assertEquals(repository._path_locks, {})
+        RepositoryTest._clear_local(repository)
+
+    def test_prefetch_no_host(self):
+        self.assertEquals(self.repository.prefetch(self.resource.files), 0)
+
+    def test_prefetch(self):
+        repository = bdkd.datastore.Repository(MagicMock(), 'prefetch-test',
+                prefetch_workers=1)
+        refreshed = []
+        repository._refresh_resource_file = (lambda resource_file,
+                priority=None: refreshed.append((resource_file, priority)))
+        self.assertEquals(repository.prefetch(self.resource.files), 1)
+        repository.prefetch_wait()
+        self.assertEquals(refreshed, [(self.resource.files[0],
+            bdkd.datastore.PRIORITY_PREFETCH)])
+
+    def test_prefetch_yields_to_foreground(self):
+        repository = bdkd.datastore.Repository(MagicMock(), 'prefetch-test',
+                prefetch_workers=1)
+        refreshed = []
+        repository._refresh_resource_file = (lambda resource_file,
+                priority=None: refreshed.append(resource_file))
+        repository._foreground_count = 1
+        repository.prefetch(self.resource.files)
+        time.sleep(0.1)
+        self.assertEquals(refreshed, [])
+        with repository._foreground_cond:
+            repository._foreground_count = 0
+            repository._foreground_cond.notify_all()
+        repository.prefetch_wait()
+        self.assertEquals(refreshed, self.resource.files)
+
+    def test_bulk_transfer_yields_to_foreground(self):
+        repository = bdkd.datastore.Repository(MagicMock(), 'priority-test')
+        repository._begin_transfer(bdkd.datastore.PRIORITY_FOREGROUND)
+        started = []
+        bulk = threading.Thread(target=lambda: started.append(
+            repository._begin_transfer(bdkd.datastore.PRIORITY_BULK)))
+        bulk.start()
+        time.sleep(0.1)
+        self.assertEquals(started, [])
+        # A further foreground transfer does not wait
+        repository._begin_transfer(bdkd.datastore.PRIORITY_FOREGROUND)
+        repository._end_transfer(bdkd.datastore.PRIORITY_FOREGROUND)
+        repository._end_transfer(bdkd.datastore.PRIORITY_FOREGROUND)
+        bulk.join(5)
+        self.assertEquals(started, [None])
+        self.assertEquals(repository._bulk_count, 1)
+        repository._end_transfer(bdkd.datastore.PRIORITY_BULK)
+
 
 class ResourceTest(unittest.TestCase):
 
@@ -180,14 +919,15 @@ class ResourceTest(unittest.TestCase):
                 metadata=dict(citation=u'M. Seton, R.D. Müller, S. Zahirovic, C. Gaina, T.H. Torsvik, G. Shephard, A. Talsma, M. Gurnis, M. Turner, S. Maus, M. Chandler, Global continental and ocean basin reconstructions since 200 Ma, Earth-Science Reviews, Volume 113, Issues 3-4, July 2012, Pages 212-270, ISSN 0012-8252, 10.1016/j.earscirev.2012.03.002. (http://www.sciencedirect.com/science/article/pii/S0012825212000311)'))
 
     @classmethod
-    def bundled_fixture(self):
+    def bundled_fixture(self, bundle_format='tar.gz'):
         shapefile_dir = os.path.join(FIXTURES, 'FeatureCollections', 
                 'Coastlines', 'Shapefile')
         shapefile_parts = glob.glob(os.path.join(shapefile_dir, '*.*'))
         resource = bdkd.datastore.Resource.new('bundled resource', 
                 shapefile_parts,
                 publish=False,
-                do_bundle=True)
+                do_bundle=True,
+                bundle_format=bundle_format)
         return resource
 
     @classmethod
@@ -270,6 +1010,279 @@ class ResourceTest(unittest.TestCase):
         local_paths = self.bundled_resource.local_paths()
         self.assertEquals(5, len(local_paths))
 
+    def test_sync_directory(self):
+        RepositoryTest._clear_local(self.repository)
+        sync_dir = os.path.join(TEST_PATH, 'sync-test')
+        if os.path.exists(sync_dir):
+            shutil.rmtree(sync_dir)
+        os.makedirs(os.path.join(sync_dir, 'sub'))
+        for name in ['a', 'b', 'sub/c']:
+            with open(os.path.join(sync_dir, name), 'w') as fh:
+                fh.write(name)
+        manifest_path = os.path.join(TEST_PATH, 'sync-test.json')
+        resource = bdkd.datastore.Resource.new('synced', publish=False)
+        self.assertEquals(resource.sync_directory(sync_dir,
+            manifest_path=manifest_path), (['a', 'b', 'sub/c'], [], []))
+        self.repository.save(resource)
+
+        resource = self.repository.get('synced')
+        self.assertEquals(resource.sync_directory(sync_dir,
+            manifest_path=manifest_path), ([], [], []))
+        # Changed, touched (same contents) and removed files
+        with open(os.path.join(sync_dir, 'a'), 'w') as fh:
+            fh.write('changed')
+        os.utime(os.path.join(sync_dir, 'b'), (0, 0))
+        os.remove(os.path.join(sync_dir, 'sub/c'))
+        self.assertEquals(resource.sync_directory(sync_dir, delete=True,
+            manifest_path=manifest_path), ([], ['a'], ['sub/c']))
+        self.repository.save(resource, overwrite=True)
+        resource = self.repository.get('synced')
+        self.assertEquals(sorted(resource_file.storage_location()
+            for resource_file in resource.files), ['a', 'b'])
+        shutil.rmtree(sync_dir)
+        os.remove(manifest_path)
+        RepositoryTest._clear_local(self.repository)
+
+    def test_update_bundle(self):
+        for compress_threads in (1, 3):
+            self.bundled_resource.update_bundle(compress_threads=compress_threads)
+            bundle_file = tarfile.open(self.bundled_resource.bundle.path)
+            self.assertEquals(5, len(bundle_file.getnames()))
+            bundle_file.close()
+
+    def test_zip_bundle_index(self):
+        resource = ResourceTest.bundled_fixture(bundle_format='zip')
+        self.assertTrue(resource.bundle.location().endswith('bundle.zip'))
+        resource.update_bundle()
+        index = resource.bundle.meta('index')
+        self.assertEquals(5, len(index))
+        with open(resource.bundle.path, 'rb') as fh:
+            for resource_file in resource.files:
+                entry = resource.bundle.bundle_entry(
+                        resource_file.storage_location())
+                fh.seek(entry['offset'])
+                contents = bdkd.datastore.datastore._bundle_member_contents(
+                        fh.read(entry['length']), entry)
+                with open(resource_file.path, 'rb') as original:
+                    self.assertEquals(contents, original.read())
+
+    def test_zip_bundle_extracted(self):
+        resource = ResourceTest.bundled_fixture(bundle_format='zip')
+        resource.update_bundle()
+        unpack_path = os.path.join(TEST_PATH, 'zip-extract')
+        if os.path.exists(unpack_path):
+            shutil.rmtree(unpack_path)
+        opened = []
+        ZipFile = zipfile.ZipFile
+
+        class TrackedZipFile(ZipFile):
+            def __init__(self, *args, **kwargs):
+                ZipFile.__init__(self, *args, **kwargs)
+                opened.append(self)
+        with patch('zipfile.ZipFile', TrackedZipFile):
+            names = bdkd.datastore.datastore._extract_bundle(resource.bundle.path,
+                    unpack_path, bdkd.datastore.BUNDLE_FORMAT_ZIP, threads=3)
+        self.assertEquals(sorted(names), sorted(resource_file.storage_location()
+            for resource_file in resource.files))
+        for resource_file in resource.files:
+            with open(resource_file.path, 'rb') as original:
+                with open(os.path.join(unpack_path,
+                    resource_file.storage_location()), 'rb') as fh:
+                    self.assertEquals(fh.read(), original.read())
+        # No handle on the archive is left open
+        self.assertTrue(opened)
+        self.assertEquals([zip_file.fp for zip_file in opened], [None] * len(opened))
+        shutil.rmtree(unpack_path)
+
+    def test_zip_bundle_ranged_fetch(self):
+        resource = ResourceTest.bundled_fixture(bundle_format='zip')
+        resource.update_bundle()
+        with open(resource.bundle.path, 'rb') as fh:
+            bundle_data = fh.read()
+        def ranged_get(headers):
+            start, end = headers['Range'][len('bytes='):].split('-')
+            return bundle_data[int(start):int(end) + 1]
+        repository = bdkd.datastore.Repository(MagicMock(), 'ranged-test')
+        RepositoryTest._clear_local(repository)
+        bucket = repository.get_bucket()
+        bucket.new_key.return_value.get_contents_as_string.side_effect = ranged_get
+        resource.repository = repository
+        resource_file = resource.files[0]
+        with open(resource_file.path, 'rb') as fh:
+            expected = fh.read()
+        local_path = repository._refresh_bundled_file(resource_file)
+        self.assertTrue(local_path.startswith(repository.local_cache))
+        with open(local_path, 'rb') as fh:
+            self.assertEquals(fh.read(), expected)
+        bucket.new_key.assert_called_with(resource.bundle.location())
+
+    def test_unpack_bundle_skipped_when_unchanged(self):
+        RepositoryTest._clear_local(self.repository)
+        self.repository.save(self.bundled_resource)
+        self.bundled_resource.bundle.resource = self.bundled_resource
+        extract = bdkd.datastore.datastore._extract_bundle
+        with patch('bdkd.datastore.datastore._extract_bundle',
+                side_effect=extract) as mock_extract:
+            self.bundled_resource.bundle.unpack_bundle()
+            self.assertEquals(mock_extract.call_count, 1)
+            self.bundled_resource.bundle.unpack_bundle()
+            self.assertEquals(mock_extract.call_count, 1)
+            # A missing member forces the bundle to be unpacked again
+            os.remove(self.repository._resource_file_dest_path(
+                self.bundled_resource.files[0]))
+            self.bundled_resource.bundle.unpack_bundle()
+            self.assertEquals(mock_extract.call_count, 2)
+
+    def test_zip_bundle_incremental_update(self):
+        work_path = os.path.join(TEST_PATH, 'incremental')
+        if os.path.exists(work_path):
+            shutil.rmtree(work_path)
+        shutil.copytree(os.path.join(FIXTURES, 'FeatureCollections',
+            'Coastlines', 'Shapefile'), work_path)
+        resource = bdkd.datastore.Resource.new('incremental resource',
+                glob.glob(os.path.join(work_path, '*.*')), publish=False,
+                do_bundle=True, bundle_format='zip')
+        resource.update_bundle()
+        writer = bdkd.datastore.datastore._ZipBundleWriter
+        with patch.object(writer, 'write', side_effect=writer.write,
+                autospec=True) as mock_write, \
+                patch('bdkd.datastore.datastore.checksum') as mock_checksum:
+            resource.update_bundle()
+            self.assertEquals(mock_write.call_count, 0)
+            # Unchanged files are recognised without reading them
+            self.assertFalse(mock_checksum.called)
+            with open(resource.files[0].path, 'ab') as fh:
+                fh.write('changed')
+            resource.update_bundle()
+            self.assertEquals(mock_write.call_count, 1)
+            # A file touched but not changed is still copied
+            os.utime(resource.files[1].path, None)
+            mock_checksum.side_effect = bdkd.datastore.checksum
+            resource.update_bundle()
+            self.assertEquals(mock_write.call_count, 1)
+        bundle_file = zipfile.ZipFile(resource.bundle.path)
+        self.assertEquals(bundle_file.testzip(), None)
+        for resource_file in resource.files:
+            with open(resource_file.path, 'rb') as fh:
+                self.assertEquals(bundle_file.read(
+                    resource_file.storage_location()), fh.read())
+        bundle_file.close()
+
+    def test_tar_bundle_no_ranged_fetch(self):
+        self.bundled_resource.repository = self.repository
+        self.assertEquals(self.repository._refresh_bundled_file(
+            self.bundled_resource.files[0]), None)
+
+
+class StreamingTest(unittest.TestCase):
+
+    def test_parallel_gzip(self):
+        data = ''.join(str(i) for i in range(20000))
+        out = io.BytesIO()
+        gzip_file = bdkd.datastore.ParallelGzipFile(out, threads=3,
+                block_size=1000)
+        for i in range(0, len(data), 700):
+            gzip_file.write(data[i:i + 700])
+        gzip_file.close()
+        self.assertEquals(gzip.GzipFile(fileobj=io.BytesIO(out.getvalue())).read(),
+                data)
+
+    def test_parallel_gzip_empty(self):
+        out = io.BytesIO()
+        bdkd.datastore.ParallelGzipFile(out).close()
+        self.assertEquals(gzip.GzipFile(fileobj=io.BytesIO(out.getvalue())).read(),
+                '')
+
+    def test_multipart_upload(self):
+        multipart_upload = MagicMock()
+        parts = {}
+        multipart_upload.upload_part_from_file.side_effect = (lambda fp,
+                part_num: parts.__setitem__(part_num, fp.read()))
+        stream = bdkd.datastore.MultipartUploadFile(multipart_upload,
+                part_size=10)
+        stream.write('a' * 15)
+        stream.write('b' * 10)
+        stream.close()
+        self.assertEquals(''.join(parts[i] for i in sorted(parts)),
+                'a' * 15 + 'b' * 10)
+        self.assertEquals(sorted(parts), [1, 2, 3])
+        multipart_upload.complete_upload.assert_called_with()
+
+    def test_multipart_upload_retried(self):
+        multipart_upload = MagicMock()
+        parts = {}
+        failures = [socket.error('reset')]
+
+        def upload_part_from_file(fp, part_num):
+            # The connection is reset after part of the first part is sent
+            data = fp.read(3)
+            if failures:
+                raise failures.pop()
+            parts[part_num] = data + fp.read()
+        multipart_upload.upload_part_from_file.side_effect = upload_part_from_file
+        stream = bdkd.datastore.MultipartUploadFile(multipart_upload,
+                part_size=10, upload_threads=1,
+                throttle=bdkd.datastore.RequestThrottle(backoff_base=0))
+        stream.write('a' * 10 + 'b' * 5)
+        stream.close()
+        self.assertEquals(multipart_upload.upload_part_from_file.call_count, 3)
+        self.assertEquals(''.join(parts[i] for i in sorted(parts)),
+                'a' * 10 + 'b' * 5)
+
+    def test_multipart_upload_error(self):
+        multipart_upload = MagicMock()
+        multipart_upload.upload_part_from_file.side_effect = IOError()
+        stream = bdkd.datastore.MultipartUploadFile(multipart_upload,
+                part_size=10)
+        stream.write('a' * 5)
+        self.assertRaises(IOError, stream.close)
+        multipart_upload.cancel_upload.assert_called_with()
+        self.assertFalse(multipart_upload.complete_upload.called)
+
+
+class ResourceFileMapTest(unittest.TestCase):
+    # Memory maps of local files: unlike ResourceFileTest, no network needed
+
+    def setUp(self):
+        self.resource_file = ResourceTest.fixture().files[0]
+        with open(self.resource_file.local_path(), 'rb') as fh:
+            self.content = fh.read()
+
+    def test_mmap(self):
+        mapped = self.resource_file.mmap()
+        self.assertEquals(len(mapped), len(self.content))
+        self.assertEquals(mapped[:], self.content)
+        mapped.close()
+
+    def test_mmap_empty(self):
+        empty_path = os.path.join(TEST_PATH, 'empty')
+        if not os.path.exists(TEST_PATH):
+            os.makedirs(TEST_PATH)
+        open(empty_path, 'wb').close()
+        resource_file = bdkd.datastore.ResourceFile(empty_path)
+        self.assertEquals(len(resource_file.mmap()), 0)
+
+    def test_memmap_arguments(self):
+        numpy = MagicMock()
+        with patch.dict('sys.modules', numpy=numpy):
+            mapped = self.resource_file.memmap(dtype='float32', shape=(2, 3),
+                    offset=8)
+        numpy.memmap.assert_called_once_with(self.resource_file.local_path(),
+                dtype='float32', mode='r', offset=8, shape=(2, 3), order='C')
+        self.assertTrue(mapped is numpy.memmap.return_value)
+
+    @unittest.skipIf(not _has_numpy(), "numpy is not installed")
+    def test_memmap(self):
+        import numpy
+        mapped = self.resource_file.memmap()
+        self.assertEquals(mapped.dtype, numpy.uint8)
+        self.assertEquals(len(mapped), len(self.content))
+        self.assertEquals(mapped.tostring(), self.content)
+        self.assertRaises(ValueError, mapped.__setitem__, 0, 0)
+        words = self.resource_file.memmap(dtype='<u4', shape=(2,), offset=4)
+        self.assertEquals(list(words), list(struct.unpack('<2I',
+            self.content[4:12])))
+
 
 class ResourceFileTest(unittest.TestCase):
 
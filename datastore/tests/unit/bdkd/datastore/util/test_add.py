@@ -18,9 +18,11 @@ from mock import patch, ANY
 import argparse
 
 import os
+import shutil
 # Load a custom configuration for unit testing
 os.environ['BDKD_DATASTORE_CONFIG'] = os.path.join(
         os.path.dirname(__file__), '..', '..', '..', 'conf', 'test.conf')
+import bdkd.datastore
 from bdkd.datastore.util import ds_util
 
 FIXTURES = os.path.join(os.path.dirname(__file__), 
@@ -77,6 +79,18 @@ class CreateTest(unittest.TestCase):
                 'some/nonexistent/file' ]
         self.assertRaises(ValueError, self.parser.parse_args, args_in)
 
+    def test_sync_arguments(self):
+        args_in = [ 'sync', '--no-publish', '--delete', '--workers', '2',
+                'test-repository', 'my_resource', FIXTURES ]
+        args = self.parser.parse_args(args_in)
+        self.assertEquals(args.repository.name, 'test-repository')
+        self.assertEquals(args.resource_name, 'my_resource')
+        self.assertEquals(args.directory, FIXTURES)
+        self.assertEquals(args.publish, False)
+        self.assertEquals(args.delete, True)
+        self.assertEquals(args.workers, 2)
+        self.assertEquals(args.filenames, [])
+
     def test_create_all_arguments(self):
         args_in = [ 'create', '--force', '--bundle', '--no-publish',
                     'test-repository', 'my_resource',
@@ -233,3 +247,37 @@ class CreateTest(unittest.TestCase):
             files_data=['file1','dir1/subdir1/file1','dir1/subdir2/file2'],
             metadata={},
             publish=False)
+
+
+class SyncTest(unittest.TestCase):
+
+    def setUp(self):
+        self.sync_dir = os.path.join('/var/tmp/test', 'sync-util-test')
+        if os.path.exists(self.sync_dir):
+            shutil.rmtree(self.sync_dir)
+        os.makedirs(os.path.join(self.sync_dir, 'sub'))
+        for name in ['a', 'sub/b']:
+            with open(os.path.join(self.sync_dir, name), 'w') as fh:
+                fh.write(name)
+        self.repository = bdkd.datastore.repository('test-memory-repository')
+        if os.path.exists(self.repository.local_cache):
+            shutil.rmtree(self.repository.local_cache)
+
+    def tearDown(self):
+        shutil.rmtree(self.sync_dir)
+
+    def test_sync_new_published_resource(self):
+        # Published by default, as the resource is created by the sync
+        ds_util.ds_util(['sync', '--description', 'Synchronised',
+            '--author', 'Fred', '--author-email', 'fred@here', '--workers', '2',
+            'test-memory-repository', 'synced', self.sync_dir])
+        resource = self.repository.get('synced')
+        self.assertTrue(resource.published)
+        self.assertEquals(sorted(resource_file.storage_location()
+            for resource_file in resource.files), ['a', 'sub/b'])
+        self.assertEquals(self.repository.upload_threads, 4)
+        # Synchronising the published resource again needs the override
+        self.assertRaises(ValueError, ds_util.ds_util, ['sync',
+            'test-memory-repository', 'synced', self.sync_dir])
+        ds_util.ds_util(['sync', '--update-published',
+            'test-memory-repository', 'synced', self.sync_dir])
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+# Copyright 2015 Nicta
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+from mock import patch
+import argparse
+import glob
+import shutil
+import StringIO
+
+import os
+# Load a custom configuration for unit testing
+os.environ['BDKD_DATASTORE_CONFIG'] = os.path.join(
+        os.path.dirname(__file__), '..', '..', '..', 'conf', 'test.conf')
+import bdkd.datastore
+from bdkd.datastore.util import ds_util
+from bdkd.datastore.util import common as util_common
+
+FIXTURES = os.path.join(os.path.dirname(__file__),
+    '..', '..', '..', '..', 'fixtures')
+TEST_PATH='/var/tmp/test'
+
+
+class FetchUtilitiesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.parser = argparse.ArgumentParser()
+        subparser = self.parser.add_subparsers(dest='subcmd')
+        ds_util._create_subparsers(subparser)
+        self.repository = bdkd.datastore.repository('test-repository')
+        if os.path.exists(self.repository.local_cache):
+            shutil.rmtree(self.repository.local_cache)
+        shapefile_parts = glob.glob(os.path.join(FIXTURES, 'FeatureCollections',
+            'Coastlines', 'Shapefile', '*.*'))
+        self.repository.save(bdkd.datastore.Resource.new('fetch_resource',
+            shapefile_parts, publish=False))
+
+    def tearDown(self):
+        shutil.rmtree(self.repository.local_cache)
+
+    def test_fetch_arguments(self):
+        args = self.parser.parse_args(['fetch', '--match', '*.shp', '-w', '3',
+            '--to', TEST_PATH, 'test-repository', 'fetch_resource'])
+        self.assertEquals(args.match, '*.shp')
+        self.assertEquals(args.workers, 3)
+        self.assertEquals(args.to_directory, TEST_PATH)
+        self.assertEquals(args.progress, None)
+
+    def test_files_match(self):
+        args = self.parser.parse_args(['files', '--match', '*.shp',
+            '--progress', 'test-repository', 'fetch_resource'])
+        with patch('sys.stdout', new_callable=StringIO.StringIO) as stdout:
+            with patch('sys.stderr', new_callable=StringIO.StringIO) as stderr:
+                ds_util._list_resource_files(args.repository,
+                        args.resource_name, args)
+        paths = stdout.getvalue().splitlines()
+        self.assertEquals(len(paths), 1)
+        self.assertTrue(paths[0].endswith('.shp'))
+        self.assertTrue(os.path.exists(paths[0]))
+        self.assertTrue('1/1 files' in stderr.getvalue())
+
+    def test_fetch_to_directory(self):
+        to_directory = os.path.join(TEST_PATH, 'fetch-test')
+        if os.path.exists(to_directory):
+            shutil.rmtree(to_directory)
+        args = self.parser.parse_args(['fetch', '--contains', r'\.(dbf|prj)$',
+            '--to', to_directory, 'test-repository', 'fetch_resource'])
+        with patch('sys.stdout', new_callable=StringIO.StringIO) as stdout:
+            ds_util._fetch_files(args.repository, args.resource_name, args,
+                    print_paths=False)
+        self.assertEquals(stdout.getvalue(), '')
+        self.assertEquals(sorted(os.path.splitext(name)[1] for name in
+            os.listdir(to_directory)), ['.dbf', '.prj'])
+        shutil.rmtree(to_directory)
+
+    def test_transfer_progress(self):
+        stream = StringIO.StringIO()
+        progress = util_common.TransferProgress(2, 3 * 1024 * 1024,
+                stream=stream)
+        progress.update(1024 * 1024)
+        self.assertTrue(progress.summary().startswith('1/2 files, 1.0 MiB of 3.0 MiB'))
+        self.assertTrue('ETA' in progress.summary())
+        progress.update(2 * 1024 * 1024)
+        progress.finish()
+        self.assertTrue(stream.getvalue().endswith('\n'))
+        self.assertFalse('ETA' in progress.summary())
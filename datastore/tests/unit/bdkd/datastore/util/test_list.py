@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+# Copyright 2015 Nicta
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+from mock import MagicMock, patch
+import argparse
+import json
+import StringIO
+import time
+
+import os
+# Load a custom configuration for unit testing
+os.environ['BDKD_DATASTORE_CONFIG'] = os.path.join(
+        os.path.dirname(__file__), '..', '..', '..', 'conf', 'test.conf')
+from bdkd.datastore.util import ds_util
+
+
+class ListUtilitiesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.parser = argparse.ArgumentParser()
+        subparser = self.parser.add_subparsers(dest='subcmd')
+        ds_util._create_subparsers(subparser)
+        self.names = ['resource_{0}'.format(i) for i in range(5)]
+        self.repository = MagicMock()
+        self.repository.list.return_value = self.names
+
+        def get(name):
+            # Later resources are fetched sooner
+            time.sleep(0.01 * (len(self.names) - self.names.index(name)))
+            resource = MagicMock()
+            resource.to_json.return_value = json.dumps(dict(name=name))
+            return resource
+        self.repository.get.side_effect = get
+
+    def test_list_arguments(self):
+        args = self.parser.parse_args(['list', '-v', '--format', 'ndjson',
+            '--workers', '3', 'test-repository'])
+        self.assertEquals(args.verbose, True)
+        self.assertEquals(args.format, 'ndjson')
+        self.assertEquals(args.workers, 3)
+
+    def test_list_names(self):
+        with patch('sys.stdout', new_callable=StringIO.StringIO) as stdout:
+            ds_util._list_resources(self.repository, None, False)
+        self.assertEquals(stdout.getvalue().splitlines(), self.names)
+        self.assertFalse(self.repository.get.called)
+
+    def test_list_verbose_ndjson_in_order(self):
+        with patch('sys.stdout', new_callable=StringIO.StringIO) as stdout:
+            ds_util._list_resources(self.repository, None, True, 'ndjson',
+                    workers=5)
+        self.assertEquals([json.loads(line)['name'] for line in
+            stdout.getvalue().splitlines()], self.names)
@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+# Copyright 2015 Nicta
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+import json
+import StringIO
+import os
+import shutil
+import socket
+import sys
+import threading
+from mock import patch
+# Load a custom configuration for unit testing
+os.environ['BDKD_DATASTORE_CONFIG'] = os.path.join(
+        os.path.dirname(__file__), '..', '..', '..', 'conf', 'test.conf')
+import bdkd.datastore
+from bdkd.datastore.util import service
+
+FIXTURES = os.path.join(os.path.dirname(__file__),
+    '..', '..', '..', '..', 'fixtures')
+TEST_PATH='/var/tmp/test'
+
+
+class ServiceTest(unittest.TestCase):
+
+    def setUp(self):
+        self.filepath = os.path.join(FIXTURES, 'FeatureCollections', 'Coastlines',
+                    'Seton_etal_ESR2012_Coastlines_2012.1.gpmlz')
+        self.repository = bdkd.datastore.repository('test-repository')
+        if os.path.exists(self.repository.local_cache):
+            shutil.rmtree(self.repository.local_cache)
+        self.service = service.DatastoreService()
+
+    def test_repositories(self):
+        self.assertTrue('test-repository' in self.service.repositories())
+
+    def test_create_list_get_delete(self):
+        self.assertTrue(self.service.create('test-repository', 'my_resource',
+            filenames=[self.filepath], metadata={'author-email': 'fred@up.com'}))
+        self.assertEquals(self.service.list('test-repository'), ['my_resource'])
+        details = self.service.get('test-repository', 'my_resource')
+        self.assertEquals(details['name'], 'my_resource')
+        self.assertEquals(details['metadata']['author_email'], 'fred@up.com')
+        self.assertEquals(len(details['files']), 1)
+        self.assertEquals(self.service.versions('test-repository', 'my_resource'),
+                [details['version']])
+        self.assertEquals(self.service.get('test-repository', 'my_resource',
+            version=details['version'])['name'], 'my_resource')
+        self.assertTrue(self.service.delete('test-repository', 'my_resource'))
+        self.assertEquals(self.service.list('test-repository'), [])
+
+    def test_stats(self):
+        self.service.stats(reset=True)
+        self.assertTrue(self.service.create('test-repository', 'stats_resource',
+            filenames=[self.filepath]))
+        counters = dict((counter['name'], counter['value']) for counter in
+                self.service.stats()['counters'])
+        self.assertTrue(counters['checksum_bytes_total'] > 0)
+        self.assertTrue('bdkd_datastore_checksum_seconds_count'
+                in self.service.stats(format='prometheus', reset=True))
+        self.assertEquals(self.service.stats()['counters'], [])
+        self.assertRaises(ValueError, self.service.stats, format='xml')
+
+    def test_handle_request(self):
+        response = json.loads(self.service.handle_request(json.dumps(
+            dict(id=7, method='list', params=dict(repository='test-repository')))))
+        self.assertEquals(response, dict(id=7, result=[]))
+
+    def test_handle_request_error(self):
+        response = json.loads(self.service.handle_request(json.dumps(
+            dict(id=8, method='get', params=dict(repository='test-repository',
+                resource='does-not-exist')))))
+        self.assertEquals(response['id'], 8)
+        self.assertEquals(response['error']['type'], 'ValueError')
+        response = json.loads(self.service.handle_request(json.dumps(
+            dict(id=9, method='_repository', params=dict(name='test-repository')))))
+        self.assertEquals(response['error']['message'], "Unknown method '_repository'")
+
+    def test_run_batch(self):
+        requests = [dict(id=i, method='create', params=dict(
+            repository='test-repository', resource='batch_{0}'.format(i),
+            filenames=[self.filepath])) for i in range(3)]
+        requests.append(dict(id=3, method='delete', params=dict(
+            repository='test-repository', resource='does-not-exist')))
+        output = StringIO.StringIO()
+        failures = service.run_batch(StringIO.StringIO(
+            '\n'.join(json.dumps(request) for request in requests) + '\n\n'),
+            output, workers=2)
+        self.assertEquals(failures, 1)
+        responses = [json.loads(line) for line in output.getvalue().splitlines()]
+        self.assertEquals([response['id'] for response in responses], [0, 1, 2, 3])
+        self.assertTrue('error' in responses[3])
+        self.assertEquals(sorted(self.service.list('test-repository')),
+                ['batch_0', 'batch_1', 'batch_2'])
+
+    def test_run_batch_stdout(self):
+        # Responses written to stdout are not mixed with anything else
+        self.assertTrue(self.service.create('test-repository', 'published',
+            filenames=[self.filepath], publish=True, metadata={
+                'description': 'Published', 'author': 'Fred',
+                'author-email': 'fred@up.com'}))
+        requests = [dict(id=i, method=method, params=dict(
+            repository='test-repository', resource='published'))
+            for i, method in enumerate(['publish', 'unpublish', 'unpublish'])]
+        with patch('sys.stdout', new_callable=StringIO.StringIO) as stdout:
+            failures = service.run_batch(StringIO.StringIO(
+                '\n'.join(json.dumps(request) for request in requests) + '\n'),
+                sys.stdout)
+        self.assertEquals(failures, 0)
+        responses = [json.loads(line) for line in stdout.getvalue().splitlines()]
+        self.assertEquals([response['id'] for response in responses], [0, 1, 2])
+        self.assertTrue(self.service.delete('test-repository', 'published'))
+
+    def test_serve(self):
+        socket_path = os.path.join(TEST_PATH, 'service-test.sock')
+        if not os.path.exists(TEST_PATH):
+            os.makedirs(TEST_PATH)
+        server = service.ServiceServer(socket_path, self.service, idle_timeout=0.1)
+        server_thread = threading.Thread(target=server.serve)
+        server_thread.start()
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        client.connect(socket_path)
+        client_file = client.makefile('rwb')
+        for request_id in range(2):
+            client_file.write(json.dumps(dict(id=request_id,
+                method='repositories')) + '\n')
+            client_file.flush()
+            response = json.loads(client_file.readline())
+            self.assertEquals(response['id'], request_id)
+            self.assertTrue('test-repository' in response['result'])
+        client_file.close()
+        client.close()
+        # With no connections, the server stops after its idle timeout
+        server_thread.join(5)
+        self.assertFalse(server_thread.is_alive())
+        self.assertFalse(os.path.exists(socket_path))
@@ -106,12 +106,13 @@ class Dataset(object):
 
 
     @classmethod
-    def open(cls, repo_name, resource_name):
+    def open(cls, repo_name, resource_name, prefetch_distance=0):
         repository = bdkd.datastore.repository(repo_name)
         if repository:
             resource = repository.get(resource_name)
             if resource:
-                return cls(resource_name, resource)
+                return cls(resource_name, resource,
+                        prefetch_distance=prefetch_distance)
         return None
 
 
@@ -127,7 +128,7 @@ class Dataset(object):
                 self.shards[(x, y)] = shard_file
 
 
-    def __init__(self, name, resource):
+    def __init__(self, name, resource, prefetch_distance=0):
         type(self).validate(resource)
         # Expose all mandatory fields as attributes
         for attr_name in type(self).META_REQUIRED_FIELDS:
@@ -137,9 +138,42 @@ class Dataset(object):
                 self.z_interval_base * self.z_interval_exponent)
         self.name = name
         self.resource = resource
+        self.prefetch_distance = prefetch_distance
         self._map_shard_files()
 
 
+    def prefetch_adjacent_shards(self, x, y, distance=None):
+        """
+        Queue the shards surrounding the shard containing (x,y) to be
+        downloaded in the background.
+
+        Shards within 'distance' shards of (x,y) are queued, nearest first.
+        Returns the number of shards queued.
+        """
+        if distance is None:
+            distance = self.prefetch_distance
+        repository = self.resource.repository
+        if not distance or not repository:
+            return 0
+        x_shard = int(x / self.shard_size) * self.shard_size
+        y_shard = int(y / self.shard_size) * self.shard_size
+        queued = 0
+        for ring in range(1, distance + 1):
+            ring_files = []
+            for dx in range(-ring, ring + 1):
+                for dy in range(-ring, ring + 1):
+                    if max(abs(dx), abs(dy)) != ring:
+                        continue
+                    shard_file = self.shards.get((
+                        x_shard + dx * self.shard_size,
+                        y_shard + dy * self.shard_size))
+                    if shard_file:
+                        ring_files.append(shard_file)
+            queued += repository.prefetch(ring_files,
+                    priority=bdkd.datastore.PRIORITY_PREFETCH + ring)
+        return queued
+
+
     def get_map_names(self, include_variables=True):
         """
         Get the names of all available maps from the maps file.
@@ -219,6 +253,7 @@ class Dataset(object):
         if (x_shard, y_shard) in self.shards:
             shard_file = self.shards[(x_shard,y_shard)]
             shard = h5py.File(shard_file.local_path(), 'r')
+            self.prefetch_adjacent_shards(x, y)
             for (name, dataset) in shard.iteritems():
                 x_index = dataset.attrs.get('x_index', None)
                 y_index = dataset.attrs.get('y_index', None)